@@ -0,0 +1,262 @@
+import * as crypto from "crypto";
+import { CollectionQuery } from "../query/collectionQuery";
+import { ProductQuery } from "../query/productQuery";
+
+import "mocha"; // test reqs
+import "mocha-inline"; // test reqs
+import * as chai from "chai"; // test reqs
+
+export interface ICachedResponse {
+  body: string;
+  etag: string;
+}
+
+interface IEntry extends ICachedResponse {
+  key: string;
+  // The collections a product search covers, null for a collection search
+  collections: string[] | null;
+  expires: number;
+}
+
+// Serialised search responses, keyed by route and normalised query, so a repeated search
+// is answered without running the query or rebuilding the footprint json. Product search
+// responses are dropped when products are added to one of their collections and
+// collection search responses when a collection is added. Writes that do not go through
+// this process (another API instance, the importer's direct database loads) are only seen
+// once an entry is older than the time to live. Least recently used entries are evicted
+// past the size limit.
+export class ResponseCache {
+  private entries = new Map<string, IEntry>();
+  private byCollection = new Map<string, Set<string>>();
+  private collectionSearches = new Set<string>();
+  private bytes = 0;
+  // Bumped by every invalidation, a response built while a write was in progress is not
+  // cached as it may be missing the write
+  private epoch = 0;
+
+  constructor(private maxBytes: number, private ttlSeconds: number) { }
+
+  public get enabled(): boolean {
+    return this.maxBytes > 0 && this.ttlSeconds > 0;
+  }
+
+  public get size(): number {
+    return this.entries.size;
+  }
+
+  public static productQueryKey(route: string, query: ProductQuery): string {
+    return JSON.stringify([
+      route,
+      // Searching a set of collections, whatever order they are listed in
+      Array.isArray(query.collections) ? query.collections.slice().sort() : query.collections,
+      query.productName,
+      query.footprint,
+      query.spatialop,
+      // Terms are checked after the lookup, so may not be well formed yet
+      Array.isArray(query.terms) ? query.terms.map(t => t && [t.property, t.operation, t.value]) : query.terms,
+      query.offset,
+      query.limit,
+      query.after
+    ]);
+  }
+
+  public static collectionQueryKey(query: CollectionQuery): string {
+    return JSON.stringify(["/search/collection", query.collection]);
+  }
+
+  public static etag(body: string): string {
+    return `"${crypto.createHash("sha1").update(body).digest("base64")}"`;
+  }
+
+  // Whether an If-None-Match header value matches an entity tag, weak comparison as for GET
+  public static matches(ifNoneMatch: string | undefined, etag: string): boolean {
+    if (!ifNoneMatch) {
+      return false;
+    }
+    let strip = (tag: string) => tag.trim().replace(/^W\//, "");
+    return ifNoneMatch.split(",").some(tag => tag.trim() === "*" || strip(tag) === strip(etag));
+  }
+
+  public get(key: string): ICachedResponse | undefined {
+    let entry = this.entries.get(key);
+    if (entry === undefined) {
+      return undefined;
+    }
+    if (entry.expires <= Date.now()) {
+      this.remove(entry);
+      return undefined;
+    }
+    // Map iteration follows insertion order, re-inserting keeps the oldest used first
+    this.entries.delete(key);
+    this.entries.set(key, entry);
+    return entry;
+  }
+
+  // Call before running a query, pass the result to set with the response
+  public begin(): number {
+    return this.epoch;
+  }
+
+  // Caches a response unless the cache was invalidated since begin, returns the response
+  // with its entity tag either way
+  public set(key: string, body: string, collections: string[] | null, epoch: number): ICachedResponse {
+    let response = { body: body, etag: ResponseCache.etag(body) };
+
+    if (!this.enabled || epoch !== this.epoch || body.length > this.maxBytes) {
+      return response;
+    }
+
+    let existing = this.entries.get(key);
+    if (existing !== undefined) {
+      this.remove(existing);
+    }
+
+    let entry: IEntry = {
+      key: key,
+      body: response.body,
+      etag: response.etag,
+      collections: collections,
+      expires: Date.now() + this.ttlSeconds * 1000
+    };
+    this.entries.set(key, entry);
+    this.bytes += body.length;
+
+    if (collections === null) {
+      this.collectionSearches.add(key);
+    } else {
+      collections.forEach(name => {
+        let keys = this.byCollection.get(name);
+        if (keys === undefined) {
+          keys = new Set<string>();
+          this.byCollection.set(name, keys);
+        }
+        keys.add(key);
+      });
+    }
+
+    for (let oldest of this.entries.values()) {
+      if (this.bytes <= this.maxBytes) {
+        break;
+      }
+      this.remove(oldest);
+    }
+
+    return response;
+  }
+
+  // Drops the product searches of the collections products were added to
+  public invalidateProducts(collectionNames: string[]) {
+    this.epoch++;
+    new Set(collectionNames).forEach(name => {
+      let keys = this.byCollection.get(name);
+      if (keys !== undefined) {
+        Array.from(keys).forEach(key => this.remove(this.entries.get(key)));
+      }
+    });
+  }
+
+  // Drops the collection searches, after a collection is added
+  public invalidateCollections() {
+    this.epoch++;
+    Array.from(this.collectionSearches).forEach(key => this.remove(this.entries.get(key)));
+  }
+
+  private remove(entry: IEntry | undefined) {
+    if (entry === undefined || !this.entries.delete(entry.key)) {
+      return;
+    }
+    let key = entry.key;
+    this.bytes -= entry.body.length;
+
+    if (entry.collections === null) {
+      this.collectionSearches.delete(key);
+    } else {
+      entry.collections.forEach(name => {
+        let keys = this.byCollection.get(name);
+        if (keys !== undefined) {
+          keys.delete(key);
+          if (keys.size == 0) {
+            this.byCollection.delete(name);
+          }
+        }
+      });
+    }
+  }
+}
+
+describe("Response Cache", () => {
+  let cache: ResponseCache;
+
+  let productKey = (collections: string[]) =>
+    ResponseCache.productQueryKey("/search/product", new ProductQuery({collections: collections}));
+
+  beforeEach(() => {
+    cache = new ResponseCache(1024, 60);
+  });
+
+  it("should key equivalent product queries the same", () => {
+    let defaults = new ProductQuery({collections: ["a/b"]});
+    let explicit = new ProductQuery({collections: ["a/b"], offset: 0, limit: 50, spatialop: "intersects"});
+
+    chai.expect(ResponseCache.productQueryKey("/search/product", defaults))
+      .to.equal(ResponseCache.productQueryKey("/search/product", explicit));
+    chai.expect(ResponseCache.productQueryKey("/search/product", defaults))
+      .to.not.equal(ResponseCache.productQueryKey("/search/product/count", defaults));
+  });
+
+  it("should key product queries the same whatever the order of their collections", () => {
+    let ab = new ProductQuery({collections: ["a/b", "a/c"]});
+    let ba = new ProductQuery({collections: ["a/c", "a/b"]});
+
+    chai.expect(ResponseCache.productQueryKey("/search/product", ab))
+      .to.equal(ResponseCache.productQueryKey("/search/product", ba));
+    chai.expect(ba.collections).to.deep.equal(["a/c", "a/b"]);
+  });
+
+  it("should return a cached response with its entity tag", () => {
+    let stored = cache.set(productKey(["a/b"]), '{"result":[]}', ["a/b"], cache.begin());
+
+    chai.expect(cache.get(productKey(["a/b"]))).to.deep.include(stored);
+    chai.expect(stored.etag).to.equal(ResponseCache.etag('{"result":[]}'));
+  });
+
+  it("should only drop the searches of a collection products were added to", () => {
+    cache.set(productKey(["a/b"]), "1", ["a/b"], cache.begin());
+    cache.set(productKey(["a/c"]), "2", ["a/c"], cache.begin());
+    cache.set(productKey(["a/b", "a/c"]), "3", ["a/b", "a/c"], cache.begin());
+
+    cache.invalidateProducts(["a/b"]);
+
+    chai.expect(cache.get(productKey(["a/b"]))).to.be.undefined;
+    chai.expect(cache.get(productKey(["a/b", "a/c"]))).to.be.undefined;
+    chai.expect(cache.get(productKey(["a/c"]))).to.not.be.undefined;
+  });
+
+  it("should not cache a response built across an invalidation", () => {
+    let epoch = cache.begin();
+    cache.invalidateProducts(["a/b"]);
+    cache.set(productKey(["a/b"]), "1", ["a/b"], epoch);
+
+    chai.expect(cache.get(productKey(["a/b"]))).to.be.undefined;
+  });
+
+  it("should evict the least recently used responses past the size limit", () => {
+    let body = "x".repeat(400);
+    cache.set("first", body, [], cache.begin());
+    cache.set("second", body, [], cache.begin());
+    cache.get("first");
+    cache.set("third", body, [], cache.begin());
+
+    chai.expect(cache.get("second")).to.be.undefined;
+    chai.expect(cache.get("first")).to.not.be.undefined;
+    chai.expect(cache.get("third")).to.not.be.undefined;
+  });
+
+  it("should match If-None-Match lists, weak tags and wildcards", () => {
+    chai.expect(ResponseCache.matches('"a", "b"', '"b"')).to.be.true;
+    chai.expect(ResponseCache.matches('W/"b"', '"b"')).to.be.true;
+    chai.expect(ResponseCache.matches("*", '"b"')).to.be.true;
+    chai.expect(ResponseCache.matches('"a"', '"b"')).to.be.false;
+    chai.expect(ResponseCache.matches(undefined, '"b"')).to.be.false;
+  });
+});
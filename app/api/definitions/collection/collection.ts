@@ -33,7 +33,7 @@ export function validate(collection: ICollection) {
 export const Schema = {
   $schema: "http://json-schema.org/draft-07/schema#",
   $async: true,
-  title: "Product",
+  title: "Collection",
   type: "object",
   properties: {
     id: {
@@ -47,17 +47,17 @@ export const Schema = {
     metadata: {
       $ref: "#/definitions/metadata/metadata"
     },
-    propertiesSchema: {
-      type: "object"
+    productsSchema: {
+      type: ["object", "null"]
     },
     footprint: {
       $ref: "#/definitions/footprint/footprint"
-    },
-    required: ["id", "name", "metadata", "propertiesSchema", "footprint"]
+    }
   },
   definitions: {
     metadata: Metadata.Schema,
     footprint: Footprint.Schema
   },
-  required: ["id", "name", "metadata", "footprint"]
+  // The id is assigned by the database when a collection is added
+  required: ["name", "metadata"]
 };
@@ -21,6 +21,9 @@ export class ProductQuery {
   public terms: ITerm[] = [];
   public types: any = {};
   public productName: string = "";
+  // Keyset paging, the full name (collection name/product name) of the last product of
+  // the previous page
+  public after: string = "";
 
   // todo: type request
   constructor(queryParams: any) {
@@ -44,6 +47,9 @@ export class ProductQuery {
     if ("productName" in queryParams) {
       this.productName = queryParams.productName;
     }
+    if ("after" in queryParams) {
+      this.after = queryParams.after;
+    }
 
     if ("collections" in queryParams) {
       this.collections.push.apply(this.collections, queryParams.collections)
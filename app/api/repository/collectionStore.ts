@@ -48,6 +48,27 @@ export class CollectionStore {
     return dbQuery;
   }
 
+  // Inserts a collection, resolves with the new collection id
+  public storeCollection(collection: ICollection): Promise<string> {
+    let qb = Database.instance.queryBuilder;
+
+    let query = qb("collection")
+      .returning("id")
+      .insert({
+        name: collection.name,
+        metadata: collection.metadata,
+        products_schema: collection.productsSchema === undefined ? null : collection.productsSchema,
+        footprint: collection.footprint ?
+          qb.raw("ST_SetSRID(ST_GeomFromGeoJSON(?), 4326)", [JSON.stringify(collection.footprint)]) :
+          null
+      });
+
+    return query.then((r) => {
+      let row = (r as any[])[0];
+      return typeof row === "object" ? row.id : row;
+    });
+  }
+
   public getCollections(query: CollectionQuery): Promise<ICollection[]> {
     let qb = Database.instance.queryBuilder;
 
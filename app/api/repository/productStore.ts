@@ -4,6 +4,23 @@ import { Database } from  "./database"
 import { IProduct } from "../definitions/product/product";
 import { ICollection } from '../definitions/collection/collection';
 
+// Postgres error code for a unique constraint violation
+const UNIQUE_VIOLATION = "23505";
+
+export interface IDuplicateProduct {
+  productName: string;
+  collectionName: string;
+}
+
+export class DuplicateProductError extends Error {
+  public readonly duplicates: IDuplicateProduct[];
+
+  constructor(duplicates: IDuplicateProduct[]) {
+    super("product names already exist in their collections");
+    this.duplicates = duplicates;
+  }
+}
+
 export class ProductStore {
 
   public getProductCount(query: query.ProductQuery): Promise<any> {
@@ -42,7 +59,7 @@ export class ProductStore {
         'properties',
         'data',
         {footprint: qb.raw('ST_AsGeoJSON(footprint)') })
-      .orderBy('full_name')
+      .modify(qb => ProductStore.orderAndPage(qb, query))
       .limit(query.limit)
       .offset(query.offset)
       .select();
@@ -50,6 +67,24 @@ export class ProductStore {
     return dbQuery;
   }
 
+  // Products are returned in full_name order. With an after cursor each page starts
+  // straight after the previous one rather than skipping offset rows, within a single
+  // collection full_name order is name order, so the page can be read from the
+  // (collection_id, name) unique index
+  private static orderAndPage(qb: knex.Knex.QueryBuilder, query: query.ProductQuery) {
+    let collectionPrefix = query.collections.length == 1 ? `${query.collections[0]}/` : "";
+
+    if (query.after === "") {
+      qb.orderBy('full_name');
+    } else if (collectionPrefix !== "" && query.after.startsWith(collectionPrefix)) {
+      qb.where("name", ">", query.after.substring(collectionPrefix.length))
+        .orderBy('name');
+    } else {
+      qb.where("full_name", ">", query.after)
+        .orderBy('full_name');
+    }
+  }
+
   private static getBaseQuery(query: query.ProductQuery): knex.Knex.QueryBuilder<IProduct, any> {
     let qb = Database.instance.queryBuilder;
 
@@ -118,14 +153,7 @@ export class ProductStore {
     } else {
       let query = qb("product")
         .returning("id")
-        .insert({
-          collection_id: collection.id,
-          metadata: JSON.stringify(product.metadata),
-          properties: JSON.stringify(product.properties),
-          data: JSON.stringify(product.data),
-          footprint: qb.raw("ST_SetSRID(ST_GeomFromGeoJSON(?), 4326)", JSON.stringify(product.footprint)),
-          name: product.name
-        })
+        .insert(ProductStore.getProductRow(qb, collection.id, product))
 
       return query.then((r) => {
         return (r as number[])[0];
@@ -133,5 +161,86 @@ export class ProductStore {
     }
   }
 
+  // Inserts a batch of products in a single transaction, either every product is stored
+  // or none are. Resolves with the new ids in the same order as the products, rejects with
+  // a DuplicateProductError naming the clashing products if any name is already taken.
+  public async storeProducts(products: IProduct[]): Promise<number[]> {
+    let qb = Database.instance.queryBuilder;
+
+    try {
+      return await qb.transaction(async (trx) => {
+        let collectionNames = Array.from(new Set(products.map(p => p.collectionName)));
+        let collections = await trx<ICollection>("collection")
+          .whereIn("name", collectionNames)
+          .select("id", "name");
+
+        let collectionIds = new Map<string, string>();
+        collections.forEach(c => collectionIds.set(c.name, c.id));
+
+        let rows = products.map(product => {
+          let collectionId = collectionIds.get(product.collectionName);
+
+          if (collectionId === undefined) {
+            throw new Error(`error retriving collection ${product.collectionName}`);
+          }
+
+          return ProductStore.getProductRow(trx, collectionId, product);
+        });
+
+        // Postgres does not promise RETURNING rows in VALUES order, so match them back
+        // to the products on (collection_id, name)
+        let inserted = await trx("product")
+          .returning(["id", "collection_id", "name"])
+          .insert(rows);
+
+        let ids = new Map<string, number>();
+        (inserted as any[]).forEach(r => ids.set(`${r.collection_id}/${r.name}`, r.id));
+
+        return rows.map(row => ids.get(`${row.collection_id}/${row.name}`) as number);
+      });
+    } catch (error) {
+      if (error.code === UNIQUE_VIOLATION) {
+        throw new DuplicateProductError(await this.getDuplicateProducts(products));
+      }
+      throw error;
+    }
+  }
+
+  // Finds the products in a batch whose names are already taken, either in the database
+  // or by an earlier product in the same batch
+  private async getDuplicateProducts(products: IProduct[]): Promise<IDuplicateProduct[]> {
+    let qb = Database.instance.queryBuilder;
+
+    let existing = await qb("product_view")
+      .whereIn(["collection_name", "name"], products.map(p => [p.collectionName, p.name]))
+      .select({collectionName: "collection_name"}, {productName: "name"});
+
+    let taken = new Set<string>(existing.map(e => `${e.collectionName}/${e.productName}`));
+    let duplicates: IDuplicateProduct[] = [];
+
+    products.forEach(product => {
+      let key = `${product.collectionName}/${product.name}`;
+
+      if (taken.has(key)) {
+        duplicates.push({productName: product.name, collectionName: product.collectionName});
+      } else {
+        taken.add(key);
+      }
+    });
+
+    return duplicates;
+  }
+
+  private static getProductRow(qb: knex.Knex, collectionId: string, product: IProduct) {
+    return {
+      collection_id: collectionId,
+      metadata: JSON.stringify(product.metadata),
+      properties: JSON.stringify(product.properties),
+      data: JSON.stringify(product.data),
+      footprint: qb.raw("ST_SetSRID(ST_GeomFromGeoJSON(?), 4326)", JSON.stringify(product.footprint)),
+      name: product.name
+    };
+  }
+
 }
 
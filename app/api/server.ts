@@ -1,5 +1,6 @@
 import * as bodyParser from "body-parser";
 import * as express from "express";
+import * as Collection from "./definitions/collection/collection";
 import * as Product from "./definitions/product/product";
 
 import { Logger } from "./logging/logger";
@@ -10,7 +11,8 @@ import { CollectionRequestValidator } from "./validation/request/collectionReque
 import { ProductRequestValidator } from "./validation/request/productRequestValidator";
 import { CollectionStore } from "./repository/collectionStore";
 import { CollectionQuery } from "./query/collectionQuery";
-import { ProductStore } from "./repository/productStore";
+import { DuplicateProductError, ProductStore } from "./repository/productStore";
+import { ICachedResponse, ResponseCache } from "./cache/responseCache";
 import * as Footprint from "./definitions/components/footprint";
 
 let app = express();
@@ -18,18 +20,20 @@ let env = getEnvironmentSettings();
 let productStore = new ProductStore();
 let collectionStore = new CollectionStore();
 let productRequestValidator = new ProductRequestValidator(collectionStore);
+let responseCache = new ResponseCache(env.responseCacheMb * 1024 * 1024, env.responseCacheTtl);
 let log = Logger.GetLog();
 
 process.on("unhandledRejection", (r) => log.warn(r));
 
-// parse json body requests
-app.use(bodyParser.json());
+// parse json body requests, batched ingestion requests can be large
+app.use(bodyParser.json({ limit: env.jsonBodyLimit }));
 app.use('/docs', express.static('./built/docs'))
 
 // enable CORS for all requests
 app.use((req, res, next) => {
   res.header("Access-Control-Allow-Origin", "*")
-  res.header("Access-Control-Allow-Headers", "Origin, X-Requested-With, Content-Type, Accept")
+  res.header("Access-Control-Allow-Headers", "Origin, X-Requested-With, Content-Type, Accept, If-None-Match")
+  res.header("Access-Control-Expose-Headers", "ETag")
   next()
 })
 
@@ -53,6 +57,13 @@ app.get('/alive', async (req, res) => {
 
 app.get(`/search/collection/*?`, async (req, res, next) => {
   let query = new CollectionQuery({collection: req.params[0]});
+  let key = ResponseCache.collectionQueryKey(query);
+  let cached = responseCache.get(key);
+
+  if (cached !== undefined) {
+    sendCached(req, res, cached);
+    return;
+  }
 
   let errors = CollectionRequestValidator.validate(query);
 
@@ -66,6 +77,7 @@ app.get(`/search/collection/*?`, async (req, res, next) => {
   } else {
 
     try {
+      let epoch = responseCache.begin();
       let collections = await collectionStore.getCollections(query);
 
       collections.forEach(c => {
@@ -74,10 +86,10 @@ app.get(`/search/collection/*?`, async (req, res, next) => {
         c.footprint = JSON.parse(c.footprint)
       });
 
-      res.json({
+      sendCached(req, res, responseCache.set(key, JSON.stringify({
         query: query,
         result: collections
-      });
+      }), null, epoch));
     } catch (error) {
       log.error(error);
 
@@ -92,6 +104,13 @@ app.get(`/search/collection/*?`, async (req, res, next) => {
 
 app.post(`/search/product/count`, async (req, res) => {
   let query = new ProductQuery(req.body);
+  let key = ResponseCache.productQueryKey(req.path, query);
+  let cached = responseCache.get(key);
+
+  if (cached !== undefined) {
+    sendCached(req, res, cached);
+    return;
+  }
 
   try {
     await productRequestValidator.validate(query)
@@ -106,12 +125,13 @@ app.post(`/search/product/count`, async (req, res) => {
   }
 
   try {
+    let epoch = responseCache.begin();
     let productCount = await productStore.getProductCount(query);
 
-    res.json({
+    sendCached(req, res, responseCache.set(key, JSON.stringify({
       query: query,
       result: productCount
-    })
+    }), query.collections, epoch));
 
   } catch (error) {
     log.error(error);
@@ -127,6 +147,13 @@ app.post(`/search/product/count`, async (req, res) => {
 
 app.post(`/search/product/countByCollection`, async (req, res) => {
   let query = new ProductQuery(req.body);
+  let key = ResponseCache.productQueryKey(req.path, query);
+  let cached = responseCache.get(key);
+
+  if (cached !== undefined) {
+    sendCached(req, res, cached);
+    return;
+  }
 
   try {
     await productRequestValidator.validate(query)
@@ -141,12 +168,13 @@ app.post(`/search/product/countByCollection`, async (req, res) => {
   }
 
   try {
+    let epoch = responseCache.begin();
     let countByCollection = await productStore.getProductCountByCollection(query)
 
-    res.json({
+    sendCached(req, res, responseCache.set(key, JSON.stringify({
       query: query,
       result: countByCollection
-    });
+    }), query.collections, epoch));
   } catch (error) {
     log.error(error);
 
@@ -161,6 +189,13 @@ app.post(`/search/product/countByCollection`, async (req, res) => {
 
 app.post(`/search/product`, async (req, res) => {
   let query = new ProductQuery(req.body);
+  let key = ResponseCache.productQueryKey(req.path, query);
+  let cached = responseCache.get(key);
+
+  if (cached !== undefined) {
+    sendCached(req, res, cached);
+    return;
+  }
 
   try {
     await productRequestValidator.validate(query)
@@ -175,6 +210,7 @@ app.post(`/search/product`, async (req, res) => {
   }
 
   try {
+    let epoch = responseCache.begin();
     let products = await productStore.getProducts(query)
 
     products.forEach(p => {
@@ -183,10 +219,10 @@ app.post(`/search/product`, async (req, res) => {
       p.footprint = JSON.parse(p.footprint);
     });
 
-    res.json({
+    sendCached(req, res, responseCache.set(key, JSON.stringify({
       query: query,
       result: products
-    });
+    }), query.collections, epoch));
   } catch (error) {
     log.error(error);
 
@@ -270,6 +306,7 @@ app.post(`/add/product`, async (req, res) => {
   try {
 
     var productId = await productStore.storeProduct(product);
+    responseCache.invalidateProducts([product.collectionName]);
     res.status(200);
     res.json({
       productName: product.name,
@@ -289,6 +326,211 @@ app.post(`/add/product`, async (req, res) => {
   }
 });
 
+app.post(`/validate/products`, async (req, res) => {
+  if (process.env.READ_ONLY) {
+    res.statusCode = 403
+    res.json({
+      error: "403 - Unauthorized"
+    })
+    return;
+  }
+
+  let products: Product.IProduct[] = req.body;
+  let batchErrors = validateBatch(products);
+
+  if (batchErrors.length > 0) {
+    res.status(400);
+    res.json({
+      valid: false,
+      errors: batchErrors
+    });
+    return;
+  }
+
+  let productValidtor = new ProductValidator(collectionStore);
+  let results = await productValidtor.validateAll(products.map(fixProductCRS));
+  let valid = results.every(r => r.valid);
+
+  res.status(valid ? 200 : 400);
+  res.json({
+    valid: valid,
+    results: results
+  });
+});
+
+// store a batch of products in a single transaction, nothing is stored if any product
+// in the batch is invalid
+app.post(`/add/products`, async (req, res) => {
+  if (process.env.READ_ONLY) {
+    res.statusCode = 403
+    res.json({
+      error: "403 - Unauthorized"
+    })
+    return;
+  }
+
+  let products: Product.IProduct[] = req.body;
+  let batchErrors = validateBatch(products);
+
+  if (batchErrors.length > 0) {
+    res.status(400);
+    res.json({
+      valid: false,
+      errors: batchErrors
+    });
+    return;
+  }
+
+  products = products.map(fixProductCRS);
+
+  let productValidtor = new ProductValidator(collectionStore);
+  let results = await productValidtor.validateAll(products);
+
+  if (!results.every(r => r.valid)) {
+    res.status(400);
+    res.json({
+      valid: false,
+      results: results
+    });
+    return;
+  }
+
+  try {
+    let productIds = await productStore.storeProducts(products);
+    responseCache.invalidateProducts(products.map(p => p.collectionName));
+
+    res.status(200);
+    res.json({
+      results: products.map((product, i) => {
+        return {
+          productName: product.name,
+          collectionName: product.collectionName,
+          productId: productIds[i]
+        };
+      })
+    });
+  } catch (error) {
+    if (error instanceof DuplicateProductError) {
+      res.status(409);
+      res.json({
+        errors: "Products already exist, unable to save products",
+        duplicates: error.duplicates
+      });
+      return;
+    }
+
+    log.error(error);
+
+    res.status(500);
+    res.json({
+      errors: "A database error occured, unable to save products"
+    });
+  }
+});
+
+// add a collection, products are added to it with /add/product or /add/products
+app.post(`/add/collection`, async (req, res) => {
+  if (process.env.READ_ONLY) {
+    res.statusCode = 403
+    res.json({
+      error: "403 - Unauthorized"
+    })
+    return;
+  }
+
+  let collection: Collection.ICollection = req.body;
+
+  if (collection === null || typeof collection !== "object" || Array.isArray(collection)) {
+    res.status(400);
+    res.json({
+      valid: false,
+      validationErrors: ["body | should be an object"]
+    });
+    return;
+  }
+
+  try {
+    await Collection.validate(collection);
+  } catch (errors) {
+    res.status(400);
+    res.json({
+      collectionName: collection.name,
+      valid: false,
+      validationErrors: errors
+    });
+    return;
+  }
+
+  try {
+    let existing = await collectionStore.getCollection(collection.name);
+
+    if (existing !== undefined) {
+      res.status(409);
+      res.json({
+        collectionName: collection.name,
+        collectionId: existing.id,
+        errors: "Collection already exists, unable to save collection"
+      });
+      return;
+    }
+
+    let collectionId = await collectionStore.storeCollection(collection);
+    responseCache.invalidateCollections();
+    res.status(200);
+    res.json({
+      collectionName: collection.name,
+      collectionId: collectionId
+    });
+  } catch (error) {
+    log.error(error);
+
+    res.status(500);
+    res.json({
+      collectionName: collection.name,
+      errors: "A database error occured, unable to save collection"
+    });
+  }
+});
+
+// Sends a search response with its entity tag, or a bodyless 304 when the client already
+// holds it. The search POSTs are read only queries, so they revalidate like a GET.
+function sendCached(req: express.Request, res: express.Response, response: ICachedResponse) {
+  res.set("ETag", response.etag);
+  res.set("Cache-Control", "no-cache");
+
+  if (ResponseCache.matches(req.get("If-None-Match"), response.etag)) {
+    res.status(304).end();
+  } else {
+    res.type("json").send(response.body);
+  }
+}
+
+function validateBatch(products: any): string[] {
+  if (!Array.isArray(products)) {
+    return ["body | should be an array of products"];
+  } else if (products.length == 0) {
+    return ["body | should NOT have fewer than 1 items"];
+  } else if (products.length > env.maxBatchSize) {
+    return [`body | should NOT have more than ${env.maxBatchSize} items`];
+  }
+
+  let errors: string[] = [];
+  products.forEach((product, i) => {
+    if (product === null || typeof product !== "object" || Array.isArray(product)) {
+      errors.push(`body[${i}] | should be an object`);
+    }
+  });
+
+  return errors;
+}
+
+function fixProductCRS(product: Product.IProduct): Product.IProduct {
+  if ("footprint" in product) {
+    product.footprint = Footprint.fixCRS(product.footprint);
+  }
+  return product;
+}
+
 if (!module.parent) {
   app.listen(env.port, () => {
     log.info(`app.server is listening on: http://localhost:${env.port}`);
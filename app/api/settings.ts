@@ -6,6 +6,11 @@ export function getEnvironmentSettings() {
   return {
     dev: false,
     port: 8081,  // elastic beanstalk: the default nginx configuration forwards traffic to an upstream server named nodejs at 127.0.0.1:8081
-    dir: 'built'
+    dir: 'built',
+    jsonBodyLimit: process.env.JSON_BODY_LIMIT || '20mb',  // batched ingestion posts many products per request
+    maxBatchSize: Number(process.env.MAX_BATCH_SIZE || 1000),
+    // search response cache, 0 for either turns it off
+    responseCacheMb: Number(process.env.RESPONSE_CACHE_MB || 64),
+    responseCacheTtl: Number(process.env.RESPONSE_CACHE_TTL || 60)  // seconds
   }
 }
@@ -16,6 +16,21 @@ import { Fixtures } from "../test/fixtures";
 
 //todo - Valdate that the collection has a properly defined schema if the product has properties.
 
+export interface IProductValidationResult {
+  productName: string;
+  collectionName: string;
+  valid: boolean;
+  validationErrors?: string[];
+}
+
+// Shared state for validating a batch of products, the product schema is compiled once
+// and each distinct collection is looked up and has its properties schema compiled once
+interface IBatchValidationContext {
+  productSchemaValidator: any;
+  getCollection(name: string): Promise<Collection.ICollection | undefined>;
+  getPropertiesValidator(collection: Collection.ICollection): any;
+}
+
 export class ProductValidator {
   collectionStore: CollectionStore;
 
@@ -23,9 +38,8 @@ export class ProductValidator {
     this.collectionStore = collectionStore;
   }
 
-  public async validate(product: Product.IProduct): Promise<string[]> {
-    let asyncValidator = ValidatorFactory.getValidator(Product.Schema.$schema);
-    let productSchemaValidator = asyncValidator.compile(Product.Schema);
+  public async validate(product: Product.IProduct, context?: IBatchValidationContext): Promise<string[]> {
+    let productSchemaValidator = context ? context.productSchemaValidator : ProductValidator.compileProductSchema();
 
     let errors: string[] = new Array<string>();
 
@@ -47,7 +61,9 @@ export class ProductValidator {
       errors = Metadata.nonSchemaValidation(product.metadata, errors);
       // Validate product properties according to its collection properties_schema
 
-      let collection = await this.collectionStore.getCollection(product.collectionName)
+      let collection = context
+        ? await context.getCollection(product.collectionName)
+        : await this.collectionStore.getCollection(product.collectionName)
 
       if (collection === undefined || collection === null) {
         errors.push(`collectionName | ${product.collectionName} does not exist in the database`);
@@ -56,7 +72,7 @@ export class ProductValidator {
         return;
       }
 
-      await this.validateProductProperties(collection as Collection.ICollection, product, errors)
+      await this.validateProductProperties(collection as Collection.ICollection, product, errors, context)
             .catch((e) => errors = e);
 
       if (errors.length == 0) {
@@ -67,15 +83,69 @@ export class ProductValidator {
     });
   }
 
-  private async validateProductProperties(collection: Collection.ICollection, product: Product.IProduct, errors: string[]): Promise<string[] | void> {
+  // Validates a batch of products, resolving with one result per product in input order
+  // rather than rejecting on the first invalid product
+  public async validateAll(products: Product.IProduct[]): Promise<IProductValidationResult[]> {
+    let collections = new Map<string, Promise<Collection.ICollection | undefined>>();
+    let propertiesValidators = new Map<string, any>();
+
+    let context: IBatchValidationContext = {
+      productSchemaValidator: ProductValidator.compileProductSchema(),
+      getCollection: (name) => {
+        if (!collections.has(name)) {
+          collections.set(name, this.collectionStore.getCollection(name));
+        }
+        return collections.get(name) as Promise<Collection.ICollection | undefined>;
+      },
+      getPropertiesValidator: (collection) => {
+        if (!propertiesValidators.has(collection.name)) {
+          propertiesValidators.set(collection.name, ProductValidator.compilePropertiesSchema(collection));
+        }
+        return propertiesValidators.get(collection.name);
+      }
+    };
+
+    return Promise.all(products.map(async (product) => {
+      let result: IProductValidationResult = {
+        productName: product.name,
+        collectionName: product.collectionName,
+        valid: true
+      };
+
+      try {
+        await this.validate(product, context);
+      } catch (errors) {
+        result.valid = false;
+        result.validationErrors = errors;
+      }
+
+      return result;
+    }));
+  }
+
+  private static compileProductSchema(): any {
+    let asyncValidator = ValidatorFactory.getValidator(Product.Schema.$schema);
+    return asyncValidator.compile(Product.Schema);
+  }
+
+  private static compilePropertiesSchema(collection: Collection.ICollection): any {
+    let asyncValidator = ValidatorFactory.getValidator(collection.productsSchema.$schema);
+    return asyncValidator.compile(collection.productsSchema);
+  }
+
+  private async validateProductProperties(collection: Collection.ICollection, product: Product.IProduct, errors: string[], context?: IBatchValidationContext): Promise<string[] | void> {
     if (collection.productsSchema === "") {
       return Promise.resolve(errors);
     }
 
-    let asyncValidator = ValidatorFactory.getValidator(collection.productsSchema.$schema);
-    let propertiesSchemaValidator = asyncValidator.compile(collection.productsSchema);
+    let propertiesSchemaValidator = context
+      ? context.getPropertiesValidator(collection)
+      : ProductValidator.compilePropertiesSchema(collection);
 
     let propValidator = propertiesSchemaValidator(product.properties);
+    // A compiled validator may be shared by a batch, so read synchronous errors before
+    // anything else can run it again
+    let syncErrors = propertiesSchemaValidator.errors;
 
     //propValidator.then is sometimes a boolean not a function.?? MD discovery
     if (typeof propValidator.then === 'function') {
@@ -87,11 +157,8 @@ export class ProductValidator {
           reject(errors);
         });
       });
-    } else {
-      let valid = await propertiesSchemaValidator(product.properties);
-      if (propertiesSchemaValidator.errors) {
-        return Promise.reject(errors.concat(ValidationHelper.reduceErrors(propertiesSchemaValidator.errors, "properties")));
-      }
+    } else if (syncErrors) {
+      return Promise.reject(errors.concat(ValidationHelper.reduceErrors(syncErrors, "properties")));
     }
     return Promise.resolve(errors);
   }
@@ -181,6 +248,49 @@ describe("Product validator", () => {
   });
 });
 
+describe("Product batch validator", () => {
+
+  let mockRepo = Fixtures.GetMockCollectionStore();
+  let validator = new ProductValidator(mockRepo.object);
+
+  it("should validate a batch of valid products", () => {
+    let p1 = Fixtures.GetTestProduct();
+    let p2 = Fixtures.GetTestProduct();
+    p2.name = "second-product";
+
+    return chai.expect(validator.validateAll([p1, p2]))
+      .to.be.fulfilled
+      .and.eventually.satisfy((results) => results.length == 2 && results.every((r) => r.valid));
+  });
+
+  it("should look up each collection only once per batch", () => {
+    let mr = Fixtures.GetMockCollectionStore();
+    let v2 = new ProductValidator(mr.object);
+    let p1 = Fixtures.GetTestProduct();
+    let p2 = Fixtures.GetTestProduct();
+    p2.name = "second-product";
+
+    return v2.validateAll([p1, p2]).then(() => {
+      mr.verify((x) => x.getCollection(TypeMoq.It.isAnyString()), TypeMoq.Times.once());
+    });
+  });
+
+  it("should return per product errors for a batch containing an invalid product", () => {
+    let p1 = Fixtures.GetTestProduct();
+    let p2 = Fixtures.GetTestProduct();
+    p2.name = "";
+
+    return validator.validateAll([p1, p2]).then((results) => {
+      chai.expect(results).to.have.lengthOf(2);
+      chai.expect(results[0].valid).to.equal(true);
+      chai.expect(results[0].validationErrors).to.equal(undefined);
+      chai.expect(results[1].valid).to.equal(false);
+      chai.expect(results[1].validationErrors)
+        .to.include('name | should match pattern "^([A-Za-z0-9-_.])+$"');
+    });
+  });
+});
+
 describe("Metadata validator", () => {
 
   let mockRepo = Fixtures.GetMockCollectionStore();
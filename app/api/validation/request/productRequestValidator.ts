@@ -64,6 +64,10 @@ export class ProductRequestValidator extends RequestValidator {
         this.validateSpatialOp(query.spatialop, errors);
       }
 
+      if (query.after !== "") {
+        this.validateAfter(query, errors);
+      }
+
       if (errors.length > 0) {
         reject(errors);
         return;
@@ -102,6 +106,14 @@ export class ProductRequestValidator extends RequestValidator {
     });
   }
 
+  private validateAfter(query: ProductQuery, errors: string[]) {
+    if (typeof query.after !== "string") {
+      errors.push("after | should be the full name (collection name/product name) of a product");
+    } else if (query.offset > 0) {
+      errors.push("after | cannot be combined with an offset");
+    }
+  }
+
   private validateTermStructure(terms: ITerm[], errors: string[]): boolean {
     let valid = true
 
@@ -346,6 +358,33 @@ describe("Product Request Validator", () => {
       .and.contain("spatialop | should be one of 'within', 'intersects', 'overlaps'");
   });
 
+  it("should validate an after cursor", () => {
+    q["after"] = "test/valid/path/1/2/345aa/product-1";
+
+    return chai.expect(validator.validate(new ProductQuery(q)))
+      .to.be.fulfilled
+      .and.eventually.be.an("array").that.is.empty;
+  });
+
+  it("should not validate an after cursor combined with an offset", () => {
+    q["after"] = "test/valid/path/1/2/345aa/product-1";
+    q["offset"] = 50;
+
+    return chai.expect(validator.validate(new ProductQuery(q)))
+      .to.be.rejected
+      .and.eventually.have.lengthOf(1)
+      .and.contain("after | cannot be combined with an offset");
+  });
+
+  it("should not validate an after cursor that is not a string", () => {
+    q["after"] = 12;
+
+    return chai.expect(validator.validate(new ProductQuery(q)))
+      .to.be.rejected
+      .and.eventually.have.lengthOf(1)
+      .and.contain("after | should be the full name (collection name/product name) of a product");
+  });
+
   it("should validate a valid WKT footprint", () => {
     let footprint =
       "POLYGON((-2.2043681144714355 53.692260240428965," +
@@ -0,0 +1,193 @@
+#pylint: disable=C0111
+"""
+Serialisation benchmarks for the shared JSON codec (common/codec.py)
+
+Times every installed codec backend, and the str based standard library json the tools
+used before the codec, on the documents the tools actually move: a product array as
+written by the LiDAR json generator and read by the importer, and the same products as
+JSON Lines, one document per line. LiDAR products of the same grid tile
+share the tile's footprint, which is also encoded with the footprint as a pre encoded
+fragment (which the codec only keeps for footprints large enough to be worth splicing,
+--points makes the synthetic footprints larger). Each measurement is the best of --repeat
+runs, reported as MB/s of JSON and products per second.
+
+    python codec_benchmarks.py --products 10000 -o codec.json
+    python codec_benchmarks.py --points 100
+    python codec_benchmarks.py -i ../import/scotland-gov-lidar/products.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common'))
+import codec # pylint: disable=C0413
+
+from run_benchmarks import synthetic_product, git_revision # pylint: disable=C0413
+
+# The LiDAR products of a tile (DSM, DTM, LAZ, ...) share its footprint
+PRODUCTS_PER_TILE = 4
+
+
+def stdlib_str_backend():
+    # The tools' serialisation before the codec, str documents with the default separators
+    return ('json-str',
+            lambda obj: json.dumps(obj).encode('utf-8'),
+            lambda data: json.loads(data.decode('utf-8')))
+
+
+def backends():
+    # (name, encode, decode) for the baseline and every installed backend
+    found = [stdlib_str_backend()]
+    for backend in codec.BACKENDS.values():
+        found.append((backend.name, backend.dumps, backend.loads))
+    return found
+
+
+def best_time(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def share_footprints(products):
+    # Every PRODUCTS_PER_TILE products hold the same footprint object, as the generator's do
+    shared = []
+    for (i, product) in enumerate(products):
+        tile = products[i - i % PRODUCTS_PER_TILE]
+        shared.append(dict(product, footprint=tile['footprint']))
+    return shared
+
+
+def with_fragments(products, fragment):
+    # As the generator writes them, each footprint encoded once
+    fragments = {}
+    encoded = []
+    for product in products:
+        geometry = product['footprint']
+        if id(geometry) not in fragments:
+            fragments[id(geometry)] = fragment(geometry)
+        encoded.append(dict(product, footprint=fragments[id(geometry)]))
+    return encoded
+
+
+def measure(name, encode, decode, products, repeat):
+    """
+    Time one backend, returning a result dict for each measurement
+
+    Keyword arguments:
+    name            -- The backend name
+    encode          -- Encodes a value to bytes
+    decode          -- Decodes bytes
+    products        -- The products to encode and decode
+    repeat          -- Runs of each measurement, the fastest is kept
+    """
+    document = encode(products)
+    lines = [encode(p) for p in products]
+    shared = share_footprints(products)
+
+    timings = [
+        ('decode-array', len(document), lambda: decode(document)),
+        ('encode-array', len(document), lambda: encode(products)),
+        ('decode-jsonl', sum(len(l) + 1 for l in lines), lambda: [decode(l) for l in lines]),
+        ('encode-jsonl', sum(len(l) + 1 for l in lines), lambda: b'\n'.join(encode(p) for p in products)),
+        ('encode-shared-footprints', len(encode(shared)), lambda: encode(shared))
+    ]
+
+    backend = codec.BACKENDS.get(name)
+    if backend is not None:
+        # Fragments only exist for the codec's own backends, built inside the timing as the
+        # generator builds them while writing
+        timings.append(('encode-footprint-fragments', len(encode(shared)),
+                        lambda: encode(with_fragments(shared, backend.fragment))))
+
+    results = []
+    for (operation, size, function) in timings:
+        seconds = best_time(function, repeat)
+        results.append({
+            'backend': name,
+            'operation': operation,
+            'products': len(products),
+            'bytes': size,
+            'seconds': seconds,
+            'mb_per_second': size / seconds / 1000000.0,
+            'products_per_second': len(products) / seconds
+        })
+    return results
+
+
+def densify(geometry, points):
+    # The square with extra points along its edges, as a coastline clipped tile would have
+    ring = geometry['coordinates'][0]
+    per_edge = max(1, (points - 1) // 4)
+    dense = []
+    for (start, end) in zip(ring, ring[1:]):
+        for step in range(per_edge):
+            t = step / float(per_edge)
+            dense.append([start[0] + (end[0] - start[0]) * t, start[1] + (end[1] - start[1]) * t])
+    return {'type': 'Polygon', 'coordinates': [dense + dense[:1]]}
+
+
+def load_products(args):
+    if args.input:
+        with open(args.input, 'rb') as products_file:
+            return json.loads(products_file.read())
+    rng = random.Random(args.seed)
+    products = [synthetic_product(i, rng) for i in range(args.products)]
+    if args.points > 5:
+        for product in products:
+            product['footprint'] = densify(product['footprint'], args.points)
+    return products
+
+
+def print_results(results):
+    print('%-10s %-28s %10s %10s %14s' % ('backend', 'operation', 'seconds', 'MB/s', 'products/s'))
+    for r in sorted(results, key=lambda r: (r['operation'], -r['mb_per_second'])):
+        print('%-10s %-28s %10.4f %10.1f %14.0f' % (
+            r['backend'], r['operation'], r['seconds'], r['mb_per_second'],
+            r['products_per_second']))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Benchmarks the JSON codec backends on \
+                                     catalog products')
+    PARSER.add_argument('-n', '--products', type=int, required=False, default=10000,
+                        help='Number of synthetic products (default 10000)')
+    PARSER.add_argument('-i', '--input', type=str, required=False,
+                        help='JSON array of products to use instead, i.e. a generator output')
+    PARSER.add_argument('-p', '--points', type=int, required=False, default=5,
+                        help='Points in each synthetic footprint (default 5, a grid square)')
+    PARSER.add_argument('-r', '--repeat', type=int, required=False, default=5,
+                        help='Runs of each measurement, the fastest is kept (default 5)')
+    PARSER.add_argument('--seed', type=int, required=False, default=0,
+                        help='Seed for the synthetic products (default 0)')
+    PARSER.add_argument('-o', '--output', type=str, required=False,
+                        help='Write the results as JSON to this path')
+    ARGS = PARSER.parse_args()
+
+    PRODUCTS = load_products(ARGS)
+    RESULTS = []
+    for (NAME, ENCODE, DECODE) in backends():
+        RESULTS.extend(measure(NAME, ENCODE, DECODE, PRODUCTS, ARGS.repeat))
+
+    print_results(RESULTS)
+
+    if ARGS.output:
+        (COMMIT, DIRTY) = git_revision()
+        with open(ARGS.output, 'w') as output:
+            json.dump({
+                'commit': COMMIT,
+                'dirty': DIRTY,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'default_backend': codec.BACKEND.name,
+                'options': {k: v for (k, v) in vars(ARGS).items() if k != 'output'},
+                'results': RESULTS
+            }, output, indent=2)
@@ -0,0 +1,370 @@
+#pylint: disable=C0111
+"""
+A local stand in for the catalog API, for benchmarking the importer and exporter without a
+live catalog
+
+Serves the routes the python tools use (/validate/product, /add/product, /add/products,
+/add/collection,
+/search/product with offset and after paging, /search/product/count,
+/search/product/countByCollection and /search/collection) from memory, with a configurable
+latency, error rate and maximum page size, and optionally a limited capacity standing in for
+the API's database connection pool. Products are only checked for a name and an
+existing collection, the mock measures the tools, not validation. A search footprint (WKT,
+intersects only) is applied when shapely is installed. Search responses carry an ETag and
+are answered with a 304 when the request's If-None-Match holds it, as the API's are.
+
+Run on its own with
+
+    python mock_catalog.py --port 8081 --latency 5 --products products.json
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    from shapely import wkt
+    from shapely.geometry import shape
+except ImportError:
+    wkt = None
+
+OPERATIONS = {
+    '=': lambda a, b: a == b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b,
+    '=<': lambda a, b: a <= b,
+    '<=': lambda a, b: a <= b
+}
+
+
+class MockCatalog:
+    """
+    In memory catalog state shared by the request handlers
+
+    Keyword arguments:
+    collections     -- A list of collection JSON blobs, each with at least a name and an
+                       optional productsSchema
+    latency         -- Mean added latency per request in seconds
+    jitter          -- Uniform +/- jitter on the latency in seconds
+    error_rate      -- Fraction of requests answered with a 503
+    max_page_size   -- Largest page /search/product returns, whatever the limit asked for
+    seed            -- Seed for the latency and error draws, so runs are repeatable
+    capacity        -- Requests served at once, the rest queue for their turn as they would
+                       for the API's database connection pool, unlimited if not given
+    """
+
+    def __init__(self, collections, latency=0.0, jitter=0.0, error_rate=0.0,
+                 max_page_size=1000, seed=0, capacity=None):
+        self.collections = dict((c['name'], c) for c in collections)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_page_size = max_page_size
+        self.products = {}
+        self.requests = 0
+        # Matching products (and their full names) per collections / terms, so paging
+        # through a large result set does not filter every product for every page
+        self._matches = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self.pool = threading.BoundedSemaphore(capacity) if capacity else None
+
+    def load(self, products):
+        """
+        Store products as if they had been added, for export benchmarks
+
+        Keyword arguments:
+        products        -- An iterable of product JSON blobs
+        """
+        for product in products:
+            self._store(product)
+
+    def _store(self, product):
+        with self._lock:
+            key = (product['collectionName'], product['name'])
+            if key in self.products:
+                return None
+            stored = dict(product, id='%08d-0000-4000-8000-000000000000' % len(self.products))
+            self.products[key] = stored
+            self._matches = {}
+            return stored['id']
+
+    def draw(self):
+        """
+        The delay for the next request and whether it should fail
+        """
+        with self._lock:
+            self.requests += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            return (delay, self._random.random() < self.error_rate)
+
+    def _matching(self, query):
+        key = json.dumps([sorted(query.get('collections') or []), query.get('terms') or [],
+                          query.get('footprint') or ''], sort_keys=True)
+        with self._lock:
+            if key not in self._matches:
+                collections = set(query.get('collections') or [])
+                products = [self.products[k] for k in sorted(self.products) if k[0] in collections]
+                for term in query.get('terms') or []:
+                    test = OPERATIONS[term['operation']]
+                    products = [p for p in products
+                                if term['property'] in (p.get('properties') or {})
+                                and test(p['properties'][term['property']], term['value'])]
+                if query.get('footprint') and wkt is not None:
+                    area = wkt.loads(query['footprint'])
+                    products = [p for p in products if shape(p['footprint']).intersects(area)]
+                self._matches[key] = (products, [p['collectionName'] + '/' + p['name']
+                                                 for p in products])
+            return self._matches[key]
+
+    def matching(self, query):
+        return self._matching(query)[0]
+
+    def search(self, query):
+        (products, names) = self._matching(query)
+        start = bisect.bisect_right(names, query['after']) if query.get('after') else 0
+        start = start + int(query.get('offset') or 0)
+        limit = min(int(query.get('limit') or 50), self.max_page_size)
+        return products[start:start + limit]
+
+    def check(self, product):
+        errors = []
+        if not isinstance(product, dict) or not product.get('name'):
+            errors.append('name | is required')
+        if not isinstance(product, dict) or product.get('collectionName') not in self.collections:
+            errors.append('collectionName | does not exist in the database')
+        return errors
+
+    def add_collection(self, collection):
+        """
+        Store a collection, returning (collection id, created)
+
+        Keyword arguments:
+        collection      -- A collection JSON blob with at least a name
+        """
+        with self._lock:
+            if collection['name'] not in self.collections:
+                self.collections[collection['name']] = dict(
+                    collection, id='%08d-0000-4000-8000-00000000c011' % len(self.collections))
+                return (self.collections[collection['name']]['id'], True)
+            return (self.collections[collection['name']].get('id'), False)
+
+    def add(self, product):
+        product_id = self._store(product)
+        if product_id is None:
+            raise KeyError(product['name'])
+        return product_id
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    Routes requests to the server's MockCatalog
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out as separate writes, with Nagle each keep alive response
+    # would wait on the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_search(self, body):
+        data = json.dumps(body).encode('utf-8')
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        if etag in [t.strip() for t in (self.headers.get('If-None-Match') or '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _delayed(self):
+        (delay, fail) = self.server.catalog.draw()
+        if delay and self.server.catalog.pool:
+            with self.server.catalog.pool:
+                time.sleep(delay)
+        elif delay:
+            time.sleep(delay)
+        if fail:
+            self._send(503, {'errors': 'Injected error'})
+        return not fail
+
+    def do_GET(self):
+        if not self._delayed():
+            return
+        catalog = self.server.catalog
+        if self.path.startswith('/search/collection/'):
+            name = self.path[len('/search/collection/'):]
+            self._send_search({'result': [c for (n, c) in sorted(catalog.collections.items())
+                                          if n.startswith(name)]})
+        else:
+            self._send(404, {'errors': 'Not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'null')
+
+        if not self._delayed():
+            return
+
+        handler = {
+            '/validate/product': self._validate_product,
+            '/add/product': self._add_product,
+            '/add/products': self._add_products,
+            '/add/collection': self._add_collection,
+            '/search/product': self._search_product,
+            '/search/product/count': self._count,
+            '/search/product/countByCollection': self._count_by_collection
+        }.get(self.path)
+
+        if handler is None:
+            self._send(404, {'errors': 'Not found'})
+        else:
+            handler(body)
+
+    def _validate_product(self, product):
+        errors = self.server.catalog.check(product)
+        self._send(400 if errors else 200, {
+            'productName': product.get('name'),
+            'collectionName': product.get('collectionName'),
+            'valid': not errors,
+            'validationErrors': errors
+        })
+
+    def _add_product(self, product):
+        catalog = self.server.catalog
+        errors = catalog.check(product)
+        if errors:
+            self._send(400, {'productName': product.get('name'), 'valid': False,
+                             'validationErrors': errors})
+            return
+        try:
+            self._send(200, {'productName': product['name'],
+                             'collectionName': product['collectionName'],
+                             'productId': catalog.add(product)})
+        except KeyError:
+            self._send(500, {'errors': 'A database error occured, unable to save product'})
+
+    def _add_products(self, products):
+        catalog = self.server.catalog
+        results = [{'productName': p.get('name'), 'collectionName': p.get('collectionName'),
+                    'valid': not catalog.check(p), 'validationErrors': catalog.check(p)}
+                   for p in products]
+        if not all(r['valid'] for r in results):
+            self._send(400, {'valid': False, 'results': results})
+            return
+
+        duplicates = [{'productName': p['name'], 'collectionName': p['collectionName']}
+                      for p in products
+                      if (p['collectionName'], p['name']) in catalog.products]
+        if duplicates:
+            self._send(409, {'errors': 'Products already exist, unable to save products',
+                             'duplicates': duplicates})
+            return
+
+        self._send(200, {'results': [{'productName': p['name'],
+                                      'collectionName': p['collectionName'],
+                                      'productId': catalog.add(p)} for p in products]})
+
+    def _add_collection(self, collection):
+        if not isinstance(collection, dict) or not collection.get('name') \
+                or not isinstance(collection.get('metadata'), dict):
+            self._send(400, {'valid': False,
+                             'validationErrors': ['name and metadata | are required']})
+            return
+        (collection_id, created) = self.server.catalog.add_collection(collection)
+        self._send(200 if created else 409, {'collectionName': collection['name'],
+                                             'collectionId': collection_id})
+
+    def _search_product(self, query):
+        self._send_search({'query': query, 'result': self.server.catalog.search(query)})
+
+    def _count(self, query):
+        self._send_search({'query': query,
+                           'result': [{'products': str(len(self.server.catalog.matching(query)))}]})
+
+    def _count_by_collection(self, query):
+        counts = {}
+        for product in self.server.catalog.matching(query):
+            counts[product['collectionName']] = counts.get(product['collectionName'], 0) + 1
+        self._send_search({'query': query, 'result': [
+            {'collectionName': name, 'products': str(count)}
+            for (name, count) in sorted(counts.items())]})
+
+
+def start_server(catalog, host='127.0.0.1', port=0):
+    """
+    Serve a MockCatalog on a background thread, returning the server, its base URL is
+    http://host:server.server_port. Stop it with server.shutdown().
+
+    Keyword arguments:
+    catalog         -- The MockCatalog to serve
+    host            -- The interface to listen on
+    port            -- The port to listen on, 0 for any free port
+    """
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.catalog = catalog
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Serves a local stand in for the catalog API')
+    PARSER.add_argument('--host', type=str, required=False, default='127.0.0.1',
+                        help='Interface to listen on (default 127.0.0.1)')
+    PARSER.add_argument('--port', type=int, required=False, default=8081,
+                        help='Port to listen on (default 8081)')
+    PARSER.add_argument('--collection', type=str, action='append', required=False,
+                        help='Name of a collection to serve, repeatable (default the \
+                        collections of the --products)')
+    PARSER.add_argument('--products', type=str, required=False,
+                        help='JSON array of products to serve as already added')
+    PARSER.add_argument('--latency', type=float, required=False, default=0.0,
+                        help='Mean added latency per request in milliseconds (default 0)')
+    PARSER.add_argument('--jitter', type=float, required=False, default=0.0,
+                        help='Uniform +/- jitter on the latency in milliseconds (default 0)')
+    PARSER.add_argument('--error-rate', type=float, required=False, default=0.0,
+                        help='Fraction of requests answered with a 503 (default 0)')
+    PARSER.add_argument('--max-page-size', type=int, required=False, default=1000,
+                        help='Largest page /search/product returns (default 1000)')
+    PARSER.add_argument('--capacity', type=int, required=False,
+                        help='Requests served at once, the rest queue (default unlimited)')
+    ARGS = PARSER.parse_args()
+
+    PRODUCTS = []
+    if ARGS.products:
+        with open(ARGS.products) as products_file:
+            PRODUCTS = json.load(products_file)
+
+    NAMES = set(ARGS.collection or []) | set(p['collectionName'] for p in PRODUCTS)
+    CATALOG = MockCatalog([{'name': name, 'productsSchema': None} for name in sorted(NAMES)],
+                          ARGS.latency / 1000.0, ARGS.jitter / 1000.0, ARGS.error_rate,
+                          ARGS.max_page_size, capacity=ARGS.capacity)
+    CATALOG.load(PRODUCTS)
+
+    SERVER = ThreadingHTTPServer((ARGS.host, ARGS.port), MockHandler)
+    SERVER.catalog = CATALOG
+    print('Serving %d products from %d collections on http://%s:%d'
+          % (len(CATALOG.products), len(CATALOG.collections), ARGS.host, ARGS.port))
+    SERVER.serve_forever()
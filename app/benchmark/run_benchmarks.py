@@ -0,0 +1,325 @@
+#pylint: disable=C0111
+"""
+Dry run throughput benchmarks for the importer and exporter against the local mock catalog
+
+For each size a synthetic product file in the import format (import/format/
+import_format.json) is generated, then each importer and exporter mode is run as its own
+process against a fresh mock_catalog, recording the wall time, products per second, peak
+RSS and the tool's own per stage timings (its --metrics summary). The results are written
+as JSON together with the git commit, python version and benchmark options, so runs of the
+same options can be compared across commits with --compare. --codec runs the tools with
+one of the shared JSON codec's backends (common/codec.py) rather than the fastest installed.
+
+    python run_benchmarks.py --sizes 1000 10000 --latency 2 -o results.json
+    python run_benchmarks.py --sizes 1000 10000 --latency 2 --compare results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_catalog import MockCatalog, start_server
+
+APP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(APP, 'common'))
+import codec # pylint: disable=C0413
+
+IMPORTER = os.path.join(APP, 'import', 'importer.py')
+EXPORTER = os.path.join(APP, 'export', 'export.py')
+
+COLLECTION = 'benchmark/synthetic'
+PRODUCTS_SCHEMA = {
+    'type': 'object',
+    'required': ['osgb_grid_ref', 'capturedDate'],
+    'properties': {
+        'osgb_grid_ref': {'type': 'string', 'pattern': '^[A-Z]{2}[0-9]{2}$'},
+        'swath_id': {'type': 'integer'},
+        'external_ref': {'type': 'string'},
+        'capturedDate': {'type': 'string', 'fullDateValidation': True}
+    }
+}
+
+# (name, tool, extra arguments), the importer modes add the synthetic file to a fresh mock,
+# the exporter modes page it back out of a mock holding it
+MODES = [
+    ('import', 'importer', ['-w', '8']),
+    ('import-server-validation', 'importer', ['-w', '8', '--server-validation']),
+    ('import-batch', 'importer', ['-w', '4', '-b', '100']),
+    ('import-geometry-workers', 'importer', ['-w', '8', '-g', '2']),
+    ('import-adaptive', 'importer', ['-w', '32', '--adaptive-concurrency']),
+    ('export-offset', 'exporter', ['--offset-paging']),
+    ('export-keyset', 'exporter', []),
+    ('export-sharded', 'exporter', ['-s', '4', '--shard-property', 'capturedDate',
+                                    '--shard-size', '2000']),
+    # Timed on the second of two runs, with every page kept from the first
+    ('export-revalidate', 'exporter', ['--response-cache'])
+]
+
+START_DATE = datetime.date(2016, 1, 1)
+
+
+def synthetic_product(i, rng):
+    # One product in the import format, a ~1km square tile over Scotland
+    (x, y) = (-6.0 + (i % 400) * 0.015, 55.0 + (i // 400 % 300) * 0.009)
+    date = START_DATE + datetime.timedelta(days=rng.randint(0, 3 * 365))
+    return {
+        'name': 'SYNTH_%07d' % i,
+        'collectionName': COLLECTION,
+        'metadata': {
+            'title': 'Synthetic product %d' % i,
+            'abstract': 'A synthetic product for benchmarking',
+            'topicCategory': 'elevation',
+            'keyword': ['benchmark', 'synthetic'],
+            'datasetReferenceDate': date.isoformat(),
+            'accessLimitations': 'no limitations',
+            'useConstraints': 'Open Government Licence Version 3',
+            'lineage': 'Generated',
+            'responsibleOrganisation': 'JNCC',
+            'metadataPointOfContact': 'data@jncc.gov.uk',
+            'metadataDate': date.isoformat(),
+            'metadataLanguage': 'English',
+            'spatialReferenceSystem': 'EPSG:27700',
+            'resourceType': 'Dataset'
+        },
+        'properties': {
+            'osgb_grid_ref': 'NY%02d' % (i % 100),
+            'swath_id': i,
+            'external_ref': 'ID-%d' % i,
+            'capturedDate': date.isoformat()
+        },
+        'data': {
+            'product': {
+                'title': 'Synthetic product %d' % i,
+                's3': {
+                    'key': 'synthetic/SYNTH_%07d.tif' % i,
+                    'bucket': 'benchmark-bucket',
+                    'region': 'eu-west-1',
+                    'size': 10000000 + i,
+                    'type': 'image/tiff'
+                }
+            }
+        },
+        'footprint': {
+            'type': 'Polygon',
+            'coordinates': [[[x, y], [x + 0.015, y], [x + 0.015, y + 0.009],
+                             [x, y + 0.009], [x, y]]]
+        }
+    }
+
+
+def write_products(path, size, seed):
+    rng = random.Random(seed)
+    with open(path, 'w') as products_file:
+        json.dump([synthetic_product(i, rng) for i in range(size)], products_file)
+
+
+def new_catalog(args, products=None):
+    catalog = MockCatalog([{'name': COLLECTION, 'productsSchema': PRODUCTS_SCHEMA}],
+                          args.latency / 1000.0, args.jitter / 1000.0, args.error_rate,
+                          args.max_page_size, args.seed, args.capacity)
+    if products:
+        catalog.load(products)
+    return catalog
+
+
+def run_tool(command):
+    """
+    Run a tool to completion, returning (exit code, wall seconds, peak RSS in MB, stderr),
+    the RSS is the child's own from wait4 rather than the benchmark's
+
+    Keyword arguments:
+    command         -- The command line to run
+    """
+    with tempfile.TemporaryFile() as errors:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=errors)
+        (_, status, usage) = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        errors.seek(0)
+        stderr = errors.read().decode('utf-8', 'replace')
+
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    peak = usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+    return (process.returncode, wall, peak, stderr)
+
+
+def command_for(tool, extra, base_url, products_path, work_dir, metrics_path, args):
+    if tool == 'importer':
+        journal = os.path.join(work_dir, 'journal-%f' % time.time())
+        return [sys.executable, IMPORTER, '-i', products_path, '-a', base_url, '-p',
+                '-j', journal, '--metrics', metrics_path] + extra
+
+    query_path = os.path.join(work_dir, 'query.json')
+    with open(query_path, 'w') as query_file:
+        json.dump({'collections': [COLLECTION], 'terms': [
+            {'property': 'capturedDate', 'operation': '>=', 'value': START_DATE.isoformat()},
+            {'property': 'capturedDate', 'operation': '<', 'value': '2020-01-01'}
+        ]}, query_file)
+    if '--response-cache' in extra:
+        extra = extra + [os.path.join(work_dir, 'response-cache')]
+    return [sys.executable, EXPORTER, '-c', base_url, '-q', query_path,
+            '-o', os.path.join(work_dir, 'export.jsonl'), '--no-download',
+            '--page-size', str(args.page_size), '--metrics', metrics_path] + extra
+
+
+def benchmark(mode, size, products_path, work_dir, args):
+    (name, tool, extra) = mode
+    products = None
+    if tool == 'exporter':
+        with open(products_path) as products_file:
+            products = json.load(products_file)
+
+    server = start_server(new_catalog(args, products))
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+    metrics_path = os.path.join(work_dir, 'metrics.json')
+    if os.path.exists(metrics_path):
+        os.remove(metrics_path)
+
+    command = command_for(tool, extra, base_url, products_path, work_dir, metrics_path, args)
+
+    try:
+        if '--response-cache' in extra:
+            shutil.rmtree(os.path.join(work_dir, 'response-cache'), ignore_errors=True)
+            run_tool(command)
+            server.catalog.requests = 0
+        (code, wall, peak, errors) = run_tool(command)
+        requests = server.catalog.requests
+        stored = len(server.catalog.products)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    metrics = None
+    if os.path.exists(metrics_path):
+        with open(metrics_path) as metrics_file:
+            metrics = json.load(metrics_file)
+
+    result = {
+        'mode': name,
+        'size': size,
+        'exit_code': code,
+        'wall_seconds': wall,
+        'products_per_second': size / wall,
+        'peak_rss_mb': peak,
+        'requests': requests,
+        'metrics': metrics
+    }
+    if tool == 'importer':
+        result['products_stored'] = stored
+    if code != 0 and args.error_rate == 0:
+        print('%s at %d products exited with %d: %s' % (name, size, code, errors.strip()[-500:]),
+              file=sys.stderr)
+    return result
+
+
+def git_revision():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=APP,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=APP,
+                                stderr=subprocess.DEVNULL) != 0
+        return (commit, dirty)
+    except (OSError, subprocess.CalledProcessError):
+        return (None, None)
+
+
+def print_results(results, previous=None):
+    baseline = {}
+    if previous:
+        baseline = dict(((r['mode'], r['size']), r) for r in previous['results'])
+        print('Compared with %s%s' % (previous.get('commit'),
+                                      ' (dirty)' if previous.get('dirty') else ''))
+
+    print('%-26s %8s %10s %12s %10s %6s %10s' % ('mode', 'size', 'wall s', 'products/s',
+                                                 'peak MB', 'exit', 'change'))
+    for r in results:
+        change = ''
+        before = baseline.get((r['mode'], r['size']))
+        if before:
+            change = '%+.1f%%' % (100.0 * (r['products_per_second'] / before['products_per_second'] - 1))
+        print('%-26s %8d %10.2f %12.1f %10.1f %6d %10s' % (
+            r['mode'], r['size'], r['wall_seconds'], r['products_per_second'], r['peak_rss_mb'],
+            r['exit_code'], change))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Benchmarks importer and exporter throughput \
+                                     against a local mock catalog')
+    PARSER.add_argument('-s', '--sizes', type=int, nargs='+', required=False,
+                        default=[1000, 10000, 100000],
+                        help='Numbers of synthetic products to benchmark (default 1000 10000 100000)')
+    PARSER.add_argument('-m', '--modes', nargs='+', required=False,
+                        choices=[m[0] for m in MODES], default=[m[0] for m in MODES],
+                        help='Modes to benchmark (default all)')
+    PARSER.add_argument('--latency', type=float, required=False, default=2.0,
+                        help='Mean mock API latency per request in milliseconds (default 2)')
+    PARSER.add_argument('--jitter', type=float, required=False, default=0.0,
+                        help='Uniform +/- jitter on the latency in milliseconds (default 0)')
+    PARSER.add_argument('--error-rate', type=float, required=False, default=0.0,
+                        help='Fraction of mock API requests answered with a 503 (default 0)')
+    PARSER.add_argument('--max-page-size', type=int, required=False, default=1000,
+                        help='Largest page the mock search returns (default 1000)')
+    PARSER.add_argument('--capacity', type=int, required=False,
+                        help='Requests the mock serves at once, the rest queue as for the \
+                        API\'s database pool (default unlimited)')
+    PARSER.add_argument('--page-size', type=int, required=False, default=50,
+                        help='Page size the exporter asks for (default 50)')
+    PARSER.add_argument('--seed', type=int, required=False, default=0,
+                        help='Seed for the synthetic products and the mock (default 0)')
+    PARSER.add_argument('--codec', type=str, required=False, choices=list(codec.BACKENDS),
+                        help='JSON codec backend the tools use (default the fastest installed)')
+    PARSER.add_argument('-o', '--output', type=str, required=False,
+                        help='Write the results as JSON to this path')
+    PARSER.add_argument('--compare', type=str, required=False,
+                        help='Earlier results JSON to compare products/s against')
+    ARGS = PARSER.parse_args()
+
+    if ARGS.codec:
+        # Inherited by the tool processes
+        os.environ['CATALOG_JSON_CODEC'] = ARGS.codec
+    ARGS.codec = ARGS.codec or codec.BACKEND.name
+
+    (COMMIT, DIRTY) = git_revision()
+    RESULTS = []
+
+    with tempfile.TemporaryDirectory() as WORK_DIR:
+        for SIZE in ARGS.sizes:
+            PRODUCTS_PATH = os.path.join(WORK_DIR, 'products-%d.json' % SIZE)
+            write_products(PRODUCTS_PATH, SIZE, ARGS.seed)
+            for MODE in [m for m in MODES if m[0] in ARGS.modes]:
+                RESULTS.append(benchmark(MODE, SIZE, PRODUCTS_PATH, WORK_DIR, ARGS))
+                print('%s %d: %.1f products/s' % (MODE[0], SIZE, RESULTS[-1]['products_per_second']))
+
+    REPORT = {
+        'commit': COMMIT,
+        'dirty': DIRTY,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'options': {k: v for (k, v) in vars(ARGS).items() if k not in ('output', 'compare')},
+        'results': RESULTS
+    }
+
+    PREVIOUS = None
+    if ARGS.compare:
+        with open(ARGS.compare) as previous_file:
+            PREVIOUS = json.load(previous_file)
+        COMPARED = ('sizes', 'modes')
+        if ({k: v for (k, v) in PREVIOUS.get('options', {}).items() if k not in COMPARED} !=
+                {k: v for (k, v) in REPORT['options'].items() if k not in COMPARED}):
+            print('Warning: %s was run with different options' % ARGS.compare)
+
+    print('')
+    print_results(RESULTS, PREVIOUS)
+
+    if ARGS.output:
+        with open(ARGS.output, 'w') as output:
+            json.dump(REPORT, output, indent=2)
@@ -0,0 +1,168 @@
+#pylint: disable=C0111
+"""
+Shared JSON codec for the catalog python tools (importer, exporter and the LiDAR json
+generator)
+
+Uses the fastest backend that is installed, orjson, falling back to the standard library
+json. Documents are decoded straight from bytes (or str) and encoded straight to compact
+UTF-8 bytes, so request bodies, response bodies and output files are never copied through
+an intermediate str. `CATALOG_JSON_CODEC=json` forces the standard library backend.
+
+`fragment` encodes a value once for use in many documents, i.e. the geometry of a grid tile
+shared by every product of the tile. Splicing a fragment in has a fixed cost, so values that
+encode to less than the backend's `min_fragment_bytes` are returned as they are and encoded
+inline, which is faster for orjson and small geometries (see benchmark/codec_benchmarks.py).
+
+    data = codec.dumps({'name': 'a'})      # b'{"name":"a"}'
+    product = codec.loads(resp.content)
+"""
+import itertools
+import json
+import os
+import re
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Stands in for a fragment while a document is encoded, spliced out afterwards
+FRAGMENT_TOKEN = '__codec_fragment_%s_' % os.urandom(8).hex()
+FRAGMENT_PATTERN = re.compile(b'"%s([0-9]+)"' % FRAGMENT_TOKEN.encode('ascii'))
+
+
+class Fragment:
+    """
+    A value encoded ahead of time, encoded documents hold its bytes as they are
+
+    Keyword arguments:
+    data            -- The value's encoded bytes
+    """
+
+    _ids = itertools.count()
+
+    def __init__(self, data):
+        self.data = data
+        self.id = next(Fragment._ids)
+        self.token = '%s%d' % (FRAGMENT_TOKEN, self.id)
+
+
+class Backend:
+    """
+    An encoder / decoder pair
+
+    Keyword arguments:
+    name            -- The backend name
+    encode          -- Encodes a value to bytes, calling a default function for values it
+                       can not encode
+    decode          -- Decodes bytes or str
+    min_fragment_bytes -- Smallest encoded value worth keeping as a fragment
+    """
+
+    def __init__(self, name, encode, decode, min_fragment_bytes=0):
+        self.name = name
+        self._encode = encode
+        self.loads = decode
+        self.min_fragment_bytes = min_fragment_bytes
+        self._local = threading.local()
+
+    def _default(self, value):
+        if isinstance(value, Fragment):
+            self._local.fragments.append(value)
+            return value.token
+        raise TypeError('Object of type %s is not JSON serializable' % type(value).__name__)
+
+    def dumps(self, obj):
+        """
+        Encode a value as compact UTF-8 JSON bytes
+        """
+        self._local.fragments = []
+        data = self._encode(obj, self._default)
+        if self._local.fragments:
+            fragments = dict((f.id, f.data) for f in self._local.fragments)
+            data = FRAGMENT_PATTERN.sub(lambda match: fragments[int(match.group(1))], data)
+        return data
+
+    def fragment(self, obj):
+        """
+        Encode a value once for use in many documents, small values are returned as they are
+        """
+        data = self.dumps(obj)
+        return Fragment(data) if len(data) >= self.min_fragment_bytes else obj
+
+
+def _stdlib_decode(data):
+    # json.loads detects the encoding of bytes but does not take other buffers
+    if isinstance(data, (bytearray, memoryview)):
+        data = bytes(data)
+    return json.loads(data)
+
+
+def _stdlib_backend():
+    def encode(obj, default):
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False,
+                          default=default).encode('utf-8')
+    return Backend('json', encode, _stdlib_decode)
+
+
+def _orjson_backend():
+    # Encoding a 5 point grid square inline is faster than splicing it in, the crossover is
+    # around 50 points
+    return Backend('orjson', lambda obj, default: orjson.dumps(obj, default=default), orjson.loads,
+                   min_fragment_bytes=1024)
+
+
+# Every installed backend by name, fastest first
+BACKENDS = dict((backend.name, backend) for backend in (
+    ([_orjson_backend()] if orjson is not None else []) + [_stdlib_backend()]))
+
+BACKEND = BACKENDS.get(os.environ.get('CATALOG_JSON_CODEC'), next(iter(BACKENDS.values())))
+
+# Raised for invalid documents by every backend, orjson's error is a json.JSONDecodeError
+DecodeError = json.JSONDecodeError
+
+
+def loads(data):
+    """
+    Decode a JSON document
+
+    Keyword arguments:
+    data            -- The document as bytes, a bytes like buffer or str
+    """
+    return BACKEND.loads(data)
+
+
+def dumps(obj):
+    """
+    Encode a value as compact UTF-8 JSON bytes
+
+    Keyword arguments:
+    obj             -- The value, may hold fragments
+    """
+    return BACKEND.dumps(obj)
+
+
+def load(binary_file):
+    """
+    Decode the JSON document in a file opened in binary mode
+    """
+    return BACKEND.loads(binary_file.read())
+
+
+def dump(obj, binary_file):
+    """
+    Encode a value to a file opened in binary mode
+    """
+    binary_file.write(BACKEND.dumps(obj))
+
+
+def fragment(obj):
+    """
+    Encode a value once for use in many documents, i.e. a geometry shared by many products.
+    Values that are cheaper to encode inline are returned as they are.
+
+    Keyword arguments:
+    obj             -- The value
+    """
+    return BACKEND.fragment(obj)
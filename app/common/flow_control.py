@@ -0,0 +1,309 @@
+#pylint: disable=C0111
+"""
+Client side flow control for the catalog python tools (importer and exporter)
+
+The catalog API serves every request from a small database connection pool, past a point
+more concurrent requests only queue there, latency climbs and requests start failing with
+5xx responses. A FlowController sits in front of the catalog API requests of a session
+and combines
+
+- a token bucket rate limit, at most `rate` requests per second with bursts of `burst`
+- an AIMD (additive increase, multiplicative decrease) limit on the number of requests in
+  flight, as TCP congestion control does for packets. The limit starts at the minimum and
+  doubles every round trip (slow start) until the first congestion signal, then grows by
+  one request per round trip. A 429, a 5xx, a connection error or a smoothed latency more
+  than `tolerance` times the fastest latency of the last few minutes halves it, at most
+  once per round trip.
+
+so each tool settles near the highest throughput the API sustains rather than at a fixed
+worker count. A 429 is never processed by the server, so those are also retried after the
+Retry-After delay, pausing every other controlled request for as long.
+"""
+import collections
+import threading
+import time
+
+from contextlib import contextmanager
+
+DEFAULT_LATENCY_TOLERANCE = 2.0
+DEFAULT_429_RETRIES = 3
+DEFAULT_RETRY_AFTER = 1.0
+
+# Weight of each new latency in the smoothed latency
+SMOOTHING = 0.2
+# The baseline latency is the fastest of the last BASELINE_BUCKETS buckets of
+# BASELINE_BUCKET_SECONDS, so a server that gets slower for good is relearnt
+BASELINE_BUCKET_SECONDS = 10.0
+BASELINE_BUCKETS = 30
+# Fraction of the limit kept on a congestion signal
+BACKOFF = 0.5
+
+
+class TokenBucket:
+    """
+    Token bucket rate limit, safe to share between worker threads. Callers reserve a token
+    each and wait for it in turn, so a backlog of callers drains at the rate in order.
+
+    Keyword arguments:
+    rate            -- Tokens added per second
+    burst           -- Most tokens the bucket holds, the largest burst allowed after an
+                       idle spell (default one second of tokens)
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(burst or rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token, returning how many seconds to wait before using it
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def acquire(self):
+        """
+        Take a token, waiting for it if the bucket is empty, returning the seconds waited
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class AdaptiveLimit:
+    """
+    AIMD limit on the number of requests in flight, safe to share between worker threads
+
+    Keyword arguments:
+    maximum         -- Highest the limit can grow to, i.e. the number of workers
+    minimum         -- Lowest the limit can fall to
+    tolerance       -- A smoothed latency this many times the baseline is congestion
+    """
+
+    def __init__(self, maximum, minimum=1, tolerance=DEFAULT_LATENCY_TOLERANCE):
+        self.maximum = max(1, maximum)
+        self.minimum = min(max(1, minimum), self.maximum)
+        self.tolerance = tolerance
+        self.limit = float(self.minimum)
+        self.in_flight = 0
+        self.slow_start = True
+        self.smoothed = None
+        self.decreases = 0
+        self._baselines = collections.deque()
+        self._last_decrease = None
+        self._condition = threading.Condition()
+
+    @property
+    def baseline(self):
+        return min(fastest for (_, fastest) in self._baselines) if self._baselines else None
+
+    def acquire(self):
+        """
+        Wait until a request can be sent within the limit
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def _observe(self, latency, now):
+        bucket = now - now % BASELINE_BUCKET_SECONDS
+        if self._baselines and self._baselines[-1][0] == bucket:
+            self._baselines[-1] = (bucket, min(self._baselines[-1][1], latency))
+        else:
+            self._baselines.append((bucket, latency))
+            while len(self._baselines) > BASELINE_BUCKETS:
+                self._baselines.popleft()
+
+        if self.smoothed is None:
+            self.smoothed = latency
+        else:
+            self.smoothed += SMOOTHING * (latency - self.smoothed)
+
+        return self.smoothed > self.tolerance * self.baseline
+
+    def release(self, latency, congested=False):
+        """
+        Finish a request, adjusting the limit by how it went
+
+        Keyword arguments:
+        latency         -- How long the request took in seconds
+        congested       -- The request failed in a way that signals an overloaded server,
+                           its latency is not used
+        """
+        now = time.monotonic()
+        with self._condition:
+            binding = self.in_flight * 2 >= self.limit
+            self.in_flight -= 1
+
+            if not congested:
+                congested = self._observe(latency, now)
+
+            if congested:
+                # The requests already in flight when the limit was cut say nothing about
+                # the new limit, so cut at most once per round trip
+                if (self._last_decrease is None
+                        or now - self._last_decrease > (self.smoothed or latency)):
+                    self.limit = max(self.minimum, self.limit * BACKOFF)
+                    self.slow_start = False
+                    self._last_decrease = now
+                    self.decreases += 1
+            elif binding:
+                # Only grow a limit that is in use, with fewer workers than the limit the
+                # latency says nothing about a higher one
+                self.limit = min(self.maximum,
+                                 self.limit + (1.0 if self.slow_start else 1.0 / self.limit))
+
+            self._condition.notify_all()
+
+
+class FlowController:
+    """
+    Rate limit and adaptive concurrency limit for the requests a session sends to one API,
+    safe to share between worker threads
+
+    Keyword arguments:
+    url_prefix      -- Only requests to URLs starting with this are controlled, i.e. the
+                       catalog API base URL and not the S3 downloads
+    rate            -- Most requests per second, unlimited if not given
+    burst           -- Largest burst of requests the rate allows after an idle spell
+    max_concurrency -- Adapt the number of requests in flight between min_concurrency and
+                       this, not adapted if not given
+    min_concurrency -- Lowest number of requests in flight to back off to
+    tolerance       -- A smoothed latency this many times the baseline is congestion
+    retries         -- Times to retry a request answered with a 429
+    metrics         -- An instrumentation.Instrumentation to record waits and signals with
+    """
+
+    def __init__(self, url_prefix, rate=None, burst=None, max_concurrency=None,
+                 min_concurrency=1, tolerance=DEFAULT_LATENCY_TOLERANCE,
+                 retries=DEFAULT_429_RETRIES, metrics=None):
+        self.url_prefix = url_prefix
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.limit = (AdaptiveLimit(max_concurrency, min_concurrency, tolerance)
+                      if max_concurrency else None)
+        self.retries = retries
+        self.metrics = metrics
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def controls(self, url):
+        return url.startswith(self.url_prefix)
+
+    def pause(self, seconds):
+        """
+        Hold every controlled request for a while, i.e. for a 429's Retry-After
+
+        Keyword arguments:
+        seconds         -- How long to hold requests for
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _wait(self):
+        with self._lock:
+            paused = self._paused_until - time.monotonic()
+        if paused > 0:
+            time.sleep(paused)
+        if self.bucket:
+            self.bucket.acquire()
+        if self.limit:
+            self.limit.acquire()
+
+    @contextmanager
+    def request(self):
+        """
+        Wait for a controlled request's turn, then time the body of the with block as the
+        request. The block sets `status` on the yielded dict to the response's status code,
+        leaving it None when the request failed with a connection error.
+        """
+        start = time.perf_counter()
+        self._wait()
+        sent = time.perf_counter()
+        if self.metrics:
+            self.metrics.record('flow_wait', sent - start, start)
+
+        outcome = {'status': None}
+        try:
+            yield outcome
+        finally:
+            status = outcome['status']
+            congested = status is None or status == 429 or status >= 500
+            if congested and self.metrics:
+                self.metrics.count('flow_congestion_signals')
+            if self.limit:
+                self.limit.release(time.perf_counter() - sent, congested)
+
+    def describe(self):
+        if self.limit is None:
+            return 'Rate limited to %g requests per second' % self.bucket.rate
+        return ('Adaptive concurrency limit settled at %.1f requests in flight after %d '
+                'back offs (smoothed latency %s ms, baseline %s ms)' % (
+                    self.limit.limit, self.limit.decreases,
+                    _millis(self.limit.smoothed), _millis(self.limit.baseline)))
+
+
+def _millis(seconds):
+    return '-' if seconds is None else '%.1f' % (seconds * 1000)
+
+
+def retry_after(resp):
+    """
+    The delay a 429 response asks for in seconds, HTTP dates are not supported
+    """
+    try:
+        return max(0.0, float(resp.headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+def add_arguments(parser):
+    """
+    Add the common flow control options to an argparse parser
+
+    Keyword arguments:
+    parser          -- An argparse.ArgumentParser
+    """
+    parser.add_argument('--rate-limit', type=float, required=False,
+                        help='Most catalog API requests per second (default unlimited)')
+    parser.add_argument('--burst', type=int, required=False,
+                        help='Largest burst of requests --rate-limit allows (default one \
+                        second of requests)')
+    parser.add_argument('--adaptive-concurrency', action='store_true', required=False,
+                        help='Adapt the number of catalog API requests in flight (up to the \
+                        number of threads querying it) to the latency and 5xx / 429 \
+                        responses seen')
+    parser.add_argument('--min-concurrency', type=int, required=False, default=1,
+                        help='Fewest requests in flight --adaptive-concurrency backs off to \
+                        (default 1)')
+    parser.add_argument('--latency-tolerance', type=float, required=False,
+                        default=DEFAULT_LATENCY_TOLERANCE,
+                        help='With --adaptive-concurrency, back off when the smoothed latency \
+                        is this many times the fastest recent latency (default %g)'
+                        % DEFAULT_LATENCY_TOLERANCE)
+
+
+def from_args(args, url_prefix, max_concurrency, metrics=None):
+    """
+    Create a controller from parsed argparse options added by add_arguments, or None when
+    neither a rate limit nor adaptive concurrency is asked for
+
+    Keyword arguments:
+    args            -- Parsed argparse namespace
+    url_prefix      -- The base URL of the catalog API
+    max_concurrency -- The most requests the tool can have in flight, i.e. its workers
+    metrics         -- An instrumentation.Instrumentation to record waits and signals with
+    """
+    if not args.rate_limit and not args.adaptive_concurrency:
+        return None
+    return FlowController(url_prefix, args.rate_limit, args.burst,
+                          max_concurrency if args.adaptive_concurrency else None,
+                          args.min_concurrency, args.latency_tolerance, metrics=metrics)
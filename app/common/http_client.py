@@ -0,0 +1,184 @@
+#pylint: disable=C0111
+"""
+Shared HTTP client for the catalog python tools (importer and exporter)
+
+All requests go through a single pooled `requests.Session` so that connections to the
+catalog API and S3 are kept alive and reused rather than re-established per call, with
+retries / backoff on connection errors and 5xx responses and a default timeout.
+
+POSTs are only retried when the connection could not be established, unless the session
+is created with retry_post (for tools that only POST read only search queries). A POST to
+/add/product that timed out or failed with a 5xx may still have been stored, retrying it
+would report a stored product as failed.
+
+A session can also be given a flow_control.FlowController, which rate limits and adapts the
+concurrency of the requests it sends to the catalog API.
+
+JSON request bodies (the `json` argument) are encoded with the shared codec rather than by
+requests, and `response_json` decodes JSON responses with it.
+"""
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import codec
+import flow_control
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_TIMEOUT = 60
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class TimeoutSession(requests.Session):
+    """
+    A requests Session that applies a default timeout to every request that does not
+    supply its own
+
+    Keyword arguments:
+    timeout         -- Default timeout in seconds, either a number or a (connect, read) tuple
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if kwargs.get('json') is not None:
+            kwargs['data'] = codec.dumps(kwargs.pop('json'))
+            kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                     **{'Content-Type': 'application/json'})
+        return super().request(method, url, **kwargs)
+
+
+class ControlledSession(TimeoutSession):
+    """
+    A TimeoutSession whose requests to the controller's API wait their turn with the
+    controller and report back how they went. Responses are seen after the session's own
+    retries, so a request that was retried counts once, with its backoff in its latency.
+    429 responses are retried here after their Retry-After delay.
+
+    Keyword arguments:
+    controller      -- A flow_control.FlowController
+    timeout         -- Default timeout in seconds, either a number or a (connect, read) tuple
+    """
+
+    def __init__(self, controller, timeout=DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.controller = controller
+
+    def request(self, method, url, **kwargs):
+        if not self.controller.controls(url):
+            return super().request(method, url, **kwargs)
+
+        attempt = 0
+        while True:
+            with self.controller.request() as outcome:
+                resp = super().request(method, url, **kwargs)
+                outcome['status'] = resp.status_code
+
+            if resp.status_code != 429 or attempt >= self.controller.retries:
+                return resp
+
+            attempt += 1
+            self.controller.pause(flow_control.retry_after(resp))
+            resp.close()
+
+
+def _retry(retries, backoff_factor, retry_post):
+    options = {
+        'total': retries,
+        'connect': retries,
+        'read': retries,
+        'status': retries,
+        'backoff_factor': backoff_factor,
+        'status_forcelist': RETRY_STATUSES,
+        'raise_on_status': False
+    }
+
+    # urllib3 retries connection errors for any method, but read errors and retryable
+    # statuses only for the idempotent methods in its default list, which excludes POST
+    try:
+        methods = Retry.DEFAULT_ALLOWED_METHODS
+        if retry_post:
+            options['allowed_methods'] = methods | frozenset(['POST'])
+    except AttributeError:
+        # urllib3 < 1.26
+        methods = Retry.DEFAULT_METHOD_WHITELIST
+        if retry_post:
+            options['method_whitelist'] = methods | frozenset(['POST'])
+
+    return Retry(**options)
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES,
+                   backoff_factor=DEFAULT_BACKOFF_FACTOR, timeout=DEFAULT_TIMEOUT,
+                   retry_post=False, controller=None):
+    """
+    Create a pooled, retrying session, the session is safe to share between worker threads
+    as long as pool_size is at least the number of workers
+
+    Keyword arguments:
+    pool_size       -- Maximum number of kept alive connections per host
+    retries         -- Number of retries on connection errors and 5xx responses
+    backoff_factor  -- Exponential backoff factor between retries, in seconds
+    timeout         -- Default request timeout in seconds
+    retry_post      -- Also retry POSTs on read errors and 5xx responses, only safe when
+                       every POST sent through the session is read only
+    controller      -- A flow_control.FlowController for the catalog API requests
+    """
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=_retry(retries, backoff_factor, retry_post),
+                          pool_block=True)
+
+    session = ControlledSession(controller, timeout) if controller else TimeoutSession(timeout)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def response_json(resp):
+    """
+    Decode a JSON response body with the shared codec, straight from its bytes
+
+    Keyword arguments:
+    resp            -- A requests Response
+    """
+    return codec.loads(resp.content)
+
+
+def add_arguments(parser):
+    """
+    Add the common HTTP client options to an argparse parser
+
+    Keyword arguments:
+    parser          -- An argparse.ArgumentParser
+    """
+    parser.add_argument('--pool-size', type=int, required=False, default=DEFAULT_POOL_SIZE,
+                        help='Number of kept alive HTTP connections per host (default %d)'
+                        % DEFAULT_POOL_SIZE)
+    parser.add_argument('--retries', type=int, required=False, default=DEFAULT_RETRIES,
+                        help='Number of retries on connection errors and 5xx responses, \
+                        POSTs that add data are only retried on connection errors \
+                        (default %d)' % DEFAULT_RETRIES)
+    parser.add_argument('--timeout', type=float, required=False, default=DEFAULT_TIMEOUT,
+                        help='HTTP request timeout in seconds (default %d)' % DEFAULT_TIMEOUT)
+
+
+def session_from_args(args, min_pool_size=0, retry_post=False, controller=None):
+    """
+    Create a session from parsed argparse options added by add_arguments
+
+    Keyword arguments:
+    args            -- Parsed argparse namespace
+    min_pool_size   -- Lower bound for the pool size, i.e. the number of worker threads
+    retry_post      -- Also retry POSTs on read errors and 5xx responses
+    controller      -- A flow_control.FlowController for the catalog API requests
+    """
+    return create_session(pool_size=max(args.pool_size, min_pool_size),
+                          retries=args.retries, timeout=args.timeout,
+                          retry_post=retry_post, controller=controller)
@@ -0,0 +1,254 @@
+#pylint: disable=C0111
+"""
+Shared instrumentation for the catalog python tools (importer, exporter and the LiDAR json
+generator)
+
+Stages of a run (footprint normalisation, validation, page fetches, downloads, S3 listing,
+...) are timed with `Instrumentation.stage` or `Instrumentation.timed_iter`, and totals such
+as bytes downloaded are kept with `Instrumentation.count`. At the end of a run a JSON
+summary is written with, for each stage, the number of calls, the total and mean time, the
+p50 / p95 / p99 / max latencies and the rate per second of the run's wall clock time, and
+for each counter its total and rate. Every timing is kept for the percentiles, which costs
+a few floats per product.
+
+Optionally every timed event is also written to a JSON Lines trace as it happens, and the
+whole run (every thread that is started while profiling) is profiled with cProfile.
+"""
+import cProfile
+import math
+import pstats
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+import codec
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(ordered, pct):
+    """
+    Nearest rank percentile of a sorted, non empty list
+
+    Keyword arguments:
+    ordered         -- A sorted list of numbers
+    pct             -- The percentile, 0 to 100
+    """
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+class Profiler:
+    """
+    cProfile across threads, the starting thread is profiled directly and every thread
+    started while the profiler runs gets a profile of its own on its first call, the
+    profiles are merged when the stats are dumped
+
+    Keyword arguments:
+    path            -- Path to dump the merged pstats to, readable with `python -m pstats`
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._main = cProfile.Profile()
+
+    def _start_thread(self, frame, event, arg):
+        profile = cProfile.Profile()
+        try:
+            # Replaces this hook for the calling thread
+            profile.enable()
+        except ValueError:
+            # Interpreters where a single profile already covers every thread
+            threading.setprofile(None)
+            sys.setprofile(None)
+            return
+        with self._lock:
+            self._profiles.append(profile)
+
+    def start(self):
+        threading.setprofile(self._start_thread)
+        self._main.enable()
+
+    def stop(self):
+        self._main.disable()
+        threading.setprofile(None)
+
+        with self._lock:
+            stats = pstats.Stats(self._main)
+            for profile in self._profiles:
+                profile.disable()
+                stats.add(profile)
+        stats.dump_stats(self.path)
+
+
+class Instrumentation:
+    """
+    Per run stage timers and counters, safe to share between worker threads
+
+    Keyword arguments:
+    summary_path    -- Path to write the JSON summary to on close, stderr if not given
+    trace_path      -- Path to write every timed event to as JSON Lines, no trace if not given
+    profile_path    -- Path to dump cProfile stats for the run to, not profiled if not given
+    """
+
+    def __init__(self, summary_path=None, trace_path=None, profile_path=None):
+        self.summary_path = summary_path
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._counters = {}
+        self._trace = open(trace_path, 'wb') if trace_path else None
+        self._profiler = Profiler(profile_path) if profile_path else None
+        self.started = time.time()
+        self._start = time.perf_counter()
+
+        if self._profiler:
+            self._profiler.start()
+
+    def record(self, name, seconds, start=None):
+        """
+        Record one timed call of a stage
+
+        Keyword arguments:
+        name            -- The stage name
+        seconds         -- How long the call took
+        start           -- perf_counter() at the start of the call, for the trace
+        """
+        with self._lock:
+            self._timings.setdefault(name, []).append(seconds)
+            if self._trace:
+                self._trace.write(codec.dumps({
+                    'stage': name,
+                    'thread': threading.current_thread().name,
+                    'start': round((start if start is not None else time.perf_counter() - seconds)
+                                   - self._start, 6),
+                    'seconds': round(seconds, 6)
+                }) + b'\n')
+
+    def count(self, name, value=1):
+        """
+        Add to a counter
+
+        Keyword arguments:
+        name            -- The counter name
+        value           -- The amount to add
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the body of a with block as one call of a stage, calls that raise are timed too
+
+        Keyword arguments:
+        name            -- The stage name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, start)
+
+    def timed_iter(self, iterable, name):
+        """
+        Yield from an iterable, timing each item it produces as one call of a stage (i.e.
+        parsing the next product or fetching the next page)
+
+        Keyword arguments:
+        iterable        -- The iterable to time
+        name            -- The stage name
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - start, start)
+            yield item
+
+    def summary(self):
+        """
+        The run's stage timings and counters so far, as a JSON serialisable dict
+        """
+        elapsed = time.perf_counter() - self._start
+
+        with self._lock:
+            timings = {name: sorted(seconds) for (name, seconds) in self._timings.items()}
+            counters = dict(self._counters)
+
+        stages = {}
+        for (name, ordered) in sorted(timings.items()):
+            total = sum(ordered)
+            stage = {
+                'count': len(ordered),
+                'total_seconds': total,
+                'mean_seconds': total / len(ordered),
+            }
+            for pct in PERCENTILES:
+                stage['p%d_seconds' % pct] = percentile(ordered, pct)
+            stage['max_seconds'] = ordered[-1]
+            stage['per_second'] = len(ordered) / elapsed if elapsed else None
+            stages[name] = stage
+
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started)),
+            'elapsed_seconds': elapsed,
+            'stages': stages,
+            'counters': {
+                name: {'total': value, 'per_second': value / elapsed if elapsed else None}
+                for (name, value) in sorted(counters.items())
+            }
+        }
+
+    def close(self):
+        """
+        End the run, writing the summary and trace and dumping the profile
+        """
+        if self._profiler:
+            self._profiler.stop()
+            self._profiler = None
+
+        summary = codec.dumps(self.summary())
+
+        if self.summary_path:
+            with open(self.summary_path, 'wb') as summary_file:
+                summary_file.write(summary + b'\n')
+        else:
+            print(summary.decode('utf-8'), file=sys.stderr)
+
+        if self._trace:
+            self._trace.close()
+            self._trace = None
+
+
+def add_arguments(parser):
+    """
+    Add the common instrumentation options to an argparse parser
+
+    Keyword arguments:
+    parser          -- An argparse.ArgumentParser
+    """
+    parser.add_argument('--metrics', type=str, required=False,
+                        help='Path to write the JSON summary of per stage timings and \
+                        counters to at the end of the run (default stderr)')
+    parser.add_argument('--trace', type=str, required=False,
+                        help='Path to write every timed stage call to as JSON Lines')
+    parser.add_argument('--cprofile', type=str, required=False,
+                        help='Path to dump cProfile stats for the run to, across all its \
+                        threads, readable with python -m pstats')
+
+
+def from_args(args):
+    """
+    Create the run's instrumentation from parsed argparse options added by add_arguments
+
+    Keyword arguments:
+    args            -- Parsed argparse namespace
+    """
+    return Instrumentation(args.metrics, args.trace, args.cprofile)
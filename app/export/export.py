@@ -1,96 +1,685 @@
+import argparse
+import copy
+import datetime
+import itertools
+import json
+import math
+import queue
+import threading
 import requests
 import pprint
 import sys
 import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+# Only needed to split a query's footprint into tiles
+try:
+    from shapely import wkt as shapelyWkt
+    from shapely.geometry import box
+except ImportError:
+    shapelyWkt = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import codec
+import flow_control
+import http_client
+import instrumentation
+
+from export_state import ExportState
+from response_cache import ResponseCache
 
 pp = pprint.PrettyPrinter()
 
+# Defaults for the --catalog-url and --output-folder options
 CATALOG_URL = 'http://172.31.6.72/'
 OUTPUT_FOLDER = './output/'
 
+PAGE_SIZE = 50
+SHARD_WORKERS = 1
+SHARD_SIZE = 10000
+
+DOWNLOAD_WORKERS = 8
+CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_ATTEMPTS = 3
+
+# One pooled, retrying session shared by the catalog queries and the S3 downloads, every
+# POST the exporter sends is a read only search so those are retried too
+SESSION = http_client.create_session(retry_post=True)
+
+# Stage timings and counters for the run, reported when the run ends
+METRICS = instrumentation.Instrumentation()
+
+# Kept search responses to revalidate, set by --response-cache
+RESPONSE_CACHE = None
 
-def getProducts(query):
-    queryUrl = CATALOG_URL + 'search/product'
-    products = []
+
+def postSearch(route, query):
+    # A catalog search's parsed response, revalidated against the kept response when there
+    # is a response cache
+    if RESPONSE_CACHE is None:
+        return http_client.response_json(SESSION.post(CATALOG_URL + route, json=query))
+    return RESPONSE_CACHE.post(SESSION, CATALOG_URL + route, query)
+
+
+def iterPages(query, keyset=True):
+    # Lazily yields pages of products, each page is only requested once the previous one
+    # has been consumed so memory stays bounded by the page size and consumers can start
+    # work on the first page while later ones are still to come
+    # Ids of the products yielded so far, for constant time de-duplication
+    seen = set()
 
     try:
         offset = 0
-        limit = 50
 
         getNextPage = True
 
-        # Iterate though each page of results until no results are returned
+        # Iterate though each page of results until no results are returned. Keyset paging
+        # asks for the page after the last product seen, so every page costs the catalog
+        # the same, offset paging is kept for catalogs without the after parameter
         while getNextPage:
-            query["offset"] = offset
-            query["limit"] = limit
+            query["limit"] = PAGE_SIZE
+            if keyset:
+                query.pop("offset", None)
+            else:
+                query["offset"] = offset
 
-            r = requests.post(queryUrl, json=query)
+            with METRICS.stage('page_fetch'):
+                # A json payload is returned. Converting to a python dictionary
+                # enables us to get the products from the result key.
+                p = postSearch('search/product', query)['result']
 
-            # A json payload is returned. Converting to a python dictionary
-            # enables us to get the products from the result key.
-            p = r.json()['result']
+            new = [x for x in p if x['id'] not in seen]
 
-            if p:
-                products = products + [x for x in p if x not in products]
-                offset = offset + limit
+            # A page of products already seen under keyset paging means the catalog
+            # ignored the after parameter (it predates it), carry on with offset paging
+            if keyset and p and not new:
+                print('The catalog does not support the after parameter, falling back to offset paging')
+                keyset = False
+                query.pop("after", None)
+                continue
+
+            if new if keyset else p:
+                METRICS.count('products_fetched', len(new))
+                seen.update(x['id'] for x in new)
+                offset = offset + len(p)
+                if keyset:
+                    query["after"] = p[-1]['collectionName'] + '/' + p[-1]['name']
+                yield new
             else:
                 getNextPage = False
 
-        return products
+        query.pop("after", None)
     except requests.exceptions.RequestException as e:
         print(e)
         sys.exit(1)
 
 
-def downloadProducts(products):
-    # Create the output folder
-    if not os.path.exists(OUTPUT_FOLDER):
-        os.makedirs(OUTPUT_FOLDER)
+def iterProducts(query, keyset=True):
+    for page in iterPages(query, keyset):
+        for product in page:
+            yield product
+
+
+def getProducts(query, keyset=True):
+    return list(iterProducts(query, keyset))
+
+
+def countProducts(query):
+    with METRICS.stage('count_request'):
+        r = postSearch('search/product/count', query)
+    return int(r['result'][0]['products'])
+
+
+def countByCollection(query):
+    with METRICS.stage('count_request'):
+        r = postSearch('search/product/countByCollection', query)
+    return {c['collectionName']: int(c['products']) for c in r['result']}
+
+
+def parseTermValue(value):
+    # Date terms are either dates (YYYY-MM-DD) or UTC date-times
+    if len(value) == 10:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    return datetime.datetime.strptime(value.replace('Z', '+00:00')[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def formatTermValue(value, like):
+    if len(like) == 10:
+        return value.strftime('%Y-%m-%d')
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def dateWindow(query, shardProperty):
+    # The lower (>, >=) and upper (<, =<) bound terms the query has on the shard property,
+    # or None if it is not bounded on both sides
+    lower = [t for t in query.get('terms', []) if t['property'] == shardProperty and t['operation'] in ('>', '>=')]
+    upper = [t for t in query.get('terms', []) if t['property'] == shardProperty and t['operation'] in ('<', '=<', '<=')]
+
+    if len(lower) != 1 or len(upper) != 1:
+        return None
+    return (lower[0], upper[0])
+
+
+def withWindow(query, lower, upper):
+    # A copy of query with its bound terms on the window's property swapped for new ones
+    (oldLower, oldUpper) = dateWindow(query, lower['property'])
+    shard = copy.deepcopy(query)
+    shard['terms'] = [t for t in shard['terms'] if t != oldLower and t != oldUpper] + [lower, upper]
+    return shard
+
+
+def splitShard(query, count, shardProperty, shardSize):
+    # Bisects the query's date window until every piece holds at most shardSize products
+    # (or is a single day / second wide). Pieces are half open, [start, middle) and
+    # [middle, end), so no product falls in two of them.
+    window = dateWindow(query, shardProperty) if shardProperty else None
+
+    if count == 0:
+        return []
+    if count <= shardSize or window is None:
+        return [(query, count)]
+
+    (lower, upper) = window
+    start = parseTermValue(lower['value'])
+    end = parseTermValue(upper['value'])
+    step = datetime.timedelta(days=1) if len(lower['value']) == 10 else datetime.timedelta(seconds=1)
+
+    if end - start <= step:
+        return [(query, count)]
+
+    middle = start + (end - start) // 2
+    if len(lower['value']) == 10:
+        middle = datetime.datetime.combine(middle.date(), datetime.time())
+    middleValue = formatTermValue(middle, lower['value'])
+
+    first = withWindow(query, lower, {'property': shardProperty, 'operation': '<', 'value': middleValue})
+    second = withWindow(query, {'property': shardProperty, 'operation': '>=', 'value': middleValue}, upper)
+
+    firstCount = countProducts(first)
+    return (splitShard(first, firstCount, shardProperty, shardSize)
+            + splitShard(second, count - firstCount, shardProperty, shardSize))
+
+
+def planShards(query, shardProperty=None, shardSize=SHARD_SIZE):
+    # Splits a query into independent shards, one per collection and then per date range
+    # of the shard property, sized from the catalog's counts. Returns (query, count) pairs.
+    if len(query['collections']) > 1:
+        counts = countByCollection(query)
+        shards = []
+        for name in query['collections']:
+            if counts.get(name, 0) > 0:
+                shard = copy.deepcopy(query)
+                shard['collections'] = [name]
+                shards.append((shard, counts[name]))
+    else:
+        shards = [(copy.deepcopy(query), countProducts(query))]
+
+    planned = []
+    for (shard, count) in shards:
+        planned.extend(splitShard(shard, count, shardProperty, shardSize))
+
+    return planned
+
+
+def planTiles(query, tileSize):
+    # Splits the query's WKT footprint into a grid of tileSize degree tiles, each clipped to
+    # the footprint, as (tile label, query) pairs. Each tile's search is a small
+    # ST_Intersects the footprint index answers cheaply, a product straddling tiles is
+    # returned by each of them. Only intersects queries can be split this way. A clipped
+    # tile in several pieces is one query per polygon, as the catalog only takes polygons.
+    aoi = shapelyWkt.loads(query['footprint'])
+    (minX, minY, maxX, maxY) = aoi.bounds
+    columns = max(1, int(math.ceil((maxX - minX) / tileSize)))
+    rows = max(1, int(math.ceil((maxY - minY) / tileSize)))
+
+    tiles = []
+    for row in range(rows):
+        for column in range(columns):
+            # Neighbouring tiles compute their shared edge the same way, so no gap opens
+            tile = box(minX + column * tileSize, minY + row * tileSize,
+                       minX + (column + 1) * tileSize, minY + (row + 1) * tileSize)
+            clipped = aoi.intersection(tile)
+            for polygon in getattr(clipped, 'geoms', [clipped]):
+                if polygon.geom_type == 'Polygon' and polygon.area > 0:
+                    tileQuery = copy.deepcopy(query)
+                    tileQuery['footprint'] = shapelyWkt.dumps(polygon, rounding_precision=-1)
+                    tiles.append(('r%dc%d' % (row, column), tileQuery))
+
+    return tiles
+
+
+def planTiledShards(query, tileSize, shardProperty=None, shardSize=SHARD_SIZE, workers=SHARD_WORKERS):
+    # Plans the shards of each tile of the query (or of the whole query without a tile
+    # size), the tiles are counted concurrently. Returns (tile label, query, count) tuples.
+    tiles = planTiles(query, tileSize) if tileSize else [(None, query)]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        plans = executor.map(lambda tile: planShards(tile[1], shardProperty, shardSize), tiles)
+        return [(label, shardQuery, count)
+                for ((label, _), plan) in zip(tiles, plans)
+                for (shardQuery, count) in plan]
+
+
+def printTileReport(tileStats):
+    # Products each tile returned and how many of those another tile had already returned
+    print('')
+    print('%-10s %10s %12s' % ('tile', 'products', 'duplicates'))
+    for (label, (fetched, new)) in sorted(tileStats.items()):
+        print('%-10s %10d %12d' % (label, fetched, fetched - new))
+
+
+def iterShardedProducts(query, shards=SHARD_WORKERS, shardProperty=None, shardSize=SHARD_SIZE, keyset=True,
+                        tileSize=None):
+    # Runs the planned shards of a query concurrently, merging their pages into a single
+    # stream of products de-duplicated by id. The merged stream is in no particular order,
+    # a bounded queue between the shard workers and the consumer keeps memory bounded.
+    # With a tile size the query's footprint is first split into tiles (see planTiles) and
+    # the products each tile returned are reported once the stream is done.
+    try:
+        planned = planTiledShards(query, tileSize, shardProperty, shardSize, shards)
+    except requests.exceptions.RequestException as e:
+        print(e)
+        sys.exit(1)
+    if tileSize:
+        print('Planned %d shards over %d tiles of %d products (straddling products counted in each tile)'
+              % (len(planned), len(set(t for (t, _, _) in planned)), sum(c for (_, _, c) in planned)))
+    else:
+        print('Planned %d shards of %d products' % (len(planned), sum(c for (_, _, c) in planned)))
+
+    pages = queue.Queue(maxsize=2 * shards)
+    done = object()
+    # Set when the consumer goes away (or a shard fails) so the workers stop rather than
+    # block on a full queue
+    stop = threading.Event()
 
-    for product in products:
-        s3Preview = product['data']['preview']['s3']
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def runShard(tile, shardQuery):
+        try:
+            for page in iterPages(shardQuery, keyset):
+                if stop.is_set():
+                    return
+                put((tile, page))
+        except BaseException as e:
+            # iterPages exits on request errors, hand that to the consumer
+            put(e)
+        finally:
+            put(done)
+
+    seen = set()
+    # Products fetched and products new to the stream, per tile
+    tileStats = {}
+
+    with ThreadPoolExecutor(max_workers=shards) as executor:
+        remaining = len(planned)
+        pending = iter(planned)
+
+        # Only as many shards run as there are workers, the next one is started as each
+        # finishes so that the queue can not fill up with pages nobody is taking
+        for (tile, shardQuery, _) in itertools.islice(pending, shards):
+            executor.submit(runShard, tile, shardQuery)
+
+        try:
+            while remaining > 0:
+                item = pages.get()
+                if item is done:
+                    remaining = remaining - 1
+                    for (tile, shardQuery, _) in itertools.islice(pending, 1):
+                        executor.submit(runShard, tile, shardQuery)
+                elif isinstance(item, BaseException):
+                    print('Shard failed: %s' % item)
+                    sys.exit(1)
+                else:
+                    (tile, page) = item
+                    stats = tileStats.setdefault(tile, [0, 0])
+                    stats[0] += len(page)
+                    for product in page:
+                        if product['id'] not in seen:
+                            seen.add(product['id'])
+                            stats[1] += 1
+                            yield product
+                        else:
+                            METRICS.count('products_duplicate')
+        finally:
+            stop.set()
+
+    if tileSize:
+        printTileReport(tileStats)
+
+
+def productFeature(product):
+    # A product as a GeoJSON feature, the footprint is the geometry and everything else
+    # goes in the feature properties
+    properties = {k: v for (k, v) in product.items() if k != 'footprint'}
+    return {'type': 'Feature', 'id': product.get('id'), 'geometry': product.get('footprint'), 'properties': properties}
+
+
+def writeProducts(products, outputPath, outputFormat):
+    # Writes products to outputPath as JSON Lines or a GeoJSON FeatureCollection as they
+    # stream past, yielding each one on to the next consumer (i.e. the downloads)
+    with open(outputPath, 'wb') as f:
+        count = 0
+        if outputFormat == 'geojson':
+            f.write(b'{"type": "FeatureCollection", "features": [\n')
+
+        for product in products:
+            with METRICS.stage('write'):
+                if outputFormat == 'geojson':
+                    if count > 0:
+                        f.write(b',\n')
+                    f.write(codec.dumps(productFeature(product)))
+                else:
+                    f.write(codec.dumps(product))
+                    f.write(b'\n')
+            count = count + 1
+            yield product
+
+        if outputFormat == 'geojson':
+            f.write(b'\n]}\n')
+
+    print('Wrote %d products to %s' % (count, outputPath))
 
-        bucket = s3Preview['bucket']
-        key = s3Preview['key']
-        region = s3Preview['region']
-        fileType = s3Preview['type']
 
-        # These products are available direct from the bucket for public download. We can get them with a url.
-        # Otherwise we would use the Amazon boto library to authenticate and connect to the bucket.
-        downloadUrl = 'https://s3-' + region + '.amazonaws.com/' + bucket + '/' + key
-        file = downloadUrl.rsplit('/', 1)[-1]
-        outputPath = OUTPUT_FOLDER + file
+def downloadPath(product):
+    s3Preview = product['data']['preview']['s3']
+
+    # These products are available direct from the bucket for public download. We can get them with a url.
+    # Otherwise we would use the Amazon boto library to authenticate and connect to the bucket.
+    downloadUrl = 'https://s3-' + s3Preview['region'] + '.amazonaws.com/' + s3Preview['bucket'] + '/' + s3Preview['key']
+    file = downloadUrl.rsplit('/', 1)[-1]
+
+    return (downloadUrl, file, OUTPUT_FOLDER + file, s3Preview.get('size'))
+
+
+def downloadProduct(product, chunkSize=CHUNK_SIZE, attempts=DOWNLOAD_ATTEMPTS, etag=None):
+    # Downloads one preview to a .part file which is renamed into place once complete, so
+    # a file under its final name is always whole. A .part file left by an interrupted
+    # download (in this run or an earlier one) is resumed with a Range request. With the
+    # ETag of an earlier download of the file it is only fetched again if it has changed.
+    # Returns (file, status, bytes transferred, etag) where status is 'downloaded' or
+    # 'skipped'.
+    (downloadUrl, file, outputPath, expectedSize) = downloadPath(product)
+    partPath = outputPath + '.part'
+
+    if os.path.exists(outputPath):
+        size = os.path.getsize(outputPath)
+        if etag is None and expectedSize is not None and size == expectedSize:
+            return (file, 'skipped', 0, None)
+        # Left behind by an older, non atomic download, carry on from where it stopped
+        if expectedSize is not None and size < expectedSize and not os.path.exists(partPath):
+            os.replace(outputPath, partPath)
+
+    transferred = 0
+    for attempt in range(1, attempts + 1):
+        offset = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+        headers = {'Range': 'bytes=%d-' % offset} if offset > 0 else {}
+        if offset == 0 and etag is not None and os.path.exists(outputPath):
+            headers['If-None-Match'] = etag
 
         try:
-            print('Downloading: ' + file)
-            r = requests.get(downloadUrl, stream=True)
-            with open(outputPath, 'wb') as f:
-                for chunk in r.iter_content(1024):
-                    f.write(chunk)
+            with SESSION.get(downloadUrl, headers=headers, stream=True) as r:
+                if r.status_code == 304:
+                    return (file, 'skipped', 0, etag)
+
+                if r.status_code == 416 and offset > 0:
+                    # Nothing left past the partial file, either it is complete or the
+                    # file changed underneath it, in which case start again
+                    if expectedSize is None or offset == expectedSize:
+                        break
+                    os.remove(partPath)
+                    continue
+
+                r.raise_for_status()
+                etag = r.headers.get('ETag', etag)
+
+                # A server that ignores the Range header sends the whole file again
+                mode = 'ab' if offset > 0 and r.status_code == 206 else 'wb'
+                with open(partPath, mode) as f:
+                    for chunk in r.iter_content(chunkSize):
+                        f.write(chunk)
+                        transferred += len(chunk)
+            break
         except requests.exceptions.RequestException as e:
+            # Client errors (i.e. a missing preview) will not go away on a retry
+            clientError = e.response is not None and 400 <= e.response.status_code < 500
+            if attempt == attempts or clientError:
+                raise
+            print('Retrying %s (attempt %d of %d): %s' % (file, attempt + 1, attempts, e))
+
+    size = os.path.getsize(partPath)
+    if expectedSize is not None and size != expectedSize:
+        # Keep the .part file, a later run resumes it or starts again if it is too big
+        if size > expectedSize:
+            os.remove(partPath)
+        raise IOError('Downloaded %d bytes of %s but the catalog size is %d' % (size, file, expectedSize))
+
+    os.replace(partPath, outputPath)
+    return (file, 'downloaded', transferred, etag)
+
+
+def downloadProducts(products, workers=DOWNLOAD_WORKERS, chunkSize=CHUNK_SIZE, state=None):
+    # Create the output folder
+    if not os.path.exists(OUTPUT_FOLDER):
+        os.makedirs(OUTPUT_FOLDER)
+
+    totals = {'downloaded': 0, 'skipped': 0, 'transferred': 0}
+    failed = []
+    start = time.time()
+
+    def collect(future, product):
+        try:
+            (file, status, size, etag) = future.result()
+            totals['transferred'] = totals['transferred'] + size
+            METRICS.count('download_bytes', size)
+            METRICS.count('previews_' + status)
+            if state is not None:
+                state.recordDownload(product, downloadPath(product)[2], etag)
+            if status == 'skipped':
+                totals['skipped'] = totals['skipped'] + 1
+                print('Skipped (already downloaded): ' + file)
+            else:
+                totals['downloaded'] = totals['downloaded'] + 1
+                print('Downloaded: ' + file)
+        except (requests.exceptions.RequestException, IOError) as e:
+            (downloadUrl, _, _, _) = downloadPath(product)
             print('Could not download: ' + downloadUrl)
             pp.pprint(e)
+            failed.append(downloadUrl)
+            METRICS.count('previews_failed')
+
+    def download(product, etag):
+        with METRICS.stage('download'):
+            return downloadProduct(product, chunkSize, DOWNLOAD_ATTEMPTS, etag)
+
+    # Previews are downloaded concurrently as the products stream in, with a bounded number
+    # in flight so the product stream is not read far ahead of the downloads. The shared
+    # session's connection pool needs to be at least as large as the number of workers.
+    # Only one worker may write to a given output file.
+    targets = set()
+    pending = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for product in products:
+            outputPath = downloadPath(product)[2]
+            if outputPath in targets:
+                continue
+            targets.add(outputPath)
+
+            etag = state.etag(product) if state is not None else None
+            pending[executor.submit(download, product, etag)] = product
+
+            if len(pending) >= 2 * workers:
+                (done, _) = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future, pending.pop(future))
+
+        for future in as_completed(pending):
+            collect(future, pending[future])
+
+    elapsed = max(time.time() - start, 0.001)
+    print('%d downloaded, %d skipped, %d failed, %.1f MB in %.1fs (%.2f MB/s)'
+          % (totals['downloaded'], totals['skipped'], len(failed), totals['transferred'] / 1000000.0,
+             elapsed, totals['transferred'] / 1000000.0 / elapsed))
+
+    return failed
 
 
 if __name__ == '__main__':
-    # Construct a query object that:
-    # - Requests all items in the 'sentinel/1/ard/backscatter/osgb' collection
-    # - that have a begin date >= 2016-08-04
-    # - and an end date =< 2016-08-05
-    query = {
-        'collections': ['sentinel/1/ard/backscatter/osgb'],
-        'terms': [
-            {
-                'property': 'begin',
-                'operation': '>=',
-                'value': '2016-08-04T00:00:00Z'
-            },
-            {
-                'property': 'end',
-                'operation': '=<',
-                'value': '2016-08-05T00:00:00Z'
-            }]
-    }
-
-    products = getProducts(query)
-    downloadProducts(products)
+    parser = argparse.ArgumentParser(description='Exports products from the catalog')
+    parser.add_argument('-c', '--catalog-url', required=False, default=CATALOG_URL,
+                        help='Base URL of the catalog API (default %s)' % CATALOG_URL)
+    parser.add_argument('-q', '--query', required=False,
+                        help='Path to a JSON product search query (default the example \
+                        sentinel/1/ard/backscatter/osgb query)')
+    parser.add_argument('-o', '--output', required=False,
+                        help='Stream the product metadata to this file')
+    parser.add_argument('-f', '--format', choices=['jsonl', 'geojson'], required=False, default='jsonl',
+                        help='Format of the --output file, JSON Lines or a GeoJSON FeatureCollection \
+                        of the product footprints (default jsonl)')
+    parser.add_argument('--output-folder', required=False, default=OUTPUT_FOLDER,
+                        help='Folder to download the previews to (default %s)' % OUTPUT_FOLDER)
+    parser.add_argument('--no-download', action='store_true', required=False, default=False,
+                        help='Only export the product metadata, do not download the previews')
+    parser.add_argument('-w', '--workers', type=int, required=False, default=DOWNLOAD_WORKERS,
+                        help='Number of previews to download concurrently (default %d)' % DOWNLOAD_WORKERS)
+    parser.add_argument('-s', '--shards', type=int, required=False, default=SHARD_WORKERS,
+                        help='Number of query shards to export concurrently, the query is split \
+                        per collection and per date range (default %d, no sharding)' % SHARD_WORKERS)
+    parser.add_argument('--shard-property', required=False,
+                        help='Date property to split shards on, the query needs a lower (>, >=) \
+                        and an upper (<, =<) term on it, i.e. begin')
+    parser.add_argument('--shard-size', type=int, required=False, default=SHARD_SIZE,
+                        help='Split shards until each holds at most this many products \
+                        (default %d)' % SHARD_SIZE)
+    parser.add_argument('--state', required=False,
+                        help='Delta export, keep a local index of the exported products in this \
+                        SQLite file and only export and download products that are new or changed \
+                        since the last run')
+    parser.add_argument('--report-deletions', action='store_true', required=False, default=False,
+                        help='With --state, list the products exported by earlier runs that the \
+                        query no longer returns and drop them from the index')
+    parser.add_argument('--tile-size', type=float, required=False,
+                        help='Split the query\'s WKT footprint into a grid of tiles this many \
+                        degrees wide, each searched as its own shard (with -s tiles run \
+                        concurrently), needs shapely and an intersects query')
+    parser.add_argument('--offset-paging', action='store_true', required=False, default=False,
+                        help='Page through the search results with offset rather than the after \
+                        cursor')
+    parser.add_argument('--page-size', type=int, required=False, default=PAGE_SIZE,
+                        help='Number of products to ask for per search page (default %d)' % PAGE_SIZE)
+    parser.add_argument('--response-cache', required=False,
+                        help='Keep the catalog\'s search responses in this folder and revalidate \
+                        them on later runs, unchanged pages come back as 304s without a body')
+    parser.add_argument('--chunk-size', type=int, required=False, default=CHUNK_SIZE // 1024,
+                        help='Download chunk size in KiB (default %d)' % (CHUNK_SIZE // 1024))
+    http_client.add_arguments(parser)
+    flow_control.add_arguments(parser)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.no_download and not args.output:
+        parser.error('--no-download needs an --output file')
+    if args.report_deletions and not args.state:
+        parser.error('--report-deletions needs a --state file')
+
+    CATALOG_URL = args.catalog_url if args.catalog_url.endswith('/') else args.catalog_url + '/'
+    OUTPUT_FOLDER = os.path.join(args.output_folder, '')
+    PAGE_SIZE = max(1, args.page_size)
+
+    workers = max(1, args.workers)
+    shards = max(1, args.shards)
+    METRICS = instrumentation.from_args(args)
+    # Only the catalog queries are flow controlled, the shards are the only threads that
+    # query the catalog
+    controller = flow_control.from_args(args, CATALOG_URL, shards, METRICS)
+    SESSION = http_client.session_from_args(args, min_pool_size=workers + shards, retry_post=True,
+                                            controller=controller)
+    if args.response_cache:
+        RESPONSE_CACHE = ResponseCache(args.response_cache, METRICS)
+
+    if args.query:
+        with open(args.query) as f:
+            query = json.load(f)
+    else:
+        # Construct a query object that:
+        # - Requests all items in the 'sentinel/1/ard/backscatter/osgb' collection
+        # - that have a begin date >= 2016-08-04
+        # - and an end date =< 2016-08-05
+        query = {
+            'collections': ['sentinel/1/ard/backscatter/osgb'],
+            'terms': [
+                {
+                    'property': 'begin',
+                    'operation': '>=',
+                    'value': '2016-08-04T00:00:00Z'
+                },
+                {
+                    'property': 'end',
+                    'operation': '=<',
+                    'value': '2016-08-05T00:00:00Z'
+                }]
+        }
+
+    if args.tile_size is not None:
+        if args.tile_size <= 0:
+            parser.error('--tile-size should be above 0')
+        if shapelyWkt is None:
+            parser.error('--tile-size needs the shapely package')
+        if not query.get('footprint'):
+            parser.error('--tile-size needs a query with a footprint')
+        if (query.get('spatialop') or 'intersects') != 'intersects':
+            parser.error('--tile-size only applies to intersects queries, splitting the footprint '
+                         'does not preserve %s' % query['spatialop'])
+
+    # The metrics are reported however the run ends
+    try:
+        # Products stream from the search pages through the metadata file to the downloads,
+        # nothing holds the whole result set
+        if shards > 1 or args.tile_size:
+            products = iterShardedProducts(query, shards, args.shard_property, max(1, args.shard_size),
+                                           not args.offset_paging, args.tile_size)
+        else:
+            products = iterProducts(query, not args.offset_paging)
+
+        state = None
+        if args.state:
+            state = ExportState(args.state)
+            products = state.filterChanged(products, not args.no_download)
+
+        if args.output:
+            products = writeProducts(products, args.output, args.format)
+
+        failed = []
+        if args.no_download:
+            for product in products:
+                pass
+        else:
+            failed = downloadProducts(products, workers, max(1, args.chunk_size) * 1024, state)
+
+        if state is not None:
+            print('%d products unchanged since the last run' % state.unchanged)
+
+            if args.report_deletions:
+                deleted = state.deleted()
+                for (_, fullName) in deleted:
+                    print('Deleted: ' + fullName)
+                print('%d products deleted since the last run' % len(deleted))
+                state.forget([i for (i, _) in deleted])
+
+            state.close()
+
+        if controller:
+            print(controller.describe())
+    finally:
+        METRICS.close()
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+# Local state for delta exports, a small SQLite index of the products seen by earlier runs
+# with a hash of their content and the preview file downloaded for them, so that a repeat
+# export only writes and downloads the products that are new or have changed since.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS products (
+    id TEXT PRIMARY KEY,
+    full_name TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    run INTEGER NOT NULL,
+    downloaded INTEGER NOT NULL DEFAULT 0,
+    file_path TEXT,
+    file_size INTEGER,
+    etag TEXT
+)
+'''
+
+COMMIT_EVERY = 500
+
+
+def contentHash(product):
+    # Hash of everything about a product that ends up in an export
+    content = {k: product.get(k) for k in ('name', 'collectionName', 'metadata', 'properties', 'data', 'footprint')}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class ExportState:
+    # Only used from the thread consuming the product stream, downloads are recorded as
+    # their results are collected
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute(SCHEMA)
+        self.run = (self.db.execute('SELECT MAX(run) FROM products').fetchone()[0] or 0) + 1
+        self.pending = 0
+        self.unchanged = 0
+
+    def _changed(self):
+        self.pending = self.pending + 1
+        if self.pending >= COMMIT_EVERY:
+            self.commit()
+
+    def filterChanged(self, products, downloads):
+        # Yields only the products that are new or changed since the last run, or (with
+        # downloads) whose preview was not downloaded whole, every product is marked as
+        # seen by this run
+        for product in products:
+            digest = contentHash(product)
+            row = self.db.execute('SELECT content_hash, downloaded, file_path, file_size FROM products WHERE id = ?',
+                                  (product['id'],)).fetchone()
+            fullName = product['collectionName'] + '/' + product['name']
+
+            if row is None:
+                self.db.execute('INSERT INTO products (id, full_name, content_hash, run) VALUES (?, ?, ?, ?)',
+                                (product['id'], fullName, digest, self.run))
+            else:
+                (oldDigest, downloaded, filePath, fileSize) = row
+                fileOk = downloaded and filePath and os.path.exists(filePath) and os.path.getsize(filePath) == fileSize
+
+                if oldDigest == digest and (not downloads or fileOk):
+                    self.db.execute('UPDATE products SET run = ? WHERE id = ?', (self.run, product['id']))
+                    self._changed()
+                    self.unchanged = self.unchanged + 1
+                    continue
+
+                # The preview is downloaded again, the old ETag is kept so an unchanged
+                # file can be confirmed with a conditional request
+                self.db.execute('UPDATE products SET full_name = ?, content_hash = ?, run = ?, downloaded = 0 WHERE id = ?',
+                                (fullName, digest, self.run, product['id']))
+
+            self._changed()
+            yield product
+
+    def etag(self, product):
+        row = self.db.execute('SELECT etag FROM products WHERE id = ?', (product['id'],)).fetchone()
+        return row[0] if row else None
+
+    def recordDownload(self, product, filePath, etag):
+        # A download that learnt no ETag (i.e. skipped as the file on disk is the right size)
+        # keeps the one recorded by an earlier run
+        self.db.execute('UPDATE products SET downloaded = 1, file_path = ?, file_size = ?, etag = COALESCE(?, etag) WHERE id = ?',
+                        (filePath, os.path.getsize(filePath), etag, product['id']))
+        self._changed()
+
+    def deleted(self):
+        # Products seen by an earlier run but not this one, only meaningful once a run has
+        # gone through the whole query
+        return self.db.execute('SELECT id, full_name FROM products WHERE run < ? ORDER BY full_name',
+                               (self.run,)).fetchall()
+
+    def forget(self, ids):
+        self.db.executemany('DELETE FROM products WHERE id = ?', [(i,) for i in ids])
+        self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
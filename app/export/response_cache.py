@@ -0,0 +1,63 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import codec
+
+# On disk cache of catalog search responses for repeat exports. Each response is kept with
+# its ETag and the same search (URL and query, whatever the key order) is sent again with
+# If-None-Match, when the results have not changed the catalog answers with a bodyless 304
+# and the kept response is used, so unchanged pages cost neither the catalog query nor the
+# transfer of their footprints. The folder can be deleted at any time.
+
+
+class ResponseCache:
+    # Safe to share between the shard threads, entries are written to a temporary file and
+    # moved into place
+
+    def __init__(self, folder, metrics=None):
+        self.folder = folder
+        self.metrics = metrics
+        os.makedirs(folder, exist_ok=True)
+
+    def entryPath(self, url, query):
+        key = json.dumps([url, query], sort_keys=True, separators=(',', ':'))
+        return os.path.join(self.folder, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def read(self, path):
+        # (etag, body bytes) of a kept response, (None, None) if there is none
+        try:
+            with open(path, 'rb') as f:
+                etag = f.readline().rstrip(b'\n').decode('utf-8')
+                return (etag, f.read())
+        except FileNotFoundError:
+            return (None, None)
+
+    def write(self, path, etag, body):
+        (fd, tmpPath) = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(etag.encode('utf-8') + b'\n')
+                f.write(body)
+            os.replace(tmpPath, path)
+        except BaseException:
+            os.remove(tmpPath)
+            raise
+
+    def post(self, session, url, query):
+        # POSTs a search and returns its parsed response, the kept one if it is unchanged
+        path = self.entryPath(url, query)
+        (etag, body) = self.read(path)
+
+        r = session.post(url, json=query, headers={'If-None-Match': etag} if etag else None)
+
+        if r.status_code == 304 and body is not None:
+            if self.metrics:
+                self.metrics.count('search_not_modified')
+                self.metrics.count('search_bytes_reused', len(body))
+            return codec.loads(body)
+
+        if r.ok and r.headers.get('ETag'):
+            self.write(path, r.headers['ETag'], r.content)
+        return codec.loads(r.content)
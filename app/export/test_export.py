@@ -0,0 +1,478 @@
+#pylint: disable=C0111
+"""
+Tests for the exporter's catalog paging, sharding and tiling, resumable downloads and
+delta export state, run from this folder with
+
+    python -m unittest test_export
+"""
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from unittest import mock
+
+import requests
+
+import export
+from export_state import ExportState
+
+
+def product(name, title='A product'):
+    return {'id': 'id-' + name, 'name': name, 'collectionName': 'a/b',
+            'metadata': {'title': title}, 'data': {}}
+
+
+OPERATIONS = {
+    '=': lambda a, b: a == b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b,
+    '=<': lambda a, b: a <= b,
+    '<=': lambda a, b: a <= b
+}
+
+
+class FakeResponse:
+
+    def __init__(self, body):
+        self.content = json.dumps(body).encode('utf-8')
+
+
+class FakeCatalog:
+    # The catalog's search routes over products held in memory, in collection / name order
+
+    def __init__(self, products, supports_after=True):
+        self.products = sorted(products, key=lambda p: (p['collectionName'], p['name']))
+        self.supports_after = supports_after
+        self.queries = []
+
+    def matching(self, query):
+        products = [p for p in self.products if p['collectionName'] in query['collections']]
+        for term in query.get('terms', []):
+            test = OPERATIONS[term['operation']]
+            products = [p for p in products if test(p['properties'][term['property']], term['value'])]
+        if query.get('footprint'):
+            from shapely import wkt
+            from shapely.geometry import shape
+            area = wkt.loads(query['footprint'])
+            products = [p for p in products if shape(p['footprint']).intersects(area)]
+        return products
+
+    def post(self, url, json=None, headers=None):
+        route = url[len(export.CATALOG_URL):]
+        self.queries.append((route, dict(json)))
+        products = self.matching(json)
+
+        if route == 'search/product/count':
+            return FakeResponse({'result': [{'products': len(products)}]})
+        if route == 'search/product/countByCollection':
+            names = sorted(set(p['collectionName'] for p in products))
+            return FakeResponse({'result': [
+                {'collectionName': n, 'products': sum(p['collectionName'] == n for p in products)}
+                for n in names]})
+
+        if self.supports_after and json.get('after'):
+            products = [p for p in products if p['collectionName'] + '/' + p['name'] > json['after']]
+        start = json.get('offset', 0)
+        return FakeResponse({'result': products[start:start + json['limit']]})
+
+    def page_queries(self):
+        return [query for (route, query) in self.queries if route == 'search/product']
+
+
+def catalog_product(i, collection='a/b', date='2016-08-01', x=0.0):
+    return {'id': 'id-%s-%03d' % (collection, i), 'name': 'p%03d' % i, 'collectionName': collection,
+            'properties': {'capturedDate': date},
+            'footprint': {'type': 'Polygon', 'coordinates': [
+                [[x, 0.0], [x + 0.1, 0.0], [x + 0.1, 0.1], [x, 0.1], [x, 0.0]]]}}
+
+
+class CatalogTest(unittest.TestCase):
+    # Runs the exporter against a FakeCatalog with small pages
+
+    page_size = 4
+
+    def setUp(self):
+        patcher = mock.patch.object(export, 'PAGE_SIZE', self.page_size)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def use(self, catalog):
+        patcher = mock.patch.object(export, 'SESSION', catalog)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return catalog
+
+    def names(self, products):
+        return sorted(p['collectionName'] + '/' + p['name'] for p in products)
+
+
+class IterPagesTest(CatalogTest):
+
+    products = [catalog_product(i) for i in range(10)]
+
+    def export(self, catalog, keyset=True):
+        self.use(catalog)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return export.getProducts({'collections': ['a/b']}, keyset)
+
+    def test_keyset_paging(self):
+        catalog = FakeCatalog(self.products)
+        self.assertEqual(self.names(self.export(catalog)), self.names(self.products))
+        queries = catalog.page_queries()
+        self.assertEqual(len(queries), 4)
+        self.assertEqual([q.get('after') for q in queries], [None, 'a/b/p003', 'a/b/p007', 'a/b/p009'])
+        self.assertFalse(any('offset' in q for q in queries))
+
+    def test_falls_back_to_offset_paging(self):
+        catalog = FakeCatalog(self.products, supports_after=False)
+        self.assertEqual(self.names(self.export(catalog)), self.names(self.products))
+        self.assertEqual([q.get('offset') for q in catalog.page_queries()][2:], [4, 8, 10])
+
+    def test_offset_paging(self):
+        catalog = FakeCatalog(self.products)
+        self.assertEqual(self.names(self.export(catalog, False)), self.names(self.products))
+        self.assertEqual([q['offset'] for q in catalog.page_queries()], [0, 4, 8, 10])
+
+
+def window(start, end):
+    return [{'property': 'capturedDate', 'operation': '>=', 'value': start},
+            {'property': 'capturedDate', 'operation': '<', 'value': end}]
+
+
+class ShardTest(CatalogTest):
+
+    # Twelve products over August, six of them captured on the 10th
+    products = ([catalog_product(i, date='2016-08-%02d' % (i + 1)) for i in range(6)]
+                + [catalog_product(i, date='2016-08-10') for i in range(6, 12)])
+
+    def plan(self, catalog, query, shardProperty='capturedDate', shardSize=3):
+        self.use(catalog)
+        return export.planShards(query, shardProperty, shardSize)
+
+    def assert_partition(self, catalog, planned, products):
+        # Every product is in exactly one shard, each shard holding the products counted
+        shardNames = [self.names(catalog.matching(shard)) for (shard, _) in planned]
+        self.assertEqual([len(n) for n in shardNames], [count for (_, count) in planned])
+        self.assertEqual(sorted(n for names in shardNames for n in names), self.names(products))
+
+    def test_window_is_bisected_into_disjoint_shards(self):
+        catalog = FakeCatalog(self.products)
+        planned = self.plan(catalog, {'collections': ['a/b'], 'terms': window('2016-08-01', '2016-09-01')})
+
+        self.assertGreater(len(planned), 2)
+        self.assert_partition(catalog, planned, self.products)
+        for (shard, count) in planned:
+            (lower, upper) = export.dateWindow(shard, 'capturedDate')
+            self.assertEqual((lower['operation'], upper['operation']), ('>=', '<'))
+            oneDay = export.parseTermValue(upper['value']) - export.parseTermValue(lower['value'])
+            self.assertTrue(count <= 3 or oneDay.days == 1)
+
+    def test_single_day_is_not_split_further(self):
+        catalog = FakeCatalog(self.products)
+        planned = self.plan(catalog, {'collections': ['a/b'], 'terms': window('2016-08-10', '2016-08-11')})
+        self.assertEqual([count for (_, count) in planned], [6])
+
+    def test_query_without_a_window_is_one_shard(self):
+        catalog = FakeCatalog(self.products)
+        planned = self.plan(catalog, {'collections': ['a/b']})
+        self.assertEqual([count for (_, count) in planned], [12])
+
+    def test_collections_are_sharded_separately(self):
+        products = self.products + [catalog_product(i, 'c/d') for i in range(2)]
+        catalog = FakeCatalog(products)
+        planned = self.plan(catalog, {'collections': ['a/b', 'c/d', 'e/f'],
+                                      'terms': window('2016-08-01', '2016-09-01')})
+
+        self.assert_partition(catalog, planned, products)
+        self.assertTrue(all(len(shard['collections']) == 1 for (shard, _) in planned))
+        self.assertEqual(sorted(set(shard['collections'][0] for (shard, _) in planned)), ['a/b', 'c/d'])
+        self.assertIn(('search/product/countByCollection', mock.ANY), catalog.queries)
+
+    def test_sharded_export_yields_every_product_once(self):
+        catalog = self.use(FakeCatalog(self.products))
+        with contextlib.redirect_stdout(io.StringIO()):
+            products = list(export.iterShardedProducts(
+                {'collections': ['a/b'], 'terms': window('2016-08-01', '2016-09-01')},
+                shards=2, shardProperty='capturedDate', shardSize=3))
+        self.assertEqual(self.names(products), self.names(self.products))
+        self.assertGreater(len(catalog.page_queries()), 1)
+
+
+@unittest.skipIf(export.shapelyWkt is None, 'needs shapely')
+class TileTest(CatalogTest):
+
+    # Products along a strip, the third straddling the edge between the first two tiles
+    products = [catalog_product(i, x=x) for (i, x) in enumerate((0.0, 0.05, 0.15, 0.25))]
+    strip = 'POLYGON ((0 0, 0.4 0, 0.4 0.1, 0 0.1, 0 0))'
+
+    def test_tiles_cover_the_footprint(self):
+        from shapely.ops import unary_union
+        aoi = export.shapelyWkt.loads('POLYGON ((0 0, 0.25 0, 0.25 0.15, 0 0.15, 0 0))')
+        tiles = export.planTiles({'collections': ['a/b'], 'footprint': aoi.wkt}, 0.1)
+
+        self.assertEqual([label for (label, _) in tiles], ['r0c0', 'r0c1', 'r0c2', 'r1c0', 'r1c1', 'r1c2'])
+        polygons = [export.shapelyWkt.loads(q['footprint']) for (_, q) in tiles]
+        # The tiles cover the footprint without overlapping
+        self.assertAlmostEqual(aoi.difference(unary_union(polygons)).area, 0)
+        self.assertAlmostEqual(sum(p.area for p in polygons), aoi.area)
+
+    def test_concave_footprint_tile_is_one_query_per_polygon(self):
+        # A U whose upper tile holds the two arms apart
+        u = 'POLYGON ((0 0, 0.4 0, 0.4 0.6, 0.3 0.6, 0.3 0.2, 0.1 0.2, 0.1 0.6, 0 0.6, 0 0))'
+        tiles = export.planTiles({'collections': ['a/b'], 'footprint': u}, 0.4)
+
+        self.assertEqual([label for (label, _) in tiles], ['r0c0', 'r1c0', 'r1c0'])
+        for (_, query) in tiles:
+            self.assertEqual(export.shapelyWkt.loads(query['footprint']).geom_type, 'Polygon')
+
+    def test_tiled_shards_count_straddling_products_in_each_tile(self):
+        self.use(FakeCatalog(self.products))
+        planned = export.planTiledShards({'collections': ['a/b'], 'footprint': self.strip}, 0.2, workers=2)
+        self.assertEqual([(label, count) for (label, _, count) in planned], [('r0c0', 3), ('r0c1', 2)])
+
+    def test_straddling_products_are_exported_once(self):
+        self.use(FakeCatalog(self.products))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            products = list(export.iterShardedProducts(
+                {'collections': ['a/b'], 'footprint': self.strip}, shards=2, tileSize=0.2))
+
+        self.assertEqual(self.names(products), self.names(self.products))
+        self.assertIn('over 2 tiles of 5 products', output.getvalue())
+
+
+class FakeDownload:
+
+    def __init__(self, status_code, body=b'', etag=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {'ETag': etag} if etag else {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(response=self)
+
+
+class FakeObject:
+    # A preview in S3, answering conditional and Range requests
+
+    def __init__(self, body, etag='"v1"', honours_range=True):
+        self.body = body
+        self.etag = etag
+        self.honours_range = honours_range
+        self.requests = []
+
+    def get(self, url, headers=None, stream=False):
+        headers = headers or {}
+        self.requests.append(headers)
+        if headers.get('If-None-Match') == self.etag:
+            return FakeDownload(304)
+        if 'Range' in headers:
+            start = int(headers['Range'][len('bytes='):-1])
+            if start >= len(self.body):
+                return FakeDownload(416)
+            if self.honours_range:
+                return FakeDownload(206, self.body[start:], self.etag)
+        return FakeDownload(200, self.body, self.etag)
+
+
+def preview_product(size):
+    return {'id': 'id-p1', 'name': 'p1', 'collectionName': 'a/b',
+            'data': {'preview': {'s3': {'region': 'eu-west-1', 'bucket': 'previews',
+                                        'key': 'a/b/p1.tif', 'size': size}}}}
+
+
+class DownloadProductTest(unittest.TestCase):
+
+    body = b'0123456789' * 5
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.folder.name, 'p1.tif')
+        patcher = mock.patch.object(export, 'OUTPUT_FOLDER', self.folder.name + os.sep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def download(self, s3_object, size=None, etag=None):
+        with mock.patch.object(export, 'SESSION', s3_object):
+            return export.downloadProduct(preview_product(size or len(self.body)), 16, 3, etag)
+
+    def write(self, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_download_is_moved_into_place_whole(self):
+        self.assertEqual(self.download(FakeObject(self.body)),
+                         ('p1.tif', 'downloaded', len(self.body), '"v1"'))
+        self.assertEqual(self.read(self.output), self.body)
+        self.assertFalse(os.path.exists(self.output + '.part'))
+
+    def test_partial_download_is_resumed(self):
+        self.write(self.output + '.part', self.body[:20])
+        s3_object = FakeObject(self.body)
+
+        (_, status, transferred, _) = self.download(s3_object)
+
+        self.assertEqual((status, transferred), ('downloaded', len(self.body) - 20))
+        self.assertEqual(s3_object.requests, [{'Range': 'bytes=20-'}])
+        self.assertEqual(self.read(self.output), self.body)
+
+    def test_server_ignoring_range_is_written_from_the_start(self):
+        self.write(self.output + '.part', self.body[:20])
+        self.download(FakeObject(self.body, honours_range=False))
+        self.assertEqual(self.read(self.output), self.body)
+
+    def test_complete_partial_download_answered_416_is_kept(self):
+        self.write(self.output + '.part', self.body)
+        s3_object = FakeObject(self.body)
+
+        self.assertEqual(self.download(s3_object)[1:3], ('downloaded', 0))
+        self.assertEqual(len(s3_object.requests), 1)
+        self.assertEqual(self.read(self.output), self.body)
+
+    def test_partial_download_of_a_shrunk_file_starts_again(self):
+        # The object was replaced by a smaller one than the part already downloaded
+        self.write(self.output + '.part', b'x' * 60)
+        s3_object = FakeObject(self.body)
+
+        self.download(s3_object)
+
+        self.assertEqual(s3_object.requests, [{'Range': 'bytes=60-'}, {}])
+        self.assertEqual(self.read(self.output), self.body)
+
+    def test_short_download_keeps_part_file_and_no_final_file(self):
+        with self.assertRaises(IOError):
+            self.download(FakeObject(self.body[:30]))
+        self.assertFalse(os.path.exists(self.output))
+        self.assertEqual(self.read(self.output + '.part'), self.body[:30])
+
+    def test_oversized_download_is_discarded(self):
+        with self.assertRaises(IOError):
+            self.download(FakeObject(self.body + b'extra'))
+        self.assertFalse(os.path.exists(self.output))
+        self.assertFalse(os.path.exists(self.output + '.part'))
+
+    def test_short_file_from_an_older_download_is_resumed(self):
+        self.write(self.output, self.body[:20])
+        s3_object = FakeObject(self.body)
+        self.download(s3_object)
+        self.assertEqual(s3_object.requests, [{'Range': 'bytes=20-'}])
+        self.assertEqual(self.read(self.output), self.body)
+
+    def test_file_of_the_catalog_size_is_skipped_without_a_request(self):
+        self.write(self.output, self.body)
+        s3_object = FakeObject(self.body)
+        self.assertEqual(self.download(s3_object), ('p1.tif', 'skipped', 0, None))
+        self.assertEqual(s3_object.requests, [])
+
+    def test_unchanged_file_is_confirmed_by_etag(self):
+        self.write(self.output, self.body)
+        s3_object = FakeObject(self.body)
+        self.assertEqual(self.download(s3_object, etag='"v1"'), ('p1.tif', 'skipped', 0, '"v1"'))
+        self.assertEqual(s3_object.requests, [{'If-None-Match': '"v1"'}])
+
+    def test_changed_file_is_downloaded_again(self):
+        self.write(self.output, b'y' * len(self.body))
+        self.download(FakeObject(self.body, etag='"v2"'), etag='"v1"')
+        self.assertEqual(self.read(self.output), self.body)
+
+
+class ExportStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'state.sqlite')
+        self.preview = os.path.join(self.folder.name, 'p1.tif')
+        with open(self.preview, 'wb') as f:
+            f.write(b'preview')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def export(self, products, downloads=False, record=True):
+        # One export run, returning the names it exports and recording their downloads
+        state = ExportState(self.path)
+        exported = []
+        for p in state.filterChanged(products, downloads):
+            exported.append(p['name'])
+            if downloads and record:
+                state.recordDownload(p, self.preview, '"v1"')
+        deleted = [fullName for (_, fullName) in state.deleted()]
+        state.close()
+        return (exported, deleted)
+
+    def test_first_run_exports_everything(self):
+        self.assertEqual(self.export([product('p1'), product('p2')]), (['p1', 'p2'], []))
+
+    def test_only_new_and_changed_products_are_exported(self):
+        self.export([product('p1'), product('p2')])
+        (exported, _) = self.export([product('p1'), product('p2', 'A new title'), product('p3')])
+        self.assertEqual(exported, ['p2', 'p3'])
+
+    def test_unchanged_products_are_skipped(self):
+        self.export([product('p1')], True)
+        self.assertEqual(self.export([product('p1')], True), ([], []))
+
+    def test_missing_preview_is_exported_again(self):
+        self.export([product('p1')], True)
+        os.remove(self.preview)
+        self.assertEqual(self.export([product('p1')], True, record=False)[0], ['p1'])
+        # Without downloads only the product content matters
+        self.assertEqual(self.export([product('p1')], False)[0], [])
+
+    def test_unrecorded_download_is_exported_again(self):
+        self.export([product('p1')], True, record=False)
+        self.assertEqual(self.export([product('p1')], True)[0], ['p1'])
+
+    def test_products_not_seen_by_a_run_are_deleted(self):
+        self.export([product('p1'), product('p2'), product('p3')])
+
+        state = ExportState(self.path)
+        self.assertEqual(list(state.filterChanged([product('p2')], False)), [])
+        deleted = state.deleted()
+        self.assertEqual([fullName for (_, fullName) in deleted], ['a/b/p1', 'a/b/p3'])
+        state.forget([i for (i, _) in deleted])
+        state.close()
+
+        self.assertEqual(self.export([product('p1'), product('p2')]), (['p1'], []))
+
+    def test_download_without_etag_keeps_recorded_etag(self):
+        state = ExportState(self.path)
+        p1 = product('p1')
+        list(state.filterChanged([p1], True))
+        state.recordDownload(p1, self.preview, '"v1"')
+        state.close()
+
+        # A later run skips the file on disk by its size, learning no ETag
+        state = ExportState(self.path)
+        state.recordDownload(p1, self.preview, None)
+        self.assertEqual(state.etag(p1), '"v1"')
+
+        state.recordDownload(p1, self.preview, '"v2"')
+        self.assertEqual(state.etag(p1), '"v2"')
+        state.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
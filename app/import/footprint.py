@@ -0,0 +1,207 @@
+#pylint: disable=C0111
+"""
+Footprint normalisation for the importer
+
+Product footprints are forced to 2D MultiPolygons with counter clockwise exterior rings
+(the GeoJSON right hand rule). The functions here are module level and picklable so that
+batches of footprints can be normalised in a process pool, away from the network workers.
+With shapely >= 2.1 a batch is oriented and flattened with the vectorised shapely
+functions, otherwise each footprint is normalised on its own; both paths produce identical
+output.
+
+Normalised footprints can optionally be compacted before they are sent, rounded to a number
+of decimal places and simplified within a tolerance (which also drops duplicate and
+collinear vertices) without changing their topology, as every vertex is stored, indexed and
+returned in every search response.
+"""
+import json
+import time
+
+from shapely import errors, geometry, ops
+
+try:
+    import shapely
+    VECTORISED = hasattr(shapely, 'orient_polygons') and hasattr(shapely, 'force_2d')
+    SET_PRECISION = hasattr(shapely, 'set_precision')
+except ImportError:
+    VECTORISED = False
+    SET_PRECISION = False
+
+# Everything shapely raises for a malformed footprint (i.e. a string or a ring with too
+# few points), normalisation reports all of these as a ValueError
+GEOS_ERROR = getattr(errors, 'GEOSException', getattr(errors, 'ShapelyError', ValueError))
+INVALID_FOOTPRINT_ERRORS = (ValueError, TypeError, KeyError, AttributeError, GEOS_ERROR)
+
+
+def _to_2d(x, y, z=None):
+    return (x, y)
+
+
+def _force_2d(geom):
+    if VECTORISED:
+        return shapely.force_2d(geom)
+    return ops.transform(_to_2d, geom)
+
+
+def _as_multipolygon(geom):
+    if geom.geom_type == 'MultiPolygon':
+        return geom
+    if geom.geom_type == 'Polygon':
+        return geometry.MultiPolygon([geom])
+    raise ValueError("Geometry is not a polygon or a multipolygon")
+
+
+def _to_geojson(geom):
+    return {
+        "type": "MultiPolygon",
+        "coordinates": [geometry.mapping(g)['coordinates'] for g in geom.geoms]
+    }
+
+
+def normalise_footprint(footprint):
+    """
+    Normalise a single GeoJSON footprint, returning a new 2D GeoJSON MultiPolygon with CCW
+    exterior rings, raises a ValueError if the footprint is not a polygon or a multipolygon
+
+    Keyword arguments:
+    footprint       -- A GeoJSON Polygon or MultiPolygon
+    """
+    try:
+        geom = _as_multipolygon(geometry.shape(footprint))
+
+        # Force 2D to prevent people supplying 3D polygons randomly to the service
+        if geom.has_z:
+            geom = _force_2d(geom)
+
+        # Force the right hand rule on polygons as GeoJSON defines it, exterior rings CCW
+        geom = geometry.MultiPolygon([geometry.polygon.orient(g, sign=1.0) for g in geom.geoms])
+    except INVALID_FOOTPRINT_ERRORS as err:
+        raise ValueError(str(err) or err.__class__.__name__)
+
+    return _to_geojson(geom)
+
+
+def normalise_footprints(footprints):
+    """
+    Normalise a batch of GeoJSON footprints, returning a list of (footprint, error) tuples
+    in input order where exactly one of footprint / error is set, so that one bad footprint
+    does not fail the whole batch
+
+    Keyword arguments:
+    footprints      -- A list of GeoJSON Polygons or MultiPolygons
+    """
+    if not VECTORISED:
+        return [_normalise_or_error(f) for f in footprints]
+
+    results = [None] * len(footprints)
+    indexes = []
+    geoms = []
+
+    for (i, f) in enumerate(footprints):
+        try:
+            if f is None:
+                raise ValueError("Product has no footprint")
+            geoms.append(_as_multipolygon(geometry.shape(f)))
+            indexes.append(i)
+        except INVALID_FOOTPRINT_ERRORS as err:
+            results[i] = (None, str(err) or err.__class__.__name__)
+
+    if geoms:
+        geoms = shapely.orient_polygons(shapely.force_2d(geoms), exterior_cw=False)
+        for (i, geom) in zip(indexes, geoms):
+            results[i] = (_to_geojson(geom), None)
+
+    return results
+
+
+def _vertex_count(footprint):
+    return sum(len(ring) for polygon in footprint['coordinates'] for ring in polygon)
+
+
+def _byte_count(footprint):
+    return len(json.dumps(footprint, separators=(',', ':')))
+
+
+def _snap(geom, precision):
+    # Snap to a grid of 10^-precision degrees, vertices that land on the same point are
+    # merged and the result is kept valid
+    if SET_PRECISION:
+        return shapely.set_precision(geom, 10 ** -precision)
+    geom = ops.transform(lambda x, y, z=None: (round(x, precision), round(y, precision)), geom)
+    return geom if geom.is_valid else geom.buffer(0)
+
+
+def _round_coordinates(coordinates, precision):
+    # The snapped coordinates are binary fractions (0.30000000000000004), rounding them
+    # again gives the shortest JSON numbers
+    return [[[[round(x, precision), round(y, precision)] for (x, y) in ring]
+             for ring in polygon] for polygon in coordinates]
+
+
+def compact_footprint(footprint, precision=None, tolerance=None):
+    """
+    Compact a normalised footprint, returning (footprint, (vertices before, vertices after,
+    bytes before, bytes after)). Duplicate and collinear vertices are always dropped,
+    raises a ValueError if the footprint collapses.
+
+    Keyword arguments:
+    footprint       -- A normalised GeoJSON MultiPolygon
+    precision       -- Number of decimal places to round coordinates to, None to not round
+    tolerance       -- Topology preserving simplification tolerance in degrees, None or 0
+                       to only drop duplicate and collinear vertices
+    """
+    try:
+        geom = geometry.shape(footprint).simplify(tolerance or 0.0, preserve_topology=True)
+        if precision is not None:
+            geom = _snap(geom, precision)
+        if geom.is_empty:
+            raise ValueError('Footprint collapsed when compacted')
+        geom = geometry.MultiPolygon([geometry.polygon.orient(g, sign=1.0)
+                                      for g in _as_multipolygon(geom).geoms])
+    except INVALID_FOOTPRINT_ERRORS as err:
+        raise ValueError(str(err) or err.__class__.__name__)
+
+    compacted = _to_geojson(geom)
+    if precision is not None:
+        compacted['coordinates'] = _round_coordinates(compacted['coordinates'], precision)
+
+    return (compacted, (_vertex_count(footprint), _vertex_count(compacted),
+                        _byte_count(footprint), _byte_count(compacted)))
+
+
+def timed_normalise_footprints(footprints, compact=False, precision=None, tolerance=None):
+    """
+    normalise_footprints, optionally compacting the normalised footprints, also returning
+    how long the batch took on the worker process and the batch's compaction totals as
+    (seconds, results, [vertices before, vertices after, bytes before, bytes after])
+
+    Keyword arguments:
+    footprints      -- A list of GeoJSON Polygons or MultiPolygons
+    compact         -- Compact the footprints with compact_footprint
+    precision       -- Number of decimal places to round coordinates to
+    tolerance       -- Topology preserving simplification tolerance in degrees
+    """
+    start = time.perf_counter()
+    results = normalise_footprints(footprints)
+    totals = [0, 0, 0, 0]
+
+    if compact:
+        for (i, (normalised, error)) in enumerate(results):
+            if error is None:
+                try:
+                    (compacted, counts) = compact_footprint(normalised, precision, tolerance)
+                    results[i] = (compacted, None)
+                    totals = [t + c for (t, c) in zip(totals, counts)]
+                except ValueError as err:
+                    results[i] = (None, str(err))
+
+    return (time.perf_counter() - start, results, totals)
+
+
+def _normalise_or_error(footprint):
+    try:
+        if footprint is None:
+            raise ValueError("Product has no footprint")
+        return (normalise_footprint(footprint), None)
+    except ValueError as err:
+        return (None, str(err))
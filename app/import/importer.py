@@ -1,11 +1,280 @@
 #pylint: disable=C0111
 from urllib.parse import urljoin
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 import argparse
+import glob
 import json
+import os
+import sys
+import threading
+import time
 import uuid
 import requests
 
-from shapely import geometry,wkt,ops
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import codec  # pylint: disable=C0413
+import footprint  # pylint: disable=C0413
+import schema_cache  # pylint: disable=C0413
+import flow_control  # pylint: disable=C0413
+import http_client  # pylint: disable=C0413
+import instrumentation  # pylint: disable=C0413
+import pg_loader  # pylint: disable=C0413
+
+READ_CHUNK_SIZE = 64 * 1024
+NUMBER_CHARS = '0123456789.eE+-'
+GEOMETRY_BATCH_SIZE = 256
+EXISTENCE_CHECK_PAGE_SIZE = 1000
+# Product files read from at once in a manifest import
+FILES_IN_FLIGHT = 8
+PROGRESS_INTERVAL = 10
+
+
+def iter_json_array(input_file_stream, chunk_size=READ_CHUNK_SIZE):
+    """
+    Incrementally read a top level JSON array, yielding one decoded element at a time so
+    that only the element currently being decoded is held in memory
+
+    Keyword arguments:
+    input_file_stream   -- A text file stream positioned at the start of the array
+    chunk_size          -- Number of characters to read from the stream at a time
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill(buf, pos):
+        chunk = input_file_stream.read(chunk_size)
+        return buf[pos:] + chunk, 0, not chunk
+
+    def skip_whitespace(buf, pos, eof):
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf, pos, eof
+            buf, pos, eof = fill(buf, pos)
+
+    buf, pos, eof = skip_whitespace(buf, pos, eof)
+    if buf[pos:pos + 1] != '[':
+        raise ValueError('Input is not a JSON array')
+    pos += 1
+
+    expect_value = True
+    while True:
+        buf, pos, eof = skip_whitespace(buf, pos, eof)
+        if pos >= len(buf):
+            raise ValueError('Unexpected end of input, JSON array is not closed')
+
+        if buf[pos] == ']':
+            return
+        if not expect_value:
+            if buf[pos] != ',':
+                raise ValueError('Expected "," or "]" in JSON array at offset %d' % pos)
+            pos += 1
+            expect_value = True
+            continue
+
+        # Only trust a decoded value once we can see past the end of it, or there is
+        # nothing more to read. A number cut off at the end of a chunk decodes as a prefix
+        # of itself (i.e. "1." as 1), so also read on while the next character could
+        # continue the number.
+        while True:
+            try:
+                (item, end) = decoder.raw_decode(buf, pos)
+                if eof or (end < len(buf) and not (
+                        isinstance(item, (int, float)) and not isinstance(item, bool)
+                        and buf[end] in NUMBER_CHARS)):
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            buf, pos, eof = fill(buf, pos)
+
+        pos = end
+        expect_value = False
+        yield item
+
+
+def iter_json_lines(input_file_stream):
+    """
+    Read a JSON Lines stream (one JSON document per line), yielding one decoded document
+    at a time with the shared codec, blank lines are ignored
+
+    Keyword arguments:
+    input_file_stream   -- A text file stream
+    """
+    for (line_number, line) in enumerate(input_file_stream, 1):
+        line = line.strip()
+        if line:
+            try:
+                yield codec.loads(line)
+            except codec.DecodeError as err:
+                raise ValueError('Invalid JSON on line %d: %s' % (line_number, err))
+
+
+def iter_products(input_file_stream):
+    """
+    Yield products one at a time from either a JSON array or a JSON Lines stream, the
+    format is detected from the first non whitespace character of the input
+
+    Keyword arguments:
+    input_file_stream   -- A text file stream
+    """
+    first = input_file_stream.read(1)
+    while first and first.isspace():
+        first = input_file_stream.read(1)
+
+    input_file_stream.seek(0)
+
+    if first == '[':
+        return iter_json_array(input_file_stream)
+    return iter_json_lines(input_file_stream)
+
+
+def iter_product_file(path):
+    """
+    Yield products one at a time from a JSON array or JSON Lines file, the file is only
+    opened once the first product is asked for
+
+    Keyword arguments:
+    path                -- The path to the product file
+    """
+    with open(path, 'r') as input_file_stream:
+        yield from iter_products(input_file_stream)
+
+
+def interleave(iterators, width):
+    """
+    Yield from several iterators in turn, one item at a time, with at most `width` of them
+    started at once, the next iterator is started as one runs out
+
+    Keyword arguments:
+    iterators           -- An iterable of iterators, i.e. iter_product_file generators
+    width               -- Number of iterators to take items from in turn
+    """
+    waiting = iter(iterators)
+    active = deque()
+
+    for iterator in waiting:
+        active.append(iterator)
+        if len(active) >= width:
+            break
+
+    while active:
+        iterator = active.popleft()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            following = next(waiting, None)
+            if following is not None:
+                active.append(following)
+            continue
+        active.append(iterator)
+        yield item
+
+
+def read_manifest(path):
+    """
+    Read an import manifest, a JSON object listing collection files and product files by
+    path or glob pattern relative to the manifest, returning (collection file paths, product
+    file paths), raises a ValueError if an entry matches no files
+
+        {"collections": ["collections/ogc.json"], "products": ["data/ogc/*.json"]}
+
+    Keyword arguments:
+    path                -- The path to the manifest
+    """
+    with open(path, 'rb') as manifest_file:
+        manifest = codec.load(manifest_file)
+
+    if not isinstance(manifest, dict) or not set(manifest) <= set(['collections', 'products']):
+        raise ValueError('Manifest %s should be an object with "collections" and / or '
+                         '"products" lists' % path)
+
+    base = os.path.dirname(os.path.abspath(path))
+    resolved = ([], [])
+
+    for (key, paths) in zip(('collections', 'products'), resolved):
+        for pattern in manifest.get(key) or []:
+            matches = sorted(glob.glob(os.path.join(base, pattern)))
+            if not matches:
+                raise ValueError('Manifest %s %s entry %s matches no files' % (path, key, pattern))
+            paths.extend(m for m in matches if m not in paths)
+
+    return resolved
+
+
+def read_collections(path):
+    """
+    Read a collection file, a JSON collection or an array of them, each with an optional
+    list of its products
+
+    Keyword arguments:
+    path                -- The path to the collection file
+    """
+    with open(path, 'rb') as collection_file:
+        collections = codec.load(collection_file)
+
+    if isinstance(collections, dict):
+        collections = [collections]
+    if not isinstance(collections, list) or not all(isinstance(c, dict) for c in collections):
+        raise ValueError('Collection file %s should hold a collection or an array of them' % path)
+
+    return collections
+
+
+class ImportJournal:
+    """
+    Append only JSON Lines record of the outcome of each product import, used to resume an
+    interrupted import without re-posting the products that were already imported
+
+    Keyword arguments:
+    path            -- The path to the journal file, created if it does not exist
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = set()
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, 'r') as journal_stream:
+                for entry in iter_json_lines(journal_stream):
+                    key = (entry['collectionName'], entry['name'])
+                    if entry['ok']:
+                        self.completed.add(key)
+                    else:
+                        self.completed.discard(key)
+
+        self._stream = open(path, 'ab')
+
+    def record(self, product, ok, message):
+        """
+        Record the outcome of a product import, flushed immediately so the journal survives
+        the importer being killed
+
+        Keyword arguments:
+        product         -- The JSON blob that was imported
+        ok              -- If the product was imported
+        message         -- The new product id or the reason the import failed
+        """
+        entry = {
+            'collectionName': product.get('collectionName'),
+            'name': product.get('name'),
+            'ok': ok,
+            'message': message
+        }
+
+        with self._lock:
+            self._stream.write(codec.dumps(entry) + b'\n')
+            self._stream.flush()
+            if ok:
+                self.completed.add((entry['collectionName'], entry['name']))
+
+    def close(self):
+        self._stream.close()
 
 
 class Importer:
@@ -14,15 +283,83 @@ class Importer:
 
     Keyword arguments:
     api_base_url        -- The base URL of the API supporting this catalog
-    input_file_path     -- The path for the input JSON blob
+    input_file_path     -- The path for the input JSON array or JSON Lines file of products,
+                           the JSON collection file or the manifest
     product_import      -- If this is a product or collection import
-    multi_polygon       -- Set to force product footprints to MutliPolygon, true by default
+    workers             -- Maximum number of products in flight against the API at once
+    session             -- A shared http_client session, a pooled one is created if not given
+    batch_size          -- Number of products to send per request to the bulk /add/products
+                           route, 1 (the default) uses the single product routes
+    geometry_workers    -- Number of processes to normalise footprints on, 0 (the default)
+                           normalises each footprint on the network worker importing it
+    journal_path        -- Path of the journal recording each product's outcome, defaults
+                           to the input file path with a .journal suffix
+    resume              -- Skip products the journal records as already imported
+    skip_existing       -- Skip products whose name already exists in their collection,
+                           checked with one paged /search/product sweep per collection
+    server_validation   -- Always validate products with the /validate/product route rather
+                           than against the collection schemas in process
+    metrics             -- A shared instrumentation.Instrumentation to time the import's
+                           stages with, one that is never reported is created if not given
+    loader              -- A pg_loader.PostgisLoader to load the products straight into the
+                           database with rather than through the API (direct mode), batches
+                           of batch_size products are loaded one at a time
+    precision           -- Round footprint coordinates to this many decimal places
+    simplify_tolerance  -- Simplify footprints within this tolerance in degrees, keeping their
+                           topology. When either is set duplicate and collinear footprint
+                           vertices are dropped too.
+    manifest            -- The input file is a manifest of collection and product files, see
+                           read_manifest
+    progress_interval   -- Print the run's progress every this many seconds, 0 for never
     """
 
-    def __init__(self, api_base_url, input_file_path, product_import=False):
+    def __init__(self, api_base_url, input_file_path, product_import=False, workers=1,
+                 session=None, batch_size=1, geometry_workers=0, journal_path=None,
+                 resume=False, skip_existing=False, server_validation=False, metrics=None,
+                 loader=None, precision=None, simplify_tolerance=None, manifest=False,
+                 progress_interval=PROGRESS_INTERVAL):
         self.api_base_url = api_base_url
         self.input_file_path = input_file_path
         self.product_import = product_import
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.geometry_workers = max(0, geometry_workers)
+        self.journal_path = journal_path or '%s.journal' % input_file_path
+        self.resume = resume
+        self.skip_existing = skip_existing
+        self.journal = None
+        self.skipped = 0
+        self.manifest = manifest
+        self.progress_interval = progress_interval
+        # Products imported / failed / skipped per collection, and the collections added
+        self.tally = {}
+        self.collection_results = []
+        self.failed_collections = set()
+        self._tally_lock = threading.Lock()
+        self._started = None
+        self._last_progress = None
+        self.precision = precision
+        self.simplify_tolerance = simplify_tolerance
+        self.compact = precision is not None or simplify_tolerance is not None
+        # Footprint vertices before / after and bytes before / after compaction
+        self.compaction = [0, 0, 0, 0]
+        self._compaction_lock = threading.Lock()
+        self._existing = {}
+        self.session = session or http_client.create_session(
+            pool_size=max(self.workers, http_client.DEFAULT_POOL_SIZE))
+        self.metrics = metrics or instrumentation.Instrumentation()
+        self.loader = loader
+        self.schemas = None
+        if loader is not None:
+            if schema_cache.SchemaCache.available():
+                self.schemas = pg_loader.DatabaseSchemaCache(loader)
+            else:
+                print('jsonschema is not installed, products will not be validated')
+        elif not server_validation:
+            if schema_cache.SchemaCache.available():
+                self.schemas = schema_cache.SchemaCache(self.session, self.api_base_url)
+            else:
+                print('jsonschema is not installed, validating products on the server')
 
     @staticmethod
     def uuid_str_valid(uuid_str):
@@ -39,121 +376,777 @@ class Importer:
         except ValueError:
             return False
 
-    def import_product(self, product):
-        """        self.multi_polygon = multi_polygon
-        Import a single product from a JSON blob
+    def fix_footprint(self, product):
+        """
+        Normalise a product footprint in place to a 2D MultiPolygon with CCW exterior rings,
+        raises a ValueError if the footprint is not a polygon or a multipolygon
+
+        Keyword arguments:
+        product         -- A JSON blob containing a GeoJSON footprint
+        """
+        if product.get('footprint') is None:
+            raise ValueError('Product %s has no footprint' % product.get('name', '<unnamed>'))
+
+        try:
+            with self.metrics.stage('normalise'):
+                product['footprint'] = footprint.normalise_footprint(product['footprint'])
+            if self.compact:
+                with self.metrics.stage('compact'):
+                    (product['footprint'], counts) = footprint.compact_footprint(
+                        product['footprint'], self.precision, self.simplify_tolerance)
+                self._record_compaction(counts)
+        except ValueError as err:
+            raise ValueError('Product %s footprint could not be normalised: %s'
+                             % (product.get('name', '<unnamed>'), err))
+
+    def _record_compaction(self, counts):
+        with self._compaction_lock:
+            self.compaction = [t + c for (t, c) in zip(self.compaction, counts)]
+        for (name, count) in zip(('footprint_vertices_before', 'footprint_vertices_after',
+                                  'footprint_bytes_before', 'footprint_bytes_after'), counts):
+            self.metrics.count(name, count)
+
+    def print_compaction(self):
+        """
+        Print the footprint vertex and byte counts before and after compaction
+        """
+        (vertices_before, vertices_after, bytes_before, bytes_after) = self.compaction
+        print('Footprints compacted from %d to %d vertices (%.1f%%) and %d to %d bytes (%.1f%%)'
+              % (vertices_before, vertices_after,
+                 100.0 * vertices_after / vertices_before if vertices_before else 100.0,
+                 bytes_before, bytes_after,
+                 100.0 * bytes_after / bytes_before if bytes_before else 100.0))
+
+    def _normalised_products(self, products, results):
+        """
+        Normalise product footprints in batches on a process pool, a few batches ahead of
+        the network workers, yielding the products in input order. Products whose footprint
+        cannot be normalised are recorded as failures in results and not yielded.
+
+        Keyword arguments:
+        products        -- An iterable of JSON blobs to import as products
+        results         -- The list of (product name, ok, message) tuples for this run
+        """
+        with ProcessPoolExecutor(max_workers=self.geometry_workers) as pool:
+            pending = deque()
+
+            def drain():
+                (batch, future) = pending.popleft()
+                (seconds, fixed_batch, counts) = future.result()
+                self.metrics.record('normalise_batch', seconds)
+                if self.compact:
+                    self._record_compaction(counts)
+                for (product, (fixed, error)) in zip(batch, fixed_batch):
+                    if error is None:
+                        product['footprint'] = fixed
+                        yield product
+                    else:
+                        results.append(self._failure(product, ValueError(
+                            'Product %s footprint could not be normalised: %s'
+                            % (product.get('name', '<unnamed>'), error))))
+
+            for batch in self._batches(products, GEOMETRY_BATCH_SIZE):
+                pending.append((batch, pool.submit(footprint.timed_normalise_footprints,
+                                                   [p.get('footprint') for p in batch],
+                                                   self.compact, self.precision,
+                                                   self.simplify_tolerance)))
+                if len(pending) > 2 * self.geometry_workers:
+                    yield from drain()
+
+            while pending:
+                yield from drain()
+
+    def client_validate(self, product):
+        """
+        Validate a product in process against its collection's products schema, returning a
+        list of errors or None if it can only be validated on the server
 
         Keyword arguments:
         product         -- A JSON blob to import as a product
         """
-        ###
-        # General footprint fixing stuff
-        ###
-        geom = geometry.shape(product['footprint'])
+        if not self.schemas:
+            return None
 
-        # Use PostGIS to force Multipolygon if needed
-        if geom.type != 'MultiPolygon':
+        with self.metrics.stage('validate'):
+            return self.schemas.validate(product)
 
-            geom = geometry.MultiPolygon([geom])
+    def validate_product(self, product):
+        """
+        Validate a product before it is sent, in process against its collection's products
+        schema where possible and otherwise with the /validate/product route, raises a
+        ValueError if the product is invalid
 
-        # Use PostGIS to force Right Hand Rule on polygons as GeoJSON defines it (PostGIS
-        # ST_ForceRHR produces exterior rings as CW, we need CCW so need to ST_Reverse as
-        # well). Also force 2D to prevent people supplying 3D polygons randomly to the
-        # service
+        Keyword arguments:
+        product         -- A JSON blob to import as a product
+        """
+        errors = self.client_validate(product)
 
-        if geom.has_z:
-            geom = ops.transform(geometry.GridService._to_2d, geom)
+        if errors is None:
+            with self.metrics.stage('validate_request'):
+                resp = self.session.post('%s/validate/product' %
+                                         self.api_base_url, json=product)
 
-        if (isinstance(geom, geometry.polygon.Polygon)):
-            geom = geometry.polygon.orient(geom)
-        elif (isinstance(geom, geometry.multipolygon.MultiPolygon)):
-            geom = [geometry.polygon.orient(g, sign=1.0) for g in geom.geoms]
-            geom = geometry.MultiPolygon(geom)
-        else:
-            raise ValueError("Geometry is not a polygon or a multipolygon")
+            if not resp.ok:
+                raise ValueError('Product %s was not validated, error returned from API: %s'
+                                 % (product['name'], resp.text))
+        elif errors:
+            raise ValueError('Product %s was not validated: %s'
+                             % (product.get('name', '<unnamed>'), json.dumps(errors)))
 
-        product['footprint'] = {
-            "type": "MultiPolygon",
-            "coordinates": [geometry.mapping(g)['coordinates'] for g in geom.geoms]
-        }
+    def import_product(self, product, normalise=True):
+        """
+        Import a single product from a JSON blob, the product is validated before it is
+        added, raises a ValueError if either step fails
 
+        Keyword arguments:
+        product         -- A JSON blob to import as a product
+        normalise       -- Normalise the footprint first, False if it already has been
+        """
+        ###
+        # General footprint fixing stuff
+        ###
+        if normalise:
+            self.fix_footprint(product)
+
+        self.validate_product(product)
 
         ###
         # Push product to import API
         ###
-        resp = requests.post('%s/validate/product' %
-                             self.api_base_url, json=product)
+        with self.metrics.stage('add_request'):
+            resp = self.session.post('%s/add/product' %
+                                     self.api_base_url, json=product)
         # resp = requests.post('%s/validate' %
         #                      self.api_base_url, json=product)
 
         if not resp.ok:
-            raise ValueError('Product %s was not validated, error returned from API: %s'
+            raise ValueError('Product %s was not imported, error returned from API: %s'
                              % (product['name'], resp.text))
+        else:
+            print('New id %s' % resp.text)
 
+        return resp.text
 
-        resp = requests.post('%s/add/product' %
-                             self.api_base_url, json=product)
-        # resp = requests.post('%s/validate' %
-        #                      self.api_base_url, json=product)
+    def import_batch(self, products, normalise=True):
+        """
+        Import a batch of products with a single request to the bulk /add/products route,
+        which validates every product and stores them in one transaction. Products the API
+        rejects as invalid or as already existing are reported against their names and the
+        rest of the batch is resubmitted. A batch rejected as a whole (too many products or
+        too large a body) is reported as failed, any other error falls back to importing
+        each product on its own so the failing products can be identified. Returns a list
+        of (product name, ok, message) tuples.
 
-        if not resp.ok:
-            raise ValueError('Product %s was not imported, error returned from API: %s'
-                             % (product['name'], resp.text))
+        Keyword arguments:
+        products        -- A list of JSON blobs to import as products
+        normalise       -- Normalise the footprints first, False if they already have been
+        """
+        results = []
+        pending = []
+
+        for product in products:
+            try:
+                if normalise:
+                    self.fix_footprint(product)
+                # Catch what can be caught before sending the batch, /add/products still
+                # validates every product on the server
+                errors = self.client_validate(product)
+                if errors:
+                    raise ValueError('Product %s was not validated: %s'
+                                     % (product.get('name', '<unnamed>'), json.dumps(errors)))
+                pending.append(product)
+            except (KeyError, ValueError) as err:
+                results.append(self._failure(product, err))
+
+        while pending:
+            with self.metrics.stage('add_batch_request'):
+                resp = self.session.post('%s/add/products' % self.api_base_url, json=pending)
+
+            if resp.ok:
+                for (product, item) in zip(pending, http_client.response_json(resp)['results']):
+                    print('New id %s' % item['productId'])
+                    results.append(self._success(product, str(item['productId'])))
+                break
+
+            body = self._json_or_none(resp)
+
+            if resp.status_code == 400 and body and 'results' in body:
+                checked = list(zip(pending, body['results']))
+                rejected = [(product, item) for (product, item) in checked if not item['valid']]
+
+                if rejected:
+                    for (product, item) in rejected:
+                        results.append(self._failure(product, ValueError(
+                            'Product %s was not validated, error returned from API: %s'
+                            % (item['productName'], json.dumps(item['validationErrors'])))))
+                    pending = [product for (product, item) in checked if item['valid']]
+                    continue
+
+            if resp.status_code == 409 and body and 'duplicates' in body:
+                duplicates = set((d['collectionName'], d['productName'])
+                                 for d in body['duplicates'])
+                clashing = [product for product in pending
+                            if (product.get('collectionName'), product.get('name')) in duplicates]
+
+                if clashing:
+                    for product in clashing:
+                        results.append(self._failure(product, ValueError(
+                            'Product %s was not imported, it already exists in collection %s'
+                            % (product['name'], product['collectionName']))))
+                    pending = [product for product in pending
+                               if (product.get('collectionName'), product.get('name'))
+                               not in duplicates]
+                    continue
+
+            if resp.status_code in (400, 413):
+                # The batch itself was rejected (too many products or too large a body),
+                # sending the products one at a time would hide a bad --batch-size
+                for product in pending:
+                    results.append(self._failure(product, ValueError(
+                        'Product %s was not imported, the batch of %d products was rejected '
+                        '(HTTP %d), try a smaller --batch-size: %s'
+                        % (product.get('name', '<unnamed>'), len(pending), resp.status_code,
+                           resp.text))))
+                break
+
+            results.extend(self._import_one(product, False) for product in pending)
+            break
+
+        return results
+
+    @staticmethod
+    def _json_or_none(resp):
+        try:
+            return http_client.response_json(resp)
+        except ValueError:
+            return None
+
+    def _count(self, product, outcome):
+        # outcome is 0 imported, 1 failed or 2 skipped
+        with self._tally_lock:
+            counts = self.tally.setdefault(product.get('collectionName'), [0, 0, 0])
+            counts[outcome] += 1
+
+    def _success(self, product, message):
+        self.metrics.count('products_imported')
+        self._count(product, 0)
+        if self.journal:
+            self.journal.record(product, True, message)
+        return (product.get('name', '<unnamed>'), True, message)
+
+    def _failure(self, product, err):
+        print(err, file=sys.stderr)
+        self.metrics.count('products_failed')
+        self._count(product, 1)
+        if self.journal:
+            self.journal.record(product, False, str(err))
+        return (product.get('name', '<unnamed>'), False, str(err))
+
+    def _skip(self, product):
+        self.skipped += 1
+        self._count(product, 2)
+
+    def _import_one(self, product, normalise=True):
+        """
+        Import a single product, returning a (product name, ok, message) tuple rather than
+        raising on failure
+
+        Keyword arguments:
+        product         -- A JSON blob to import as a product
+        normalise       -- Normalise the footprint first, False if it already has been
+        """
+        try:
+            return self._success(product, self.import_product(product, normalise))
+        except (KeyError, ValueError) as err:
+            return self._failure(product, err)
+        except requests.exceptions.RequestException as err:
+            return self._failure(product, ValueError(
+                'Product %s could not be sent to the API: %s'
+                % (product.get('name', '<unnamed>'), err)))
+
+    def existing_product_names(self, collection_name):
+        """
+        Get the names of every product already in a collection, fetched once per collection
+        by paging through /search/product with the after cursor, so each page costs the
+        catalog the same however deep into the collection it is
+
+        Keyword arguments:
+        collection_name -- The full name of the collection
+        """
+        if collection_name not in self._existing:
+            names = set()
+            query = {'collections': [collection_name], 'limit': EXISTENCE_CHECK_PAGE_SIZE}
+            keyset = True
+            offset = 0
+
+            while True:
+                with self.metrics.stage('existing_page_request'):
+                    resp = self.session.post('%s/search/product' % self.api_base_url,
+                                             json=query)
+
+                if not resp.ok:
+                    raise ValueError('Could not list products in collection %s, error '
+                                     'returned from API: %s' % (collection_name, resp.text))
+
+                page = http_client.response_json(resp)['result']
+
+                # A page of names already seen means the catalog ignored the after parameter
+                # (it predates it), carry on with offset paging
+                if keyset and page and all(p['name'] in names for p in page):
+                    keyset = False
+                    query.pop('after')
+                    query['offset'] = offset
+                    continue
+
+                names.update(p['name'] for p in page)
+
+                if len(page) < EXISTENCE_CHECK_PAGE_SIZE:
+                    break
+                offset += len(page)
+                if keyset:
+                    query['after'] = page[-1]['collectionName'] + '/' + page[-1]['name']
+                else:
+                    query['offset'] = offset
+
+            print('%d products already in %s' % (len(names), collection_name))
+            self._existing[collection_name] = names
+
+        return self._existing[collection_name]
+
+    def _unimported_products(self, products):
+        """
+        Skip products that the journal records as imported (when resuming) or that already
+        exist in their collection (when skipping existing products), without any per
+        product network call
+
+        Keyword arguments:
+        products        -- An iterable of JSON blobs to import as products
+        """
+        for product in products:
+            key = (product.get('collectionName'), product.get('name'))
+
+            if self.resume and key in self.journal.completed:
+                self._skip(product)
+                continue
+
+            if self.skip_existing and key[0] and key[1] in self.existing_product_names(key[0]):
+                self.journal.record(product, True, 'already exists')
+                self._skip(product)
+                continue
+
+            yield product
+
+    def _collection_created(self, products, results):
+        """
+        Fail the products of collections that could not be added without sending them
+
+        Keyword arguments:
+        products        -- An iterable of JSON blobs to import as products
+        results         -- The list of (product name, ok, message) tuples for this run
+        """
+        for product in products:
+            if product.get('collectionName') in self.failed_collections:
+                results.append(self._failure(product, ValueError(
+                    'Product %s was not imported, collection %s could not be added'
+                    % (product.get('name', '<unnamed>'), product['collectionName']))))
+            else:
+                yield product
+
+    def report_progress(self):
+        """
+        Print the products imported, failed and skipped so far across every input file, at
+        most once per progress interval
+        """
+        now = time.monotonic()
+        if not self.progress_interval or now - self._last_progress < self.progress_interval:
+            return
+        self._last_progress = now
+
+        with self._tally_lock:
+            totals = [sum(counts) for counts in zip(*self.tally.values())] or [0, 0, 0]
+        elapsed = now - self._started
+        print('Progress: %d imported, %d failed, %d skipped in %.0fs (%.1f products/s)'
+              % (totals[0], totals[1], totals[2], elapsed, sum(totals) / elapsed if elapsed else 0))
+
+    @staticmethod
+    def _batches(products, batch_size):
+        batch = []
+        for product in products:
+            batch.append(product)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _import_products(self, products):
+        """
+        Import an iterable of products, keeping at most `self.workers` products (or batches
+        of products when `self.batch_size` is above 1) in flight at once. Each product is
+        still validated before it is added, failures are recorded rather than stopping the
+        run. When `self.geometry_workers` is set footprints are normalised on a separate
+        process pool ahead of the network workers. Returns a list of (product name, ok,
+        message) tuples in completion order.
+
+        Keyword arguments:
+        products        -- An iterable of JSON blobs to import as products
+        """
+        results = []
+        normalise = self.geometry_workers == 0
+
+        if self.resume or (self.skip_existing and not self.loader):
+            products = self._unimported_products(products)
+
+        if not normalise:
+            products = self._normalised_products(products, results)
+
+        if self.failed_collections:
+            products = self._collection_created(products, results)
+
+        if self.loader:
+            # One connection, the batches are loaded in turn on this thread
+            for batch in self._batches(products, self.batch_size):
+                results.extend(self.load_batch(batch, normalise))
+                self.report_progress()
+            return results
+
+        if self.batch_size > 1:
+            units = self._batches(products, self.batch_size)
+            import_unit = lambda batch: self._import_batch_safely(batch, normalise)
         else:
-            print('New id %s' % resp.text)
+            units = products
+            import_unit = lambda product: [self._import_one(product, normalise)]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            in_flight = set()
+
+            for unit in units:
+                if len(in_flight) >= self.workers:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results.extend(future.result())
+                    self.report_progress()
+
+                in_flight.add(executor.submit(import_unit, unit))
+
+            for future in wait(in_flight).done:
+                results.extend(future.result())
+
+        return results
+
+    def load_batch(self, products, normalise=True):
+        """
+        Load a batch of products straight into the database with the direct mode loader,
+        products that fail footprint normalisation or validation are reported and the rest
+        loaded together. Products that already exist are updated, or skipped when skipping
+        existing products. Returns a list of (product name, ok, message) tuples.
+
+        Keyword arguments:
+        products        -- A list of JSON blobs to import as products
+        normalise       -- Normalise the footprints first, False if they already have been
+        """
+        results = []
+        pending = []
+
+        for product in products:
+            try:
+                if normalise:
+                    self.fix_footprint(product)
+                errors = self.client_validate(product)
+                if errors:
+                    raise ValueError('Product %s was not validated: %s'
+                                     % (product.get('name', '<unnamed>'), json.dumps(errors)))
+                pending.append(product)
+            except (KeyError, ValueError) as err:
+                results.append(self._failure(product, err))
+
+        if not pending:
+            return results
+
+        try:
+            loaded = self.loader.load(pending)
+        except pg_loader.psycopg2.Error as err:
+            self.loader.connection.rollback()
+            return results + [self._failure(product, ValueError(
+                'Product %s could not be loaded into the database: %s'
+                % (product.get('name', '<unnamed>'), str(err).strip()))) for product in pending]
+
+        for (product, status, message) in loaded:
+            if status == 'stored':
+                print('New id %s' % message)
+                results.append(self._success(product, message))
+            elif status == 'exists':
+                self.journal.record(product, True, message)
+                self._skip(product)
+            else:
+                results.append(self._failure(product, ValueError(message)))
+
+        return results
+
+    def _import_batch_safely(self, products, normalise=True):
+        try:
+            return self.import_batch(products, normalise)
+        except requests.exceptions.RequestException as err:
+            return [self._failure(product, ValueError(
+                'Product %s could not be sent to the API: %s'
+                % (product.get('name', '<unnamed>'), err))) for product in products]
+
+    @staticmethod
+    def print_summary(results, skipped=0):
+        """
+        Print a per product success / failure summary of an import run
+
+        Keyword arguments:
+        results         -- A list of (product name, ok, message) tuples
+        skipped         -- The number of products skipped as already imported
+        """
+        failed = [r for r in results if not r[1]]
+
+        print('')
+        print('Import summary')
+        print('==============')
+        for (name, ok, _) in results:
+            print('%s %s' % ('OK    ' if ok else 'FAILED', name))
+        print('')
+        print('%d products imported, %d failed, %d skipped as already imported'
+              % (len(results) - len(failed), len(failed), skipped))
+
+        for (name, _, message) in failed:
+            print('  %s: %s' % (name, message))
+
+
+    def import_collection(self, collection):
+        """
+        Add a collection from a JSON blob, without its products, with the /add/collection
+        route or in direct mode straight into the database (unvalidated). A collection that
+        already exists is left as it is. Returns a (collection name, ok, message) tuple.
+
+        Keyword arguments:
+        collection      -- A JSON blob to import as a collection
+        """
+        name = collection.get('name', '<unnamed>')
+
+        try:
+            if self.loader:
+                try:
+                    (collection_id, created) = self.loader.create_collection(collection)
+                except pg_loader.psycopg2.Error as err:
+                    self.loader.connection.rollback()
+                    raise ValueError('Collection %s was not imported, error returned from the '
+                                     'database: %s' % (name, str(err).strip()))
+            else:
+                with self.metrics.stage('add_collection_request'):
+                    resp = self.session.post('%s/add/collection' % self.api_base_url,
+                                             json=collection)
+                body = self._json_or_none(resp)
+                created = resp.ok
 
+                if resp.status_code == 409 and body and 'collectionId' in body:
+                    collection_id = body['collectionId']
+                elif resp.ok:
+                    collection_id = body['collectionId']
+                else:
+                    raise ValueError('Collection %s was not imported, error returned from API: %s'
+                                     % (name, resp.text))
+        except (KeyError, TypeError, ValueError, requests.exceptions.RequestException) as err:
+            print(err, file=sys.stderr)
+            self.failed_collections.add(name)
+            return (name, False, str(err))
 
-    # Not yet implemented.
-    # def import_collection(self, collection):
-    #     """
-    #     Import a collection from a JSON blob
+        message = '%s %s' % ('created with id' if created else 'already exists with id',
+                             collection_id)
+        print('Collection %s %s' % (name, message))
+        return (name, True, message)
 
-    #     Keyword arguments:
-    #     collection      -- A JSON blob to import as a collection
-    #     """
-    #     products = collection['products']
-    #     del collection['products']
+    def _import_sources(self, collection_paths, product_paths):
+        """
+        Add the collections in the collection files, then import their products and those of
+        the product files on the one pool of workers, taking products from up to
+        FILES_IN_FLIGHT files in turn so every file progresses together
+
+        Keyword arguments:
+        collection_paths -- Paths of JSON collection files
+        product_paths   -- Paths of JSON array or JSON Lines product files
+        """
+        sources = []
 
-    #     resp = requests.post(
-    #         urljoin(self.api_base_url, '/add/collection'), data=collection)
-    #     if not resp.ok:
-    #         raise ValueError('Product %s was not imported, error returned from API: %s'
-    #                          % (collection['metadata']['title'], resp.text()))
+        for path in collection_paths:
+            for collection in read_collections(path):
+                products = collection.pop('products', None) or []
+                self.collection_results.append(self.import_collection(collection))
+                for product in products:
+                    product['collectionName'] = collection.get('name')
+                sources.append(iter(products))
 
-    #     json_resp = json.loads(resp.text)
+        sources.extend(iter_product_file(path) for path in product_paths)
 
-    #     for product in products:
-    #         product['collectionName'] = json_resp['name']
-    #         self.import_product(product)
+        return self._import_products(
+            self.metrics.timed_iter(interleave(sources, FILES_IN_FLIGHT), 'parse'))
+
+    def print_collection_summary(self):
+        """
+        Print the collections added and the products imported, failed and skipped in each
+        collection
+        """
+        if self.collection_results:
+            print('')
+            print('Collections')
+            print('===========')
+            for (name, ok, message) in self.collection_results:
+                print('%s %s: %s' % ('OK    ' if ok else 'FAILED', name, message))
+
+        print('')
+        print('Products by collection')
+        print('======================')
+        for (name, counts) in sorted(self.tally.items(), key=lambda t: str(t[0])):
+            print('%s: %d imported, %d failed, %d skipped' % ((name,) + tuple(counts)))
 
     def do_import(self):
         """
         Perform an import using the config information supplied to this importer from the
         __init__ method
         """
-        with open(self.input_file_path, 'r') as input_file_stream:
-            inputs = json.load(input_file_stream)
-
-        if self.product_import:
-            for product in inputs:
-                self.import_product(product)
+        if self.manifest:
+            (collection_paths, product_paths) = read_manifest(self.input_file_path)
+        elif self.product_import:
+            (collection_paths, product_paths) = ([], [self.input_file_path])
         else:
-            raise NotImplementedError()
+            (collection_paths, product_paths) = ([self.input_file_path], [])
+
+        self.journal = ImportJournal(self.journal_path)
+        self._started = self._last_progress = time.monotonic()
+
+        if self.loader:
+            self.loader.start()
+
+        try:
+            results = self._import_sources(collection_paths, product_paths)
+        finally:
+            # Deferred indexes are rebuilt however the load ends
+            if self.loader:
+                self.loader.finish()
+            self.journal.close()
+
+        self.metrics.count('products_skipped', self.skipped)
+        self.print_summary(results, self.skipped)
+        if collection_paths or len(product_paths) > 1:
+            self.print_collection_summary()
+        if self.compact:
+            self.print_compaction()
+
+        return self.collection_results + results
 
 
 if __name__ == '__main__':
     PARSER = argparse.ArgumentParser(
         description='Imports a JSON blob into the catalog')
     PARSER.add_argument('-i', '--input', type=str,
-                        required=True, help='Path to json input file')
-    PARSER.add_argument('-a', '--api', type=str, required=True,
-                        help='URL to the base catalog API')
+                        required=False, help='Path to json input file, with -p either a JSON \
+                        array or JSON Lines (one product per line), otherwise a collection or \
+                        an array of collections, each with an optional array of its products')
+    PARSER.add_argument('-m', '--manifest', type=str, required=False,
+                        help='Path to a JSON manifest of collection files and product files \
+                        (paths or glob patterns relative to the manifest) to import in one run, \
+                        i.e. {"collections": ["ogc.json"], "products": ["data/ogc/*.json"]}')
+    PARSER.add_argument('-a', '--api', type=str, required=False,
+                        help='URL to the base catalog API, required unless loading directly \
+                        into the database with --direct')
     PARSER.add_argument('-p', '--product', required=False, action='store_true',
                         help='Tell the importer that we are importing a product / array of \
                         products [append to existing collection]')
+    PARSER.add_argument('-w', '--workers', type=int, required=False, default=1,
+                        help='Number of products to import concurrently (default 1)')
+    PARSER.add_argument('-b', '--batch-size', type=int, required=False,
+                        help='Number of products to send per request to the bulk \
+                        /add/products route (default 1, one product per request), or to load \
+                        per COPY with --direct (default %d)' % pg_loader.DEFAULT_COPY_BATCH_SIZE)
+    PARSER.add_argument('-g', '--geometry-workers', type=int, required=False, default=0,
+                        help='Number of processes to normalise footprints on ahead of the \
+                        network workers (default 0, normalise on the network workers)')
+    PARSER.add_argument('-j', '--journal', type=str, required=False,
+                        help='Path to the journal recording each product\'s outcome \
+                        (default the input or manifest path with a .journal suffix)')
+    PARSER.add_argument('-r', '--resume', required=False, action='store_true',
+                        help='Skip products the journal records as already imported')
+    PARSER.add_argument('--skip-existing', required=False, action='store_true',
+                        help='Skip products whose name already exists in their collection, \
+                        checked up front with one paged search per collection')
+    PARSER.add_argument('--server-validation', required=False, action='store_true',
+                        help='Validate each product with the /validate/product route rather \
+                        than against its collection\'s products schema in process')
+    PARSER.add_argument('--direct', required=False, action='store_true',
+                        help='Load the products straight into the catalog database with COPY \
+                        and a set based upsert rather than through the API, existing products \
+                        are updated (skipped with --skip-existing)')
+    PARSER.add_argument('--dbhost', type=str, required=False,
+                        help='Database host for --direct (default PGHOST)')
+    PARSER.add_argument('--dbport', type=int, required=False,
+                        help='Database port for --direct (default PGPORT)')
+    PARSER.add_argument('--dbname', type=str, required=False,
+                        help='Database name for --direct (default PGDATABASE)')
+    PARSER.add_argument('--dbuser', type=str, required=False,
+                        help='Database user for --direct (default PGUSER)')
+    PARSER.add_argument('--dbpass', type=str, required=False,
+                        help='Database password for --direct (default PGPASSWORD)')
+    PARSER.add_argument('--defer-indexes', required=False, action='store_true',
+                        help='With --direct, drop the product footprint and collection indexes \
+                        for the load and rebuild them at the end, needs the table owner')
+    PARSER.add_argument('--precision', type=int, required=False,
+                        help='Round footprint coordinates to this many decimal places (i.e. 6, \
+                        about 0.1m), dropping duplicate and collinear vertices')
+    PARSER.add_argument('--simplify', type=float, required=False,
+                        help='Simplify footprints within this tolerance in degrees, keeping \
+                        their topology, dropping duplicate and collinear vertices')
+    PARSER.add_argument('--progress-interval', type=float, required=False,
+                        default=PROGRESS_INTERVAL,
+                        help='Print the run\'s progress every this many seconds, 0 for never \
+                        (default %d)' % PROGRESS_INTERVAL)
+    http_client.add_arguments(PARSER)
+    flow_control.add_arguments(PARSER)
+    instrumentation.add_arguments(PARSER)
 
     ARGS = PARSER.parse_args()
 
-    IMPORTER = Importer(ARGS.api, ARGS.input, ARGS.product)
-    IMPORTER.do_import()
+    if bool(ARGS.input) == bool(ARGS.manifest):
+        PARSER.error('one of -i/--input or -m/--manifest is required')
+    if ARGS.manifest and ARGS.product:
+        PARSER.error('-p/--product does not apply to a --manifest')
+    if not ARGS.direct and not ARGS.api:
+        PARSER.error('-a/--api is required unless loading with --direct')
+    if ARGS.direct and not pg_loader.available():
+        PARSER.error('--direct needs the psycopg2 package')
+    if ARGS.defer_indexes and not ARGS.direct:
+        PARSER.error('--defer-indexes needs --direct')
+
+    METRICS = instrumentation.from_args(ARGS)
+    LOADER = None
+    if ARGS.direct:
+        LOADER = pg_loader.PostgisLoader(
+            pg_loader.connect(ARGS.dbhost, ARGS.dbport, ARGS.dbname, ARGS.dbuser, ARGS.dbpass),
+            not ARGS.skip_existing, ARGS.defer_indexes, METRICS)
+        BATCH_SIZE = ARGS.batch_size or pg_loader.DEFAULT_COPY_BATCH_SIZE
+    else:
+        BATCH_SIZE = ARGS.batch_size or 1
+
+    CONTROLLER = None
+    if ARGS.api:
+        CONTROLLER = flow_control.from_args(ARGS, ARGS.api, ARGS.workers, METRICS)
+
+    IMPORTER = Importer(ARGS.api, ARGS.input or ARGS.manifest, ARGS.product, ARGS.workers,
+                        http_client.session_from_args(ARGS, ARGS.workers, controller=CONTROLLER),
+                        BATCH_SIZE,
+                        ARGS.geometry_workers, ARGS.journal, ARGS.resume, ARGS.skip_existing,
+                        ARGS.server_validation, METRICS, LOADER, ARGS.precision,
+                        ARGS.simplify, bool(ARGS.manifest), ARGS.progress_interval)
+    try:
+        RESULTS = IMPORTER.do_import()
+        if CONTROLLER:
+            print(CONTROLLER.describe())
+    finally:
+        if LOADER:
+            LOADER.close()
+        METRICS.close()
+
+    if not all(ok for (_, ok, _) in RESULTS):
+        sys.exit(1)
 
@@ -0,0 +1,328 @@
+#pylint: disable=C0111
+"""
+Direct to PostGIS bulk loading for the importer
+
+For initial loads of whole collections the HTTP API costs a round trip (and a single row
+insert) per product. In direct mode the importer connects to the catalog database instead,
+resolves each collectionName to its collection id once, streams each batch of products with
+COPY into a temporary staging table and moves the batch into the product table with one
+set based INSERT ... ON CONFLICT (collection_id, name), building the footprints with the
+same ST_SetSRID(ST_GeomFromGeoJSON(...), 4326) the API uses.
+
+Products are validated against the API's product schema and their properties against the
+collection's products schema (when jsonschema is installed) and the footprints normalised,
+but the API's footprint checks are skipped, so direct mode is meant for trusted generated
+data such as the LiDAR json files.
+Needs the optional psycopg2 package.
+"""
+import csv
+import io
+
+try:
+    import psycopg2
+    from psycopg2 import sql
+except ImportError:
+    psycopg2 = None
+
+import codec
+import instrumentation
+import schema_cache
+
+DEFAULT_COPY_BATCH_SIZE = 1000
+
+STAGING_TABLE = '''
+CREATE TEMPORARY TABLE IF NOT EXISTS product_staging (
+    seq integer NOT NULL,
+    collection_id uuid NOT NULL,
+    name character varying(500) NOT NULL,
+    metadata jsonb NOT NULL,
+    properties jsonb,
+    data jsonb,
+    footprint text
+) ON COMMIT DELETE ROWS
+'''
+
+COPY_STAGING = '''
+COPY product_staging (seq, collection_id, name, metadata, properties, data, footprint)
+FROM STDIN WITH (FORMAT csv)
+'''
+
+# The last product of a name in a batch wins, as it would across batches
+UPSERT = '''
+INSERT INTO product (collection_id, name, metadata, properties, data, footprint)
+SELECT DISTINCT ON (collection_id, name)
+    collection_id, name, metadata, properties, data,
+    ST_SetSRID(ST_GeomFromGeoJSON(footprint), 4326)
+FROM product_staging
+ORDER BY collection_id, name, seq DESC
+ON CONFLICT (collection_id, name) DO %s
+RETURNING id::text, collection_id::text, name
+'''
+
+ON_CONFLICT_UPDATE = '''UPDATE SET
+    metadata = EXCLUDED.metadata,
+    properties = EXCLUDED.properties,
+    data = EXCLUDED.data,
+    footprint = EXCLUDED.footprint'''
+
+ON_CONFLICT_SKIP = 'NOTHING'
+
+COLLECTIONS = 'SELECT id::text, name, products_schema FROM collection WHERE name = ANY(%s)'
+
+# Nothing is inserted when a collection of the name exists
+CREATE_COLLECTION = '''
+INSERT INTO collection (name, metadata, products_schema, footprint)
+SELECT %(name)s, %(metadata)s::jsonb, %(products_schema)s::jsonb,
+    ST_SetSRID(ST_GeomFromGeoJSON(%(footprint)s), 4326)
+WHERE NOT EXISTS (SELECT 1 FROM collection WHERE name = %(name)s)
+RETURNING id::text
+'''
+
+# Indexes that are only maintained, not needed, while loading, the unique constraint on
+# (collection_id, name) is kept for ON CONFLICT
+DEFERRABLE_INDEXES = '''
+SELECT i.relname, pg_get_indexdef(x.indexrelid)
+FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+WHERE x.indrelid = 'public.product'::regclass AND NOT x.indisunique AND NOT x.indisprimary
+ORDER BY i.relname
+'''
+
+
+def available():
+    return psycopg2 is not None
+
+
+def connect(host=None, port=None, dbname=None, user=None, password=None):
+    """
+    Connect to the catalog database, options that are not given fall back to the libpq
+    environment variables (PGHOST, PGPORT, PGDATABASE, PGUSER, PGPASSWORD) as for the API
+
+    Keyword arguments:
+    host            -- Database host
+    port            -- Database port
+    dbname          -- Database name
+    user            -- Database user
+    password        -- Database password
+    """
+    options = {'host': host, 'port': port, 'dbname': dbname, 'user': user,
+               'password': password}
+    return psycopg2.connect(**{k: v for (k, v) in options.items() if v is not None})
+
+
+class PostgisLoader:
+    """
+    Loads batches of products straight into the product table over a single connection,
+    batches are loaded one at a time and each batch is committed on its own
+
+    Keyword arguments:
+    connection      -- A psycopg2 connection to the catalog database
+    update_existing -- Update products whose name already exists in their collection,
+                       otherwise they are skipped
+    defer_indexes   -- Drop the product table's non unique indexes (the GiST footprint
+                       index and the collection id index) for the load and rebuild them at
+                       the end, needs the table owner
+    metrics         -- An instrumentation.Instrumentation to time the load with
+    """
+
+    def __init__(self, connection, update_existing=True, defer_indexes=False, metrics=None):
+        self.connection = connection
+        self.upsert = UPSERT % (ON_CONFLICT_UPDATE if update_existing else ON_CONFLICT_SKIP)
+        self.defer_indexes = defer_indexes
+        self.metrics = metrics or instrumentation.Instrumentation()
+        self.deferred = []
+        self._collections = {}
+
+    def start(self):
+        """
+        Create the staging table and, when deferring index maintenance, drop the indexes
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute(STAGING_TABLE)
+
+            if self.defer_indexes:
+                cursor.execute(DEFERRABLE_INDEXES)
+                self.deferred = cursor.fetchall()
+                for (name, definition) in self.deferred:
+                    # Printed first so the index can be recreated by hand if the run dies
+                    print('Deferring index %s: %s' % (name, definition))
+                    cursor.execute(sql.SQL('DROP INDEX public.{}').format(sql.Identifier(name)))
+
+        self.connection.commit()
+
+    def finish(self):
+        """
+        Rebuild any deferred indexes and refresh the planner statistics
+        """
+        self.connection.rollback()
+
+        if self.deferred:
+            with self.connection.cursor() as cursor:
+                for (name, definition) in self.deferred:
+                    print('Rebuilding index %s' % name)
+                    with self.metrics.stage('index_rebuild'):
+                        cursor.execute(definition)
+                cursor.execute('ANALYZE public.product')
+            self.connection.commit()
+            self.deferred = []
+
+    def close(self):
+        self.connection.close()
+
+    def collection(self, collection_name):
+        """
+        Get (collection id, products schema) for a collection, or None if there is no such
+        collection, looked up once per run
+
+        Keyword arguments:
+        collection_name -- The full name of the collection
+        """
+        if collection_name not in self._collections:
+            self._lookup([collection_name])
+        return self._collections[collection_name]
+
+    def create_collection(self, collection):
+        """
+        Add a collection unless one of its name already exists, returning (collection id,
+        created)
+
+        Keyword arguments:
+        collection      -- A JSON blob with the collection name, metadata and optional
+                           productsSchema and polygon footprint
+        """
+        name = collection['name']
+
+        with self.metrics.stage('add_collection'):
+            with self.connection.cursor() as cursor:
+                cursor.execute(CREATE_COLLECTION, {
+                    'name': name,
+                    'metadata': _json(collection['metadata']),
+                    'products_schema': _json_or_null(collection.get('productsSchema')),
+                    'footprint': _json_or_null(collection.get('footprint'))
+                })
+                created = cursor.fetchone() is not None
+            self.connection.commit()
+
+        self._collections.pop(name, None)
+        return (self.collection(name)[0], created)
+
+    def _lookup(self, collection_names):
+        missing = [name for name in collection_names if name not in self._collections]
+        if not missing:
+            return
+
+        with self.metrics.stage('collection_lookup'):
+            with self.connection.cursor() as cursor:
+                cursor.execute(COLLECTIONS, (missing,))
+                found = dict((name, (collection_id, products_schema))
+                             for (collection_id, name, products_schema) in cursor.fetchall())
+            self.connection.commit()
+
+        for name in missing:
+            self._collections[name] = found.get(name)
+
+    def load(self, products):
+        """
+        Load a batch of products, returning a (product, status, message) tuple for each
+        where status is 'stored' (message the product id), 'exists' or 'failed'. A batch
+        the database rejects (i.e. a footprint PostGIS can not read) is split in half and
+        retried until the failing products are found, any other database error is raised.
+
+        Keyword arguments:
+        products        -- A list of JSON blobs with normalised footprints
+        """
+        results = []
+        rows = []
+
+        self._lookup(list(set(p.get('collectionName') for p in products)))
+
+        for product in products:
+            collection = self._collections.get(product.get('collectionName'))
+            if collection is None:
+                results.append((product, 'failed', 'Product %s was not imported, collection %s '
+                                'does not exist in the database'
+                                % (product.get('name', '<unnamed>'), product.get('collectionName'))))
+            else:
+                rows.append((product, collection[0]))
+
+        if rows:
+            results.extend(self._load_rows(rows))
+
+        return results
+
+    def _load_rows(self, rows):
+        try:
+            stored = self._copy_and_upsert(rows)
+        except (psycopg2.DataError, psycopg2.IntegrityError, psycopg2.InternalError) as err:
+            self.connection.rollback()
+            if len(rows) > 1:
+                middle = len(rows) // 2
+                return self._load_rows(rows[:middle]) + self._load_rows(rows[middle:])
+            (product, _) = rows[0]
+            return [(product, 'failed', 'Product %s was not imported, error returned from the '
+                     'database: %s' % (product.get('name', '<unnamed>'), str(err).strip()))]
+
+        results = []
+        for (product, collection_id) in rows:
+            product_id = stored.get((collection_id, product['name']))
+            if product_id is None:
+                results.append((product, 'exists', 'already exists'))
+            else:
+                results.append((product, 'stored', product_id))
+        return results
+
+    def _copy_and_upsert(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for (seq, (product, collection_id)) in enumerate(rows):
+            writer.writerow([
+                seq,
+                collection_id,
+                product['name'],
+                _json(product.get('metadata')),
+                _json_or_null(product.get('properties')),
+                _json_or_null(product.get('data')),
+                _json(product['footprint'])
+            ])
+        buffer.seek(0)
+
+        with self.connection.cursor() as cursor:
+            with self.metrics.stage('copy'):
+                cursor.copy_expert(COPY_STAGING, buffer)
+            with self.metrics.stage('upsert'):
+                cursor.execute(self.upsert)
+                stored = dict(((collection_id, name), product_id)
+                              for (product_id, collection_id, name) in cursor.fetchall())
+
+        # Committing empties the staging table
+        self.connection.commit()
+        return stored
+
+
+def _json(value):
+    # The csv writer and the query parameters take str
+    return codec.dumps(value).decode('utf-8')
+
+
+def _json_or_null(value):
+    # An unquoted empty CSV field is NULL
+    return None if value is None else _json(value)
+
+
+class DatabaseSchemaCache(schema_cache.SchemaCache):
+    """
+    SchemaCache reading the collections' products schemas from the database rather than
+    the API, for direct mode
+
+    Keyword arguments:
+    loader          -- The PostgisLoader for the run
+    """
+
+    def __init__(self, loader):
+        super().__init__(None, None)
+        self.loader = loader
+
+    def _fetch_collection(self, collection_name):
+        collection = self.loader.collection(collection_name)
+        if collection is None:
+            return None
+        return {'name': collection_name, 'productsSchema': collection[1]}
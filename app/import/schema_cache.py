@@ -0,0 +1,272 @@
+#pylint: disable=C0111
+"""
+Client side product validation for the importer
+
+Products are validated in process against the API's product schema (format/product_schema.json,
+a copy of app/api/definitions/product to be kept in step with it) and their properties
+against their collection's products schema. Each collection's products schema is fetched
+from the catalog once per run and compiled into a JSON schema validator, cached by
+collection name and by schema hash (collections sharing a schema share a validator). So
+invalid products are caught on the importer's workers before any network I/O and the
+/validate/product round trip can be dropped, /add/product still validates every product
+on the server. Formats are checked the way the API's ajv "full" formats check them, rather
+than with jsonschema's own checkers which silently pass some formats unless further
+packages are installed. Validation needs the optional jsonschema package, without it (or
+for a schema it cannot compile) validate returns None and the importer falls back to the
+server's /validate/product route.
+"""
+import datetime
+import hashlib
+import ipaddress
+import json
+import os
+import re
+import threading
+
+try:
+    import jsonschema
+except ImportError:
+    jsonschema = None
+
+import codec
+
+PRODUCT_SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'format', 'product_schema.json')
+
+DATE_PATTERN = re.compile(r'^[0-9]{4}-[0-9]{2}-[0-9]{2}(T[0-9]{2}:[0-9]{2}(:[0-9]{2})?Z)?$')
+
+# ajv's "full" format patterns, for the formats the product schema uses
+FORMAT_DATE = re.compile(r'^(\d\d\d\d)-(\d\d)-(\d\d)$')
+FORMAT_TIME = re.compile(r'^(\d\d):(\d\d):(\d\d)(\.\d+)?(z|[+-]\d\d(?::?\d\d)?)?$', re.IGNORECASE)
+FORMAT_HOSTNAME = re.compile(r'^(?=.{1,253}\.?$)[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?'
+                             r'(?:\.[a-z0-9](?:[-0-9a-z]{0,61}[0-9a-z])?)*\.?$', re.IGNORECASE)
+FORMAT_EMAIL = re.compile(r"^[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
+                          r"@(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)+[a-z0-9](?:[a-z0-9-]*[a-z0-9])?$", re.IGNORECASE)
+FORMAT_URI = re.compile(r'^[a-z][a-z0-9+.-]*:[^\s]*$', re.IGNORECASE)
+FORMAT_URL = re.compile(r'^(?:https?|ftp)://[^\s/$.?#][^\s]*$', re.IGNORECASE)
+FORMAT_UUID = re.compile(r'^(?:urn:uuid:)?[0-9a-f]{8}-(?:[0-9a-f]{4}-){3}[0-9a-f]{12}$', re.IGNORECASE)
+
+
+def _is_date(value):
+    match = FORMAT_DATE.match(value)
+    if not match:
+        return False
+    try:
+        datetime.date(*(int(part) for part in match.groups()))
+    except ValueError:
+        return False
+    return True
+
+
+def _is_date_time(value):
+    # A date and a time with its time zone, separated by a T or a space
+    parts = re.split(r'[tT\s]', value)
+    if len(parts) != 2 or not _is_date(parts[0]):
+        return False
+    match = FORMAT_TIME.match(parts[1])
+    if not match or not match.group(5):
+        return False
+    (hour, minute, second) = (int(match.group(i)) for i in (1, 2, 3))
+    return (hour <= 23 and minute <= 59 and second <= 59) or (hour, minute, second) == (23, 59, 60)
+
+
+def _is_ipv6(value):
+    try:
+        ipaddress.IPv6Address(value)
+    except ValueError:
+        return False
+    return True
+
+
+FORMATS = {
+    'date': _is_date,
+    'date-time': _is_date_time,
+    'hostname': lambda value: bool(FORMAT_HOSTNAME.match(value)),
+    'email': lambda value: bool(FORMAT_EMAIL.match(value)),
+    'ipv6': _is_ipv6,
+    'uri': lambda value: bool(FORMAT_URI.match(value)),
+    'url': lambda value: bool(FORMAT_URL.match(value)),
+    'uuid': lambda value: bool(FORMAT_UUID.match(value))
+}
+
+
+def format_checker():
+    """
+    A jsonschema format checker for the FORMATS, other formats are not checked (as ajv
+    ignores formats it does not know)
+    """
+    checker = jsonschema.FormatChecker(formats=())
+    for (name, check) in FORMATS.items():
+        # Formats only apply to strings
+        checker.checks(name)(lambda value, check=check: not isinstance(value, str) or check(value))
+    return checker
+
+
+def _full_date_validation(validator, enabled, instance, schema):
+    """
+    The server's custom fullDateValidation keyword, the value must be a real calendar date
+    (or UTC date time) rather than just look like one
+    """
+    if not isinstance(instance, str):
+        return
+    if not DATE_PATTERN.match(instance):
+        yield jsonschema.ValidationError('is not a valid date time format')
+        return
+    try:
+        datetime.date(*(int(part) for part in instance[:10].split('-')))
+    except ValueError:
+        yield jsonschema.ValidationError('is not a valid date')
+
+
+def schema_hash(schema):
+    return hashlib.sha256(json.dumps(schema, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def compile_schema(schema):
+    """
+    Compile a JSON schema into a validator with the server's custom keyword and formats,
+    raises a jsonschema.SchemaError if the schema is not valid
+
+    Keyword arguments:
+    schema          -- A JSON schema
+    """
+    # $async only means something to ajv
+    schema = {k: v for (k, v) in schema.items() if k != '$async'}
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    cls = jsonschema.validators.extend(cls, {'fullDateValidation': _full_date_validation})
+    return cls(schema, format_checker=format_checker())
+
+
+def _error_messages(errors, prefix=None):
+    # As the API reports them, "path | message" sorted by path
+    messages = []
+    for error in sorted(errors, key=lambda e: [str(p) for p in e.absolute_path]):
+        path = '.'.join(([prefix] if prefix else []) + [str(p) for p in error.absolute_path])
+        messages.append('%s | %s' % (path or 'product', error.message))
+    return messages
+
+
+def _bounding_box_errors(bounding_box):
+    # The API's check of the metadata bounding box beyond its schema
+    errors = []
+    if bounding_box['north'] <= bounding_box['south']:
+        errors.append('metadata.boundingBox | north should be greater than south')
+    if bounding_box['east'] <= bounding_box['west']:
+        errors.append('metadata.boundingBox | east should be greater than west')
+    return errors
+
+
+class SchemaCache:
+    """
+    Per run cache of the collections' compiled products schemas, safe to share between
+    worker threads
+
+    Keyword arguments:
+    session         -- A shared http_client session
+    api_base_url    -- The base URL of the catalog API
+    """
+
+    def __init__(self, session, api_base_url):
+        self.session = session
+        self.api_base_url = api_base_url
+        self._lock = threading.Lock()
+        self._collections = {}
+        self._validators = {}
+        self._product_validator = None
+
+    @staticmethod
+    def available():
+        return jsonschema is not None
+
+    def _fetch_collection(self, collection_name):
+        resp = self.session.get('%s/search/collection/%s' % (self.api_base_url, collection_name))
+
+        if not resp.ok:
+            raise ValueError('Could not get collection %s, error returned from API: %s'
+                             % (collection_name, resp.text))
+
+        matches = [c for c in codec.loads(resp.content)['result'] if c['name'] == collection_name]
+        return matches[0] if matches else None
+
+    def _compile(self, schema):
+        if not schema:
+            return None
+
+        key = schema_hash(schema)
+        if key not in self._validators:
+            try:
+                self._validators[key] = compile_schema(schema)
+            except (jsonschema.SchemaError, AttributeError, TypeError) as err:
+                print('Products schema %s can not be used for client side validation, '
+                      'validating on the server: %s' % (key[:12], err))
+                self._validators[key] = False
+
+        return self._validators[key]
+
+    def product_validator(self):
+        """
+        Get the compiled product schema validator, or False when it can not be used, compiled
+        once per run
+        """
+        with self._lock:
+            if self._product_validator is None:
+                try:
+                    with open(PRODUCT_SCHEMA_PATH, 'rb') as schema_file:
+                        self._product_validator = compile_schema(codec.load(schema_file))
+                except (OSError, ValueError, jsonschema.SchemaError, AttributeError, TypeError) as err:
+                    print('The product schema can not be used for client side validation, '
+                          'validating on the server: %s' % err)
+                    self._product_validator = False
+            return self._product_validator
+
+    def collection(self, collection_name):
+        """
+        Get (collection exists, compiled validator or None when no properties schema, False
+        when the schema can not be used) for a collection, fetched once per run
+
+        Keyword arguments:
+        collection_name -- The full name of the collection
+        """
+        with self._lock:
+            if collection_name not in self._collections:
+                collection = self._fetch_collection(collection_name)
+                if collection is None:
+                    self._collections[collection_name] = (False, None)
+                else:
+                    self._collections[collection_name] = (
+                        True, self._compile(collection.get('productsSchema')))
+            return self._collections[collection_name]
+
+    def validate(self, product):
+        """
+        Validate a product as the API does, the whole product against the product schema and
+        then its properties against its collection's products schema, returning a list of
+        errors (empty when valid) or None if the product can only be validated on the server
+
+        Keyword arguments:
+        product         -- A JSON blob to import as a product
+        """
+        if jsonschema is None:
+            return None
+
+        product_validator = self.product_validator()
+        if product_validator is False:
+            return None
+
+        # The API stops at the product schema's errors
+        errors = _error_messages(product_validator.iter_errors(product))
+        if errors:
+            return errors
+
+        errors = _bounding_box_errors(product['metadata']['boundingBox'])
+        collection_name = product['collectionName']
+        (exists, validator) = self.collection(collection_name)
+
+        if not exists:
+            return errors + ['collectionName | %s does not exist in the database' % collection_name]
+        if validator is False:
+            return None
+        if validator is None:
+            return errors
+
+        return errors + _error_messages(validator.iter_errors(product['properties']), 'properties')
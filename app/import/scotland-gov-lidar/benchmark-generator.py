@@ -0,0 +1,158 @@
+import argparse
+import importlib.util
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+
+from object_sources import ManifestObjectSource, LocalObjectSource
+from grid_cache import build_grid_cache, GridCache
+
+# Benchmarks the stages of the LiDAR json generator against synthetic grids and keysets,
+# with no AWS credentials or network needed. For each size a square WGS84 grid of that many
+# tiles and a matching keyset (one key for each of a fraction of the tiles, spread over a
+# few resolution prefixes) are generated, then listing, grid loading, grid lookup / product building and serialisation
+# are timed separately. Grid loading and lookup are timed for both the parsed GeoJSON dict
+# and the compiled grid cache (the one-off cache build is reported on its own).
+
+RESOLUTIONS = ['25cm', '50cm', '1m', '2m']
+
+def load_generator():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scotland-lidar-json-generator.py')
+    spec = importlib.util.spec_from_file_location('generator', path)
+    generator = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(generator)
+    return generator
+
+def write_synthetic_grid(path, tiles):
+    side = int(math.ceil(math.sqrt(tiles)))
+    size = 0.01
+    features = []
+    for i in range(tiles):
+        (x, y) = (-8.0 + (i % side) * size, 54.5 + (i // side) * size)
+        features.append({
+            'type': 'Feature',
+            'properties': {'id': 'T%06d' % i},
+            'geometry': {
+                'type': 'Polygon',
+                'coordinates': [[[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]]
+            }
+        })
+    with open(path, 'w') as grid_file:
+        json.dump({'type': 'FeatureCollection', 'features': features}, grid_file)
+
+def synthetic_keys(prefix, tiles, coverage):
+    # Buckets usually only hold a fraction of the grid, keys for every step'th tile
+    step = max(1, int(round(1 / coverage)))
+    for i in range(0, tiles, step):
+        resolution = RESOLUTIONS[i % len(RESOLUTIONS)]
+        yield ('%s%s/T%06d_%s_DSM_BENCH.tif' % (prefix, resolution, i, resolution.upper()), 1000000 + i)
+
+def write_manifest(path, keys):
+    with open(path, 'w') as manifest:
+        for (key, size) in keys:
+            manifest.write(json.dumps({'key': key, 'size': size}) + '\n')
+
+def write_local_tree(root, keys):
+    # Empty files, the local source reports the on disk size
+    for (key, _) in keys:
+        path = os.path.join(root, *key.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+
+def make_products(generator, objects, grids):
+    return [generator.make_product(key, size, 'bench-bucket', 'eu-west-1', grids, 'bench/collection', 'Bench', False)
+            for (key, size, _) in objects]
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return (result, time.perf_counter() - start)
+
+def benchmark(generator, tiles, coverage, source_type, workers, split_depth, jsonl, work_dir):
+    prefix = 'bench/dsm/27700/gridded/'
+    grid_path = os.path.join(work_dir, 'grid-%d.geojson' % tiles)
+    write_synthetic_grid(grid_path, tiles)
+    keys = list(synthetic_keys(prefix, tiles, coverage))
+
+    if source_type == 'local':
+        root = os.path.join(work_dir, 'tree-%d' % tiles)
+        write_local_tree(root, keys)
+        source = LocalObjectSource(root)
+    else:
+        manifest_path = os.path.join(work_dir, 'manifest-%d.jsonl' % tiles)
+        write_manifest(manifest_path, keys)
+        source = ManifestObjectSource(manifest_path)
+
+    (objects, listing) = timed(lambda: list(generator.list_bucket(source, prefix, workers, split_depth)))
+    (grids, grid_load) = timed(lambda: generator.load_grids(grid_path))
+    (products, lookup) = timed(lambda: make_products(generator, objects, grids))
+
+    cache_path = os.path.join(work_dir, 'grid-%d.gridcache' % tiles)
+    (_, cache_build) = timed(lambda: build_grid_cache(grid_path, 'id', cache_path))
+    (cache, cache_open) = timed(lambda: GridCache(cache_path))
+    (cache_products, cache_lookup) = timed(lambda: make_products(generator, objects, cache))
+    cache.close()
+
+    if cache_products != products:
+        raise ValueError('Grid cache products differ from the GeoJSON products for %d tiles' % tiles)
+
+    output_path = os.path.join(work_dir, 'products-%d.json' % tiles)
+    with open(output_path, 'wb') as output:
+        (_, serialise) = timed(lambda: generator.write_products(iter(products), output, jsonl))
+
+    return {
+        'tiles': tiles,
+        'objects': len(objects),
+        'listing_seconds': listing,
+        'grid_load_seconds': grid_load,
+        'grid_lookup_seconds': lookup,
+        'grid_cache_build_seconds': cache_build,
+        'grid_cache_open_seconds': cache_open,
+        'grid_cache_lookup_seconds': cache_lookup,
+        'serialise_seconds': serialise,
+        'output_bytes': os.path.getsize(output_path)
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks listing, grid lookup and serialisation for the LiDAR json generator on synthetic keysets, offline.')
+
+    parser.add_argument('-s', '--sizes', help='Grid sizes (number of tiles / keys) to benchmark (default 1000 5000 10000)', type=int, nargs='+', default=[1000, 5000, 10000])
+    parser.add_argument('--coverage', help='Fraction of the grid tiles that have a key (default 1)', type=float, default=1.0)
+    parser.add_argument('--source', help='Listing source to benchmark, manifest or local (default manifest)', choices=['manifest', 'local'], default='manifest')
+    parser.add_argument('-w', '--workers', help='Number of sub prefixes to list concurrently (default 8)', type=int, default=8)
+    parser.add_argument('--split_depth', help='How many folder levels to split the listing over (default 1)', type=int, default=1)
+    parser.add_argument('--jsonl', help='Serialise as JSON Lines rather than a JSON array', action='store_true', default=False)
+    parser.add_argument('-o', '--output', help='Also write the results as JSON to this path', required=False)
+
+    args = parser.parse_args()
+
+    generator = load_generator()
+    results = []
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Keep the per prefix listing output out of the results table
+        stdout = sys.stdout
+        for tiles in args.sizes:
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                results.append(benchmark(generator, tiles, args.coverage, args.source, max(1, args.workers), args.split_depth, args.jsonl, work_dir))
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+
+    print('%d%% grid coverage, %s source' % (round(args.coverage * 100), args.source))
+    print('%8s %10s %10s %10s %14s %13s %15s %10s %12s' % ('tiles', 'list s', 'grid s', 'lookup s', 'cache build s',
+                                                          'cache open s', 'cache lookup s', 'write s', 'bytes'))
+    for r in results:
+        print('%8d %10.3f %10.3f %10.3f %14.3f %13.4f %15.3f %10.3f %12d' % (
+            r['tiles'], r['listing_seconds'], r['grid_load_seconds'], r['grid_lookup_seconds'], r['grid_cache_build_seconds'],
+            r['grid_cache_open_seconds'], r['grid_cache_lookup_seconds'], r['serialise_seconds'], r['output_bytes']))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'source': args.source, 'coverage': args.coverage, 'workers': args.workers, 'results': results}, output, indent=2)
@@ -0,0 +1,176 @@
+import mmap
+import os
+import struct
+import zlib
+
+import codec
+
+# Precompiled grid cache for the LiDAR json generator. Parsing a full WGS84 grid GeoJSON file
+# on every run is slow (the 1k grids hold tens of thousands of tiles) when only a fraction
+# of the tiles are ever in the bucket, so the grid is compiled once into a binary file next
+# to it and memory mapped on later runs. Tiles are looked up on demand through an open
+# addressing hash table (crc32 of the tile id, linear probing) over a fixed width index, so
+# opening the cache costs nothing however big the grid is, and only the geometries that
+# are asked for are decoded. The layout is
+#
+#   header:     magic, source size, source mtime, tile count, id width, grid property
+#   slots:      2 x count x index record number (EMPTY_SLOT for an empty slot)
+#   index:      count x (tile id, tile offset, tile length)
+#   tiles:      compact JSON [[west, south, east, north], geometry] per tile, utf-8
+#
+# The cache records the size and modification time of the GeoJSON file it was built from
+# and is rebuilt whenever they change.
+
+MAGIC = b'GRIDC003'
+HEADER = struct.Struct('<8sQqII64s')
+SLOT = struct.Struct('<I')
+EMPTY_SLOT = 0xFFFFFFFF
+
+def iter_positions(coordinates):
+    # Every position in a GeoJSON coordinates array, whatever its nesting (rings / parts)
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        yield coordinates
+    else:
+        for c in coordinates:
+            yield from iter_positions(c)
+
+def geometry_bbox(geometry):
+    # (west, south, east, north) over all rings and parts of a geometry
+    positions = list(iter_positions(geometry['coordinates']))
+    xs = [p[0] for p in positions]
+    ys = [p[1] for p in positions]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+def bbox_dict(bbox):
+    (west, south, east, north) = bbox
+    return {
+        'north': north,
+        'east': east,
+        'south': south,
+        'west': west
+    }
+
+def default_cache_path(grid_path, grid_property):
+    return '%s.%s.gridcache' % (grid_path, grid_property)
+
+def _source_stamp(grid_path):
+    stat = os.stat(grid_path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def _index_record(id_width):
+    return struct.Struct('<%dsQI' % id_width)
+
+def _slot_count(count):
+    return max(1, 2 * count)
+
+def _slot(tile, slot_count):
+    return zlib.crc32(tile) % slot_count
+
+def build_grid_cache(grid_path, grid_property, cache_path):
+    # Compiles a grid GeoJSON file into a cache, written to a temporary file and moved into
+    # place so a half written cache is never read
+    with open(grid_path, 'rb') as grid_file:
+        features = codec.load(grid_file)['features']
+
+    tiles = {}
+    for item in features:
+        tile = [geometry_bbox(item['geometry']), item['geometry']]
+        tiles[str(item['properties'][grid_property]).encode('utf-8')] = codec.dumps(tile)
+
+    id_width = max([len(tile) for tile in tiles] + [1])
+    record = _index_record(id_width)
+    (size, mtime) = _source_stamp(grid_path)
+    ordered = sorted(tiles)
+
+    slots = [EMPTY_SLOT] * _slot_count(len(ordered))
+    for (i, tile) in enumerate(ordered):
+        slot = _slot(tile, len(slots))
+        while slots[slot] != EMPTY_SLOT:
+            slot = (slot + 1) % len(slots)
+        slots[slot] = i
+
+    temp_path = cache_path + '.tmp'
+    with open(temp_path, 'wb') as cache:
+        cache.write(HEADER.pack(MAGIC, size, mtime, len(ordered), id_width, grid_property.encode('utf-8')))
+        cache.write(struct.pack('<%dI' % len(slots), *slots))
+        offset = 0
+        for tile in ordered:
+            cache.write(record.pack(tile, offset, len(tiles[tile])))
+            offset += len(tiles[tile])
+        for tile in ordered:
+            cache.write(tiles[tile])
+    os.replace(temp_path, cache_path)
+
+    return len(tiles)
+
+class GridCache:
+    # Read only mapping of tile id -> {'wgs84': {'geojson': ..., 'bbox': ...}}, the same shape
+    # as the dict built by load_grids, backed by a memory mapped grid cache
+    def __init__(self, cache_path):
+        with open(cache_path, 'rb') as cache:
+            self.data = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.source_size, self.source_mtime, self.count, id_width, grid_property) = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a grid cache' % cache_path)
+
+        self.grid_property = grid_property.rstrip(b'\0').decode('utf-8')
+        self.record = _index_record(id_width)
+        self.slot_count = _slot_count(self.count)
+        self.index_start = HEADER.size + self.slot_count * SLOT.size
+        self.blob_start = self.index_start + self.count * self.record.size
+        self.tiles = {}
+
+    def matches(self, grid_path, grid_property):
+        return (self.source_size, self.source_mtime) == _source_stamp(grid_path) and self.grid_property == grid_property
+
+    def _find(self, tile):
+        # Probes the hash table from the tile's slot until the tile or an empty slot turns
+        # up, ids are null padded to the index width
+        key = tile.encode('utf-8')
+        slot = _slot(key, self.slot_count)
+        while True:
+            (i,) = SLOT.unpack_from(self.data, HEADER.size + slot * SLOT.size)
+            if i == EMPTY_SLOT:
+                return None
+            record = self.record.unpack_from(self.data, self.index_start + i * self.record.size)
+            if record[0].rstrip(b'\0') == key:
+                return record
+            slot = (slot + 1) % self.slot_count
+
+    def __getitem__(self, tile):
+        if tile not in self.tiles:
+            record = self._find(tile)
+            if record is None:
+                raise KeyError(tile)
+            (_, offset, length) = record
+            start = self.blob_start + offset
+            (bbox, geometry) = codec.loads(self.data[start:start + length])
+            self.tiles[tile] = {'wgs84': {'geojson': geometry, 'bbox': bbox_dict(bbox)}}
+        return self.tiles[tile]
+
+    def __contains__(self, tile):
+        return tile in self.tiles or self._find(tile) is not None
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.data.close()
+
+def open_grid_cache(grid_path, grid_property, cache_path=None):
+    # Opens the cache for a grid file, (re)building it first if it is missing or stale
+    cache_path = cache_path or default_cache_path(grid_path, grid_property)
+
+    if os.path.exists(cache_path):
+        try:
+            cache = GridCache(cache_path)
+            if cache.matches(grid_path, grid_property):
+                return cache
+            cache.close()
+        except (ValueError, struct.error):
+            pass
+
+    count = build_grid_cache(grid_path, grid_property, cache_path)
+    print('Built grid cache of %d tiles at %s' % (count, cache_path))
+    return GridCache(cache_path)
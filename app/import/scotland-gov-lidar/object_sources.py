@@ -0,0 +1,147 @@
+import json
+import os
+
+# Object listing sources for the LiDAR json generator. Every source lists (key, size, etag)
+# triples under a prefix and can split a prefix into its sub prefixes so that they can be
+# listed concurrently:
+#
+#   split_prefix(prefix, depth) -> [(prefix, recursive), ...]
+#   list_objects(prefix, recursive) -> [(key, size, etag), ...]
+#
+# where a non recursive listing only covers the keys sitting directly under the prefix and
+# etag is None when the source does not know it. S3ObjectSource lists a live bucket,
+# LocalObjectSource a directory tree laid out like the bucket and ManifestObjectSource a
+# saved listing, so that generation runs can be reproduced and benchmarked without AWS
+# credentials or a network.
+
+def _parent(key):
+    # The prefix a key sits directly under, '' for keys at the top level
+    return key[:key.rindex('/') + 1] if '/' in key else ''
+
+def _split(prefix, depth, list_level):
+    # Shared split logic, list_level(prefix) returns (sub prefixes, has keys) for the
+    # level directly under a prefix
+    if depth <= 0:
+        return [(prefix, True)]
+
+    (sub_prefixes, has_keys) = list_level(prefix)
+
+    if not sub_prefixes:
+        return [(prefix, True)]
+
+    # A path given without its trailing slash has a single sub prefix, itself with a slash
+    if len(sub_prefixes) == 1 and not has_keys:
+        return _split(sub_prefixes[0], depth, list_level)
+
+    prefixes = [(prefix, False)] if has_keys else []
+    for sub_prefix in sub_prefixes:
+        prefixes.extend(_split(sub_prefix, depth - 1, list_level))
+    return prefixes
+
+class S3ObjectSource:
+    def __init__(self, bucket, profile=None, max_connections=10):
+        import boto3
+        from botocore.config import Config
+
+        session = boto3.Session() if not profile else boto3.Session(profile_name=profile)
+        # Clients (unlike resources) are safe to share between the listing threads
+        self.client = session.client('s3', config=Config(max_pool_connections=max_connections))
+        self.bucket = bucket
+
+    def _list_level(self, prefix):
+        sub_prefixes = []
+        has_keys = False
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            sub_prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+            has_keys = has_keys or len(page.get('Contents', [])) > 0
+        return (sub_prefixes, has_keys)
+
+    def split_prefix(self, prefix, depth):
+        return _split(prefix, depth, self._list_level)
+
+    def list_objects(self, prefix, recursive):
+        options = {'Bucket': self.bucket, 'Prefix': prefix}
+        if not recursive:
+            options['Delimiter'] = '/'
+
+        objects = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(**options):
+            objects.extend((o['Key'], o['Size'], o['ETag'].strip('"')) for o in page.get('Contents', []))
+        return objects
+
+class LocalObjectSource:
+    # Lists a local directory tree as if it were the bucket, keys are '/' separated paths
+    # relative to the root directory. Files have no ETag, hashing every file to make one up
+    # would cost more than the listing.
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, prefix):
+        return os.path.join(self.root, *_parent(prefix).split('/'))
+
+    def _entries(self, prefix):
+        # Entries of the directory a prefix points into, filtered by the partial name part
+        path = self._path(prefix)
+        name_start = prefix[len(_parent(prefix)):]
+        if not os.path.isdir(path):
+            return []
+        return sorted((e for e in os.scandir(path) if e.name.startswith(name_start)), key=lambda e: e.name)
+
+    def _list_level(self, prefix):
+        entries = self._entries(prefix)
+        sub_prefixes = [_parent(prefix) + e.name + '/' for e in entries if e.is_dir()]
+        has_keys = any(e.is_file() for e in entries)
+        return (sub_prefixes, has_keys)
+
+    def split_prefix(self, prefix, depth):
+        return _split(prefix, depth, self._list_level)
+
+    def list_objects(self, prefix, recursive):
+        objects = []
+        pending = [(_parent(prefix), self._entries(prefix))]
+        while pending:
+            (parent, entries) = pending.pop()
+            for entry in entries:
+                if entry.is_file():
+                    objects.append((parent + entry.name, entry.stat().st_size, None))
+                elif recursive and entry.is_dir():
+                    key_prefix = parent + entry.name + '/'
+                    pending.append((key_prefix, sorted(os.scandir(entry.path), key=lambda e: e.name)))
+        return sorted(objects)
+
+class ManifestObjectSource:
+    # Lists a saved listing, a JSON Lines file of {"key": ..., "size": ..., "etag": ...}
+    # objects as written by save_manifest, the etag is optional
+    def __init__(self, manifest_path):
+        with open(manifest_path) as manifest:
+            self.objects = sorted((o['key'], o['size'], o.get('etag')) for o in (json.loads(line) for line in manifest if line.strip()))
+
+    def _list_level(self, prefix):
+        sub_prefixes = set()
+        has_keys = False
+        for (key, _, _) in self.objects:
+            if key.startswith(prefix):
+                rest = key[len(prefix):]
+                if '/' in rest:
+                    sub_prefixes.add(prefix + rest[:rest.index('/') + 1])
+                else:
+                    has_keys = True
+        return (sorted(sub_prefixes), has_keys)
+
+    def split_prefix(self, prefix, depth):
+        return _split(prefix, depth, self._list_level)
+
+    def list_objects(self, prefix, recursive):
+        return [(key, size, etag) for (key, size, etag) in self.objects
+                if key.startswith(prefix) and (recursive or '/' not in key[len(prefix):])]
+
+def save_manifest(objects, manifest_path):
+    # Saves (key, size, etag) triples as a manifest for ManifestObjectSource, yielding them
+    # on so a live listing can be recorded as it is consumed
+    with open(manifest_path, 'w') as manifest:
+        for (key, size, etag) in objects:
+            record = {'key': key, 'size': size}
+            if etag is not None:
+                record['etag'] = etag
+            manifest.write(json.dumps(record) + '\n')
+            yield (key, size, etag)
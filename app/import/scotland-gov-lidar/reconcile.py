@@ -0,0 +1,77 @@
+# Reconciliation of a bucket listing with the products already in the catalog, for the
+# LiDAR json generator. Rather than regenerating and re-importing a whole collection after a
+# few tiles are added to or replaced in the bucket, the listing and the collection's
+# products (fetched in bulk, a page of /search/product at a time) are both indexed by S3 key
+# and compared with set operations:
+#
+#   new:        keys in the bucket that no product points at
+#   changed:    keys in both whose size differs, or whose ETag differs from the one in the
+#               manifest of the run the catalog was loaded from (when there is one)
+#   orphaned:   products whose key is no longer in the bucket
+#
+# so only those products need to be built and imported, or removed from the catalog. The
+# product schema has no room for an ETag, so they are only kept in the manifests.
+
+import codec
+
+from object_sources import ManifestObjectSource
+
+DEFAULT_PAGE_SIZE = 1000
+
+def catalog_products(session, catalog_url, collection_name, page_size=DEFAULT_PAGE_SIZE, metrics=None):
+    # Yields every product in a collection, paging with the after cursor so each page costs
+    # the catalog the same however deep into the collection it is
+    query_url = catalog_url.rstrip('/') + '/search/product'
+    query = {'collections': [collection_name], 'limit': page_size}
+    seen = set()
+
+    while True:
+        if metrics:
+            with metrics.stage('catalog_page'):
+                resp = session.post(query_url, json=query)
+        else:
+            resp = session.post(query_url, json=query)
+
+        if not resp.ok:
+            raise ValueError('Could not list products in collection %s, error returned from API: %s'
+                             % (collection_name, resp.text))
+
+        page = codec.loads(resp.content)['result']
+        if not page:
+            return
+
+        new = [p for p in page if p['id'] not in seen]
+        if not new:
+            raise ValueError('The catalog at %s does not support the after parameter' % catalog_url)
+        seen.update(p['id'] for p in new)
+
+        yield from new
+        query['after'] = page[-1]['collectionName'] + '/' + page[-1]['name']
+
+def product_object(product, bucket):
+    # (key, size) of the object a product points at in the bucket, None for a product that
+    # does not point at one
+    s3 = ((product.get('data') or {}).get('product') or {}).get('s3') or {}
+    if not s3.get('key') or s3.get('bucket', bucket) != bucket:
+        return None
+    return (s3['key'], s3.get('size'))
+
+def manifest_etags(manifest_path):
+    # key -> etag of the objects in a saved manifest that have one
+    return dict((key, etag) for (key, _, etag) in ManifestObjectSource(manifest_path).objects if etag is not None)
+
+def is_changed(listed, catalogued_size, previous_etag):
+    (size, etag) = listed
+    if size != catalogued_size:
+        return True
+    return etag is not None and previous_etag is not None and etag != previous_etag
+
+def reconcile(listed, catalogued, previous=None):
+    # Compares the listing (key -> (size, etag)) with the catalog (key -> size) and the
+    # previous run's ETags (key -> etag), returning the sorted (new, changed, orphaned) keys
+    previous = previous or {}
+    new = listed.keys() - catalogued.keys()
+    orphaned = catalogued.keys() - listed.keys()
+    changed = [key for key in listed.keys() & catalogued.keys()
+               if is_changed(listed[key], catalogued[key], previous.get(key))]
+    return (sorted(new), sorted(changed), sorted(orphaned))
@@ -1,96 +1,224 @@
-import boto3
-import json
 import os
+import sys
 import uuid
 import argparse
 
-def get_bbox(item):
-    west = item['geometry']['coordinates'][0][0][0]
-    south = item['geometry']['coordinates'][0][0][1]
-    east = item['geometry']['coordinates'][0][0][0]
-    north = item['geometry']['coordinates'][0][0][1]
-
-    for coord in item['geometry']['coordinates'][0]:
-        if west > coord[0]:
-            west = coord[0]
-        if south > coord[1]:
-            south = coord[1]
-        if east < coord[0]:
-            east = coord[0]
-        if north < coord[1]:
-            north = coord[1]
-    return {
-		'north': north,
-		'east': east,
-		'south': south,
-		'west': west
-	}
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+import codec
+import instrumentation
+
+from object_sources import S3ObjectSource, LocalObjectSource, ManifestObjectSource, save_manifest
+from grid_cache import bbox_dict, geometry_bbox, open_grid_cache
+import reconcile
+
+try:
+    import http_client
+except ImportError:
+    # requests is only needed to reconcile with the catalog
+    http_client = None
 
-def get_products(bucket, region, s3_path, wgs84_grid_path, collection_name, collection_title, profile):
+DEFAULT_WORKERS = 8
+DEFAULT_SPLIT_DEPTH = 1
+# Tile name property in the grid file, the charlesroper OSGB grids use TILE_NAME or PLAN_NO
+DEFAULT_GRID_PROPERTY = 'id'
 
-    session = boto3.Session() if not profile else boto3.Session(profile_name=profile)
-    resource = session.resource('s3')
-    remote_bucket = resource.Bucket(bucket)
+# Stage timings and counters for the run, reported when the run ends
+METRICS = instrumentation.Instrumentation()
 
+def get_bbox(item):
+    # Covers every ring / part of the geometry, not just the first ring
+    return bbox_dict(geometry_bbox(item['geometry']))
+
+def load_grids(wgs84_grid_path, grid_property=DEFAULT_GRID_PROPERTY):
+    # Parses the whole grid file into a dict, see grid_cache for the compiled alternative
     grids = {}
 
-    with open(wgs84_grid_path) as wgs84_grid_file:
-        wgs84_grid_json = json.load(wgs84_grid_file)
+    with open(wgs84_grid_path, 'rb') as wgs84_grid_file:
+        wgs84_grid_json = codec.load(wgs84_grid_file)
         for item in wgs84_grid_json['features']:
-            grids[item['properties']['id']] = {'wgs84': {'geojson': item['geometry'], 'bbox': get_bbox(item)}}
-#            grids[item['properties']['TILE_NAME']] = {'wgs84': {'geojson': item['geometry'], 'bbox': get_bbox(item)}}
-#            grids[item['properties']['PLAN_NO']] = {'wgs84': {'geojson': item['geometry'], 'bbox': get_bbox(item)}}
-
-    #with open(osgb_grid_path) as osgb_grid_file:
-    #    osgb_grid_json = json.load(osgb_grid_file)
-    #    for item in osgb_grid_json['features']:
-    #        print(grids[item['properties']['id']])
-    #        grids[item['properties']['id']]['osgb'] = {'geojson': item['geometry'], 'bbox': get_bbox(item)}
-
-    products = []
-
-    for key in remote_bucket.objects.filter(Prefix=s3_path):
-        print(key.key)
-        if (not key.key.endswith('/')):
-            #GRID_50CM_DSM_CONTRACTNAME.TIFF
-            #Scotland Lidar-1 %s %s
-            (productName, fileType) = os.path.basename(key.key).split('.')
-            (grid, resolution, productType, collectionIdentifier) = productName.split('_')
-            base_title = '%s %s %s' % (collection_title, productType, grid)
-            if args.include_resolution:
-                base_title = '%s %s %s %s' % (collection_title, productType, resolution.lower(), grid)
-            products.append({
-                'name': productName.lower(),
-                'collectionName': collection_name,
-                    'metadata': {
-                        'title': base_title,
-                        'boundingBox': grids[grid]['wgs84']['bbox']
-                    },
-                    'properties': {
-                        'osgbGridRef': grid
+            grids[item['properties'][grid_property]] = {'wgs84': {'geojson': item['geometry'], 'bbox': get_bbox(item)}}
+
+    return grids
+
+def list_objects(source, prefix, recursive):
+    with METRICS.stage('s3_list'):
+        objects = source.list_objects(prefix, recursive)
+    METRICS.count('objects_listed', len(objects))
+    print('Listed %d objects under %s' % (len(objects), prefix))
+    return objects
+
+def list_bucket(source, s3_path, workers, split_depth):
+    # Yields (key, size, etag) for every object under s3_path. The listing is split across sub
+    # prefixes which are listed concurrently, results come back in sub prefix order so the
+    # output is the same from run to run.
+    with METRICS.stage('s3_split_prefix'):
+        prefixes = source.split_prefix(s3_path, split_depth) if workers > 1 else [(s3_path, True)]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for (prefix, recursive) in prefixes:
+            pending.append(executor.submit(list_objects, source, prefix, recursive))
+            if len(pending) > 2 * workers:
+                yield from pending.popleft().result()
+
+        while pending:
+            yield from pending.popleft().result()
+
+def make_product(key, size, bucket, region, grids, collection_name, collection_title, include_resolution):
+    #GRID_50CM_DSM_CONTRACTNAME.TIFF
+    #Scotland Lidar-1 %s %s
+    (productName, fileType) = os.path.basename(key).split('.')
+    (grid, resolution, productType, collectionIdentifier) = productName.split('_')
+    base_title = '%s %s %s' % (collection_title, productType, grid)
+    if include_resolution:
+        base_title = '%s %s %s %s' % (collection_title, productType, resolution.lower(), grid)
+    return {
+        'name': productName.lower(),
+        'collectionName': collection_name,
+            'metadata': {
+                'title': base_title,
+                'boundingBox': grids[grid]['wgs84']['bbox']
+            },
+            'properties': {
+                'osgbGridRef': grid
+            },
+            'footprint': grids[grid]['wgs84']['geojson'],
+            'data': {
+                'product': {
+                    'title': base_title,
+                    'http': {
+                        # 'url': 'https://s3-%s.amazonaws.com/%s/%s' % (region, bucket, key),
+                        'url': 'https://%s.s3-%s.amazonaws.com/%s' % (bucket, region, key),
+                        'size': size,
+                        'type': getFileType(fileType)
                     },
-                    'footprint': grids[grid]['wgs84']['geojson'],
-                    'data': {
-                        'product': {
-                            'title': base_title,
-                            'http': {
-                                # 'url': 'https://s3-%s.amazonaws.com/%s/%s' % (region, bucket, key.key),
-                                'url': 'https://%s.s3-%s.amazonaws.com/%s' % (bucket, region, key.key),
-                                'size': key.size,
-                                'type': getFileType(fileType)
-                            },
-                            's3': {
-                                'key': key.key,
-                                'bucket': bucket,
-                                'region': region,
-                                'size': key.size,
-                                'type': getFileType(fileType)
-                            }
-                        }
+                    's3': {
+                        'key': key,
+                        'bucket': bucket,
+                        'region': region,
+                        'size': size,
+                        'type': getFileType(fileType)
                     }
-                })
+                }
+            }
+        }
+
+def open_grids(wgs84_grid_path, grid_property, use_grid_cache, grid_cache_path):
+    with METRICS.stage('grid_load'):
+        if use_grid_cache:
+            return open_grid_cache(wgs84_grid_path, grid_property, grid_cache_path)
+        return load_grids(wgs84_grid_path, grid_property)
+
+def get_products(source, bucket, region, s3_path, wgs84_grid_path, collection_name, collection_title,
+                 include_resolution=False, workers=DEFAULT_WORKERS, split_depth=DEFAULT_SPLIT_DEPTH, manifest_path=None,
+                 grid_property=DEFAULT_GRID_PROPERTY, use_grid_cache=True, grid_cache_path=None):
+    # Yields products one at a time as the listing comes back rather than building the
+    # whole list in memory, source is one of the object_sources listing sources. Tiles are
+    # looked up in the compiled grid cache unless use_grid_cache is off.
 
-    return products
+    grids = open_grids(wgs84_grid_path, grid_property, use_grid_cache, grid_cache_path)
+
+    objects = list_bucket(source, s3_path, workers, split_depth)
+    if manifest_path:
+        objects = save_manifest(objects, manifest_path)
+
+    for (key, size, _) in objects:
+        if (not key.endswith('/')):
+            with METRICS.stage('make_product'):
+                product = make_product(key, size, bucket, region, grids, collection_name, collection_title, include_resolution)
+            yield product
+
+def index_catalog(session, catalog_url, bucket, s3_path, collection_name, page_size):
+    # The collection's products from this bucket and path, indexed by S3 key to size and to
+    # the product itself
+    catalogued = {}
+    products = {}
+    unmatched = 0
+    for product in reconcile.catalog_products(session, catalog_url, collection_name, page_size, METRICS):
+        found = reconcile.product_object(product, bucket)
+        if found is None:
+            unmatched += 1
+        elif found[0].startswith(s3_path):
+            (key, size) = found
+            catalogued[key] = size
+            products[key] = product
+    METRICS.count('catalog_products', len(products))
+    if unmatched:
+        print('%d products in %s do not point at an object in %s and were left out' % (unmatched, collection_name, bucket))
+    return (catalogued, products)
+
+def reconcile_products(source, bucket, region, s3_path, wgs84_grid_path, collection_name, collection_title,
+                       session, catalog_url, include_resolution=False, workers=DEFAULT_WORKERS,
+                       split_depth=DEFAULT_SPLIT_DEPTH, manifest_path=None, grid_property=DEFAULT_GRID_PROPERTY,
+                       use_grid_cache=True, grid_cache_path=None, page_size=reconcile.DEFAULT_PAGE_SIZE,
+                       previous_manifest_path=None):
+    # Compares the bucket listing with the collection's products in the catalog, returning
+    # (new products, changed products, orphaned catalog products). The catalog is paged
+    # through while the bucket is listed and only the new and changed products are built.
+    # ETags are compared with the previous run's manifest, if there is one, as products do
+    # not hold them.
+    previous = reconcile.manifest_etags(previous_manifest_path) if previous_manifest_path else {}
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        catalog = executor.submit(index_catalog, session, catalog_url, bucket, s3_path, collection_name, page_size)
+
+        objects = list_bucket(source, s3_path, workers, split_depth)
+        if manifest_path:
+            objects = save_manifest(objects, manifest_path)
+        listed = dict((key, (size, etag)) for (key, size, etag) in objects if not key.endswith('/'))
+
+        (catalogued, catalog_products) = catalog.result()
+
+    with METRICS.stage('reconcile'):
+        (new, changed, orphaned) = reconcile.reconcile(listed, catalogued, previous)
+
+    grids = open_grids(wgs84_grid_path, grid_property, use_grid_cache, grid_cache_path) if new or changed else None
+
+    def build(keys):
+        products = []
+        for key in keys:
+            (size, _) = listed[key]
+            with METRICS.stage('make_product'):
+                products.append(make_product(key, size, bucket, region, grids, collection_name, collection_title, include_resolution))
+        return products
+
+    return (build(new), build(changed), [catalog_products[key] for key in orphaned])
+
+def reconcile_output_path(output_path, part):
+    # lidar-4-dsm.json -> lidar-4-dsm.new.json
+    (root, extension) = os.path.splitext(output_path)
+    return '%s.%s%s' % (root, part, extension)
+
+def write_products(products, output, jsonl):
+    # Streams products to the output file (opened in binary mode) as they are produced,
+    # either as a JSON array or as JSON Lines. Products of the same tile share the tile's
+    # geometry, which is only encoded the first time it is written.
+    count = 0
+    footprints = {}
+    if not jsonl:
+        output.write(b'[')
+    for product in products:
+        with METRICS.stage('write'):
+            geometry = product.get('footprint')
+            if geometry is not None:
+                if id(geometry) not in footprints:
+                    # The geometry is kept so that its id is not reused
+                    footprints[id(geometry)] = (geometry, codec.fragment(geometry))
+                product = dict(product, footprint=footprints[id(geometry)][1])
+            if jsonl:
+                output.write(codec.dumps(product))
+                output.write(b'\n')
+            else:
+                if count > 0:
+                    output.write(b',')
+                output.write(codec.dumps(product))
+        count += 1
+    if not jsonl:
+        output.write(b']')
+    return count
 
 def getFileType(fileType):
     if (fileType == 'tif'):
@@ -104,14 +232,69 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--region', help='S3 bucket region', required=True)
     parser.add_argument('-p', '--profile', help='AWS profile to use for authentication', required=False)
     parser.add_argument('-g', '--geojson', help='The path to a GeoJSON file containing an appropriate grid system', required=True)
+    parser.add_argument('--grid_property', help='The grid file property holding the tile name (default %s)' % DEFAULT_GRID_PROPERTY, required=False, default=DEFAULT_GRID_PROPERTY)
+    parser.add_argument('--grid_cache', help='Path of the compiled grid cache (default alongside the grid file)', required=False)
+    parser.add_argument('--no_grid_cache', help='Parse the whole grid file instead of using the compiled grid cache', required=False, action='store_true', default=False)
 
     parser.add_argument('--path', help='Prefix path to scan for files on', required=True)
     parser.add_argument('-c', '--collection', help='Catalog Collection name to associate with the scanned files', required=True)
     parser.add_argument('-t', '--collectiontitle', help='Collection Title to use in creating titles for the scanned files', required=True)
     parser.add_argument('-o', '--output', help='Full output json file path', required=True)
     parser.add_argument('--include_resolution', help='Include the product resolution in the product titles', required=False, action='store_true', default=False)
+    parser.add_argument('--jsonl', help='Write the output as JSON Lines (one product per line) rather than a single JSON array', required=False, action='store_true', default=False)
+    parser.add_argument('-w', '--workers', help='Number of sub prefixes to list concurrently (default %d, 1 lists the whole path serially)' % DEFAULT_WORKERS, required=False, type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--split_depth', help='How many folder levels below the path to split the listing over (default %d)' % DEFAULT_SPLIT_DEPTH, required=False, type=int, default=DEFAULT_SPLIT_DEPTH)
+
+    source_group = parser.add_mutually_exclusive_group()
+    source_group.add_argument('--local', help='List a local directory tree laid out like the bucket instead of S3', required=False)
+    source_group.add_argument('--manifest', help='List a saved manifest (JSON Lines of key / size) instead of S3', required=False)
+    parser.add_argument('--save_manifest', help='Save the listing as a manifest for later --manifest runs', required=False)
+    parser.add_argument('--reconcile', help='Base URL of a catalog API to reconcile the listing with, only the new, changed and orphaned products are written, each to its own file alongside the output', required=False)
+    parser.add_argument('--previous_manifest', help='Manifest saved (with --save_manifest) by the run the catalog was last loaded from, objects whose ETag has changed since are reconciled as changed', required=False)
+    parser.add_argument('--page_size', help='Products per catalog search page when reconciling (default %d)' % reconcile.DEFAULT_PAGE_SIZE, required=False, type=int, default=reconcile.DEFAULT_PAGE_SIZE)
+    instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
+    workers = max(1, args.workers)
+    if args.reconcile and http_client is None:
+        parser.error('--reconcile needs the requests package')
+    METRICS = instrumentation.from_args(args)
+
+    if args.local:
+        source = LocalObjectSource(args.local)
+    elif args.manifest:
+        source = ManifestObjectSource(args.manifest)
+    else:
+        source = S3ObjectSource(args.bucket, args.profile, max(10, workers))
+
+    if args.reconcile:
+        try:
+            (new, changed, orphaned) = reconcile_products(source, args.bucket, args.region, args.path, args.geojson, args.collection,
+                                                          args.collectiontitle, http_client.create_session(retry_post=True), args.reconcile,
+                                                          args.include_resolution, workers, args.split_depth, args.save_manifest,
+                                                          args.grid_property, not args.no_grid_cache, args.grid_cache,
+                                                          max(1, args.page_size), args.previous_manifest)
+            for (part, products) in (('new', new), ('changed', changed), ('orphaned', orphaned)):
+                path = reconcile_output_path(args.output, part)
+                with open(path, 'wb') as output:
+                    count = write_products(products, output, args.jsonl)
+                METRICS.count('products_%s' % part, count)
+                print('Wrote %d %s products to %s' % (count, part, path))
+                if part == 'changed' and count:
+                    # The API does not replace products, they would all fail as duplicates
+                    print('Import %s with the importer\'s --direct mode, which updates the existing products' % path)
+        finally:
+            METRICS.close()
+    else:
+        products = get_products(source, args.bucket, args.region, args.path, args.geojson, args.collection, args.collectiontitle,
+                                args.include_resolution, workers, args.split_depth, args.save_manifest,
+                                args.grid_property, not args.no_grid_cache, args.grid_cache)
+
+        try:
+            with open(args.output, 'wb') as output:
+                count = write_products(products, output, args.jsonl)
+            METRICS.count('products_written', count)
+        finally:
+            METRICS.close()
 
-    with open(args.output, 'w') as output:
-        json.dump(get_products(args.bucket, args.region, args.path, args.geojson, args.collection, args.collectiontitle, args.profile), output)
+        print('Wrote %d products to %s' % (count, args.output))
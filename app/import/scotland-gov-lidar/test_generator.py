@@ -0,0 +1,263 @@
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+
+from grid_cache import build_grid_cache, default_cache_path, open_grid_cache, GridCache
+from object_sources import LocalObjectSource, ManifestObjectSource, save_manifest
+import reconcile
+
+# Offline tests for the LiDAR json generator against synthetic grids and listings, built the
+# way the generator benchmark builds them, with no AWS credentials or network needed. Run
+# them from this folder with
+#
+#     python -m unittest test_generator
+
+def load_script(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+    spec = importlib.util.spec_from_file_location(name[:-len('.py')].replace('-', '_'), path)
+    script = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(script)
+    return script
+
+BENCHMARK = load_script('benchmark-generator.py')
+GENERATOR = load_script('scotland-lidar-json-generator.py')
+
+def feature(tile, geometry):
+    return {'type': 'Feature', 'properties': {'id': tile}, 'geometry': geometry}
+
+class FakeResponse:
+    def __init__(self, body):
+        self.ok = True
+        self.content = json.dumps(body).encode('utf-8')
+        self.text = self.content.decode('utf-8')
+
+class FakeCatalog:
+    # The catalog's /search/product over a collection held in memory, in name order
+    def __init__(self, products, supports_after=True):
+        self.products = sorted(products, key=lambda p: p['name'])
+        self.supports_after = supports_after
+        self.queries = []
+
+    def post(self, url, json=None):
+        self.queries.append(dict(json))
+        products = [p for p in self.products if p['collectionName'] in json['collections']]
+        if self.supports_after and 'after' in json:
+            products = [p for p in products if p['collectionName'] + '/' + p['name'] > json['after']]
+        return FakeResponse({'result': products[:json['limit']]})
+
+def square(x, y, size):
+    return [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+
+class GeneratorTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.folder.name, name)
+
+class GridTest(GeneratorTest):
+    def setUp(self):
+        super().setUp()
+        self.grid_path = self.path('grid.geojson')
+        BENCHMARK.write_synthetic_grid(self.grid_path, 30)
+
+    def open_cache(self):
+        # Opened (and built when needed) without the build message
+        with contextlib.redirect_stdout(io.StringIO()):
+            return open_grid_cache(self.grid_path, 'id')
+
+    def test_bbox_covers_every_ring_and_part(self):
+        # A tile split by the coast, the second part reaching further than the first
+        multi = feature('NS00', {'type': 'MultiPolygon', 'coordinates': [[square(0, 0, 1)], [square(2, -1, 1)]]})
+        self.assertEqual(GENERATOR.get_bbox(multi), {'west': 0, 'south': -1, 'east': 3, 'north': 1})
+
+        # An outer ring listed after a hole
+        holed = feature('NS01', {'type': 'Polygon', 'coordinates': [square(1, 1, 1), square(0, 0, 3)]})
+        self.assertEqual(GENERATOR.get_bbox(holed), {'west': 0, 'south': 0, 'east': 3, 'north': 3})
+
+    def test_cache_matches_the_parsed_grid(self):
+        grids = GENERATOR.load_grids(self.grid_path)
+        cache = self.open_cache()
+        try:
+            self.assertEqual(len(cache), len(grids))
+            for tile in grids:
+                self.assertIn(tile, cache)
+                self.assertEqual(cache[tile], grids[tile])
+        finally:
+            cache.close()
+
+    def test_missing_tile_is_not_in_the_cache(self):
+        cache_path = self.path('grid.cache')
+        build_grid_cache(self.grid_path, 'id', cache_path)
+        cache = GridCache(cache_path)
+        try:
+            self.assertNotIn('T999999', cache)
+            with self.assertRaises(KeyError):
+                cache['T999999']
+        finally:
+            cache.close()
+
+    def test_products_are_the_same_from_the_cache(self):
+        keys = list(BENCHMARK.synthetic_keys('lidar/', 30, 0.5))
+        objects = [(key, size, None) for (key, size) in keys]
+        cache = self.open_cache()
+        try:
+            self.assertEqual(BENCHMARK.make_products(GENERATOR, objects, cache),
+                             BENCHMARK.make_products(GENERATOR, objects, GENERATOR.load_grids(self.grid_path)))
+        finally:
+            cache.close()
+
+    def test_stale_cache_is_rebuilt(self):
+        self.open_cache().close()
+
+        with open(self.grid_path) as grid_file:
+            grid = json.load(grid_file)
+        grid['features'].append(feature('T999999', {'type': 'Polygon', 'coordinates': [square(0, 0, 1)]}))
+        with open(self.grid_path, 'w') as grid_file:
+            json.dump(grid, grid_file)
+
+        cache = self.open_cache()
+        try:
+            self.assertEqual(len(cache), 31)
+            self.assertIn('T999999', cache)
+        finally:
+            cache.close()
+
+    def test_corrupt_cache_is_rebuilt(self):
+        with open(default_cache_path(self.grid_path, 'id'), 'wb') as cache_file:
+            cache_file.write(b'not a grid cache' * 8)
+
+        cache = self.open_cache()
+        try:
+            self.assertEqual(len(cache), 30)
+        finally:
+            cache.close()
+
+class ObjectSourceTest(GeneratorTest):
+    def setUp(self):
+        super().setUp()
+        # Keys spread over resolution prefixes, plus one sitting directly under the path
+        self.keys = sorted(list(BENCHMARK.synthetic_keys('lidar/dsm/', 20, 1)) + [('lidar/dsm/index.txt', 0)])
+        manifest_path = self.path('manifest.jsonl')
+        BENCHMARK.write_manifest(manifest_path, self.keys)
+        BENCHMARK.write_local_tree(self.path('bucket'), self.keys)
+        self.sources = [ManifestObjectSource(manifest_path), LocalObjectSource(self.path('bucket'))]
+
+    def listed(self, source, prefixes):
+        return sorted(key for (prefix, recursive) in prefixes for (key, _, _) in source.list_objects(prefix, recursive))
+
+    def test_split_covers_every_key_once(self):
+        for source in self.sources:
+            prefixes = source.split_prefix('lidar/dsm/', 1)
+            self.assertEqual(prefixes, [('lidar/dsm/', False)] + [('lidar/dsm/%s/' % r, True) for r in sorted(BENCHMARK.RESOLUTIONS)])
+            self.assertEqual(self.listed(source, prefixes), [key for (key, _) in self.keys])
+
+    def test_path_without_a_trailing_slash_is_split_below_it(self):
+        for source in self.sources:
+            self.assertEqual(source.split_prefix('lidar/dsm', 1), source.split_prefix('lidar/dsm/', 1))
+            self.assertEqual(source.split_prefix('lidar', 2), source.split_prefix('lidar/dsm/', 1))
+
+    def test_no_split_lists_recursively(self):
+        for source in self.sources:
+            self.assertEqual(source.split_prefix('lidar/dsm/', 0), [('lidar/dsm/', True)])
+            self.assertEqual(source.split_prefix('lidar/dsm/1m/', 1), [('lidar/dsm/1m/', True)])
+
+    def test_non_recursive_listing_only_covers_the_level(self):
+        for source in self.sources:
+            self.assertEqual(source.list_objects('lidar/dsm/', False), [('lidar/dsm/index.txt', 0, None)])
+
+    def test_concurrent_listing_is_in_a_stable_order(self):
+        for source in self.sources:
+            with contextlib.redirect_stdout(io.StringIO()):
+                serial = list(GENERATOR.list_bucket(source, 'lidar/dsm/', 1, 1))
+                concurrent = list(GENERATOR.list_bucket(source, 'lidar/dsm/', 4, 1))
+            self.assertEqual(sorted(serial), sorted(concurrent))
+            self.assertEqual(concurrent, [o for (p, r) in source.split_prefix('lidar/dsm/', 1) for o in source.list_objects(p, r)])
+
+class ReconcileTest(GeneratorTest):
+    def setUp(self):
+        super().setUp()
+        self.grid_path = self.path('grid.geojson')
+        BENCHMARK.write_synthetic_grid(self.grid_path, 10)
+        self.keys = list(BENCHMARK.synthetic_keys('lidar/', 10, 1))
+
+    def catalog(self, keys, **options):
+        # The collection as loaded from an earlier listing
+        grids = GENERATOR.load_grids(self.grid_path)
+        products = [dict(GENERATOR.make_product(key, size, 'lidar-bucket', 'eu-west-1', grids, 'lidar/dsm', 'Lidar', False), id='id-%d' % i)
+                    for (i, (key, size)) in enumerate(keys)]
+        return FakeCatalog(products, **options)
+
+    def manifest(self, name, objects):
+        path = self.path(name)
+        list(save_manifest(objects, path))
+        return path
+
+    def reconcile(self, listing, catalog, previous_manifest_path=None):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return GENERATOR.reconcile_products(ManifestObjectSource(self.manifest('listing.jsonl', listing)),
+                                                'lidar-bucket', 'eu-west-1', 'lidar/', self.grid_path, 'lidar/dsm', 'Lidar',
+                                                catalog, 'http://catalog/', workers=2, page_size=3, use_grid_cache=False,
+                                                previous_manifest_path=previous_manifest_path)
+
+    def test_classification(self):
+        listed = {'a': (1, None), 'b': (2, None), 'c': (3, 'v2'), 'd': (4, 'v1')}
+        catalogued = {'b': 2, 'c': 3, 'd': 40, 'e': 5}
+        self.assertEqual(reconcile.reconcile(listed, catalogued), (['a'], ['d'], ['e']))
+        self.assertEqual(reconcile.reconcile(listed, catalogued, {'c': 'v1', 'd': 'v1'}), (['a'], ['c', 'd'], ['e']))
+        # An ETag is only compared when both runs know it
+        self.assertEqual(reconcile.reconcile(listed, catalogued, {'b': 'v1'}), (['a'], ['d'], ['e']))
+
+    def test_product_object(self):
+        (product,) = self.catalog(self.keys[:1]).products
+        self.assertEqual(reconcile.product_object(product, 'lidar-bucket'), self.keys[0])
+        self.assertIsNone(reconcile.product_object(product, 'another-bucket'))
+        self.assertIsNone(reconcile.product_object({'data': {}}, 'lidar-bucket'))
+
+    def test_catalog_is_paged_with_after(self):
+        catalog = self.catalog(self.keys)
+        products = list(reconcile.catalog_products(catalog, 'http://catalog/', 'lidar/dsm', 3))
+        self.assertEqual(len(products), 10)
+        self.assertEqual(len(catalog.queries), 5)
+        self.assertEqual(catalog.queries[1]['after'], 'lidar/dsm/' + products[2]['name'])
+
+    def test_catalog_without_after_is_an_error(self):
+        with self.assertRaises(ValueError):
+            list(reconcile.catalog_products(self.catalog(self.keys, supports_after=False), 'http://catalog/', 'lidar/dsm', 3))
+
+    def test_reconcile_products(self):
+        # Two tiles added to the bucket, one replaced by a file of a new size, one removed
+        catalog = self.catalog(self.keys[:8])
+        listing = [(key, size, 'v1') for (key, size) in self.keys[1:]]
+        (replaced, size, _) = listing[2]
+        listing[2] = (replaced, size + 1, 'v1')
+
+        (new, changed, orphaned) = self.reconcile(listing, catalog)
+
+        self.assertEqual([p['data']['product']['s3']['key'] for p in new], [key for (key, _) in self.keys[8:]])
+        self.assertEqual([(p['data']['product']['s3']['key'], p['data']['product']['s3']['size']) for p in changed],
+                         [(replaced, size + 1)])
+        self.assertEqual([p['data']['product']['s3']['key'] for p in orphaned], [self.keys[0][0]])
+
+    def test_replaced_file_of_the_same_size_is_changed_by_etag(self):
+        catalog = self.catalog(self.keys)
+        previous = self.manifest('previous.jsonl', [(key, size, 'v1') for (key, size) in self.keys])
+        listing = [(key, size, 'v1') for (key, size) in self.keys]
+        listing[3] = (listing[3][0], listing[3][1], 'v2')
+
+        self.assertEqual(self.reconcile(listing, catalog), ([], [], []))
+        (new, changed, orphaned) = self.reconcile(listing, catalog, previous)
+        self.assertEqual(([p['data']['product']['s3']['key'] for p in changed], new, orphaned), ([self.keys[3][0]], [], []))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,691 @@
+#pylint: disable=C0111
+"""
+Tests for the importer's streaming input readers, manifests, footprint compaction, client
+side validation, bulk batches, resumable imports, flow control, direct mode, the run
+instrumentation and the shared JSON codec, run from this folder with
+
+    python -m unittest test_importer
+"""
+import contextlib
+import csv
+import io
+import json
+import os
+import tempfile
+import unittest
+import uuid
+
+from unittest import mock
+
+from importer import (Importer, interleave, iter_json_array, iter_json_lines, iter_products,
+                      read_manifest)
+import codec
+import flow_control
+import footprint
+import importer
+import instrumentation
+import pg_loader
+import schema_cache
+
+
+def read_array(text, chunk_size):
+    return list(iter_json_array(io.StringIO(text), chunk_size))
+
+
+class IterJsonArrayTest(unittest.TestCase):
+
+    def assert_all_chunk_sizes(self, text, expected):
+        for chunk_size in range(1, len(text) + 2):
+            self.assertEqual(read_array(text, chunk_size), expected,
+                             'chunk size %d' % chunk_size)
+
+    def test_products(self):
+        products = [{'name': 'p%d' % i, 'properties': {'n': [i, 1.5, None, True]}}
+                    for i in range(20)]
+        self.assert_all_chunk_sizes(json.dumps(products), products)
+        self.assert_all_chunk_sizes(json.dumps(products, indent=2), products)
+
+    def test_empty_array(self):
+        self.assert_all_chunk_sizes(' [ ] ', [])
+
+    def test_numbers_split_across_chunks(self):
+        self.assert_all_chunk_sizes('[1.5e3, 2]', [1500.0, 2])
+        self.assert_all_chunk_sizes('[1.5,22,333]', [1.5, 22, 333])
+        self.assert_all_chunk_sizes('[-12.25E-2 ,1e+2]', [-0.1225, 100.0])
+
+    def test_literals_and_strings_split_across_chunks(self):
+        self.assert_all_chunk_sizes('[true,false,null,"a,]b"]', [True, False, None, 'a,]b'])
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            read_array('{"name": "p"}', 4)
+
+    def test_unclosed_array(self):
+        with self.assertRaises(ValueError):
+            read_array('[1, 2', 4)
+
+    def test_missing_separator(self):
+        with self.assertRaises(ValueError):
+            read_array('[1 2]', 4)
+
+
+class IterProductsTest(unittest.TestCase):
+
+    def test_detects_array(self):
+        products = [{'name': 'a'}, {'name': 'b'}]
+        self.assertEqual(list(iter_products(io.StringIO('\n  ' + json.dumps(products)))),
+                         products)
+
+    def test_detects_json_lines(self):
+        text = '{"name": "a"}\n\n{"name": "b"}\n'
+        self.assertEqual(list(iter_products(io.StringIO(text))),
+                         [{'name': 'a'}, {'name': 'b'}])
+
+    def test_invalid_json_line(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_lines(io.StringIO('{"name": "a"}\n{"name": \n')))
+
+
+class ManifestTest(unittest.TestCase):
+
+    def test_interleave(self):
+        started = []
+
+        def source(name, count):
+            started.append(name)
+            for i in range(count):
+                yield '%s%d' % (name, i)
+
+        items = list(interleave((source(n, c) for (n, c) in [('a', 3), ('b', 1), ('c', 2)]), 2))
+        self.assertEqual(items, ['a0', 'b0', 'a1', 'a2', 'c0', 'c1'])
+        self.assertEqual(started, ['a', 'b', 'c'])
+
+    def test_read_manifest(self):
+        with tempfile.TemporaryDirectory() as folder:
+            for name in ('c.json', 'p1.json', 'p2.jsonl'):
+                open(os.path.join(folder, name), 'w').close()
+            path = os.path.join(folder, 'manifest.json')
+
+            with open(path, 'w') as manifest:
+                json.dump({'collections': ['c.json'], 'products': ['p*', 'p1.json']}, manifest)
+            self.assertEqual(read_manifest(path), (
+                [os.path.join(folder, 'c.json')],
+                [os.path.join(folder, 'p1.json'), os.path.join(folder, 'p2.jsonl')]))
+
+            with open(path, 'w') as manifest:
+                json.dump({'products': ['missing/*.json']}, manifest)
+            with self.assertRaises(ValueError):
+                read_manifest(path)
+
+
+class CompactFootprintTest(unittest.TestCase):
+
+    SQUARE = {'type': 'MultiPolygon', 'coordinates': [[[
+        [-3.123456789, 55.0], [-3.0000000001, 55.0], [-3.0, 55.0], [-3.0, 55.1234567891],
+        [-3.0, 55.1234567891], [-3.123456789, 55.1234567891], [-3.123456789, 55.0]]]]}
+
+    def test_drops_duplicate_and_collinear_vertices(self):
+        (compacted, counts) = footprint.compact_footprint(self.SQUARE)
+        self.assertEqual(len(compacted['coordinates'][0][0]), 5)
+        self.assertEqual(counts[:2], (7, 5))
+        self.assertLess(counts[3], counts[2])
+
+    def test_rounds_to_precision(self):
+        (compacted, _) = footprint.compact_footprint(self.SQUARE, precision=3)
+        self.assertEqual(sorted(set(tuple(v) for v in compacted['coordinates'][0][0])),
+                         [(-3.123, 55.0), (-3.123, 55.123), (-3.0, 55.0), (-3.0, 55.123)])
+
+    def test_keeps_ccw_exterior_rings(self):
+        (compacted, _) = footprint.compact_footprint(self.SQUARE, precision=4, tolerance=0.001)
+        ring = compacted['coordinates'][0][0]
+        area = sum(x0 * y1 - x1 * y0 for ((x0, y0), (x1, y1)) in zip(ring, ring[1:]))
+        self.assertGreater(area, 0)
+
+    def test_collapsed_footprint(self):
+        with self.assertRaises(ValueError):
+            footprint.compact_footprint(self.SQUARE, precision=0)
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_backends_agree(self):
+        value = {'name': 'p\u00e9', 'footprint': {'coordinates': [[[-3.5, 55.25], [1, 2]]]},
+                 'data': None, 'count': 3, 'ok': True}
+        for backend in codec.BACKENDS.values():
+            data = backend.dumps(value)
+            self.assertIsInstance(data, bytes, backend.name)
+            self.assertEqual(json.loads(data), value, backend.name)
+            self.assertEqual(backend.loads(data), value, backend.name)
+            self.assertEqual(backend.loads(memoryview(data)), value, backend.name)
+            self.assertEqual(backend.loads(data.decode('utf-8')), value, backend.name)
+
+    def test_fragments_are_spliced(self):
+        ring = [[i / 1000.0, 55 + i / 1000.0] for i in range(200)]
+        geometry = {'type': 'Polygon', 'coordinates': [ring + ring[:1]]}
+        for backend in codec.BACKENDS.values():
+            shared = backend.fragment(geometry)
+            self.assertIsInstance(shared, codec.Fragment, backend.name)
+            products = [{'name': 'a', 'footprint': shared}, {'name': 'b', 'footprint': shared}]
+            self.assertEqual(json.loads(backend.dumps(products)),
+                             [{'name': 'a', 'footprint': geometry},
+                              {'name': 'b', 'footprint': geometry}], backend.name)
+
+    def test_small_values_are_not_fragments(self):
+        small = {'type': 'Point', 'coordinates': [0, 0]}
+        for backend in codec.BACKENDS.values():
+            if len(backend.dumps(small)) < backend.min_fragment_bytes:
+                self.assertIs(backend.fragment(small), small, backend.name)
+            else:
+                self.assertIsInstance(backend.fragment(small), codec.Fragment, backend.name)
+
+    def test_decode_error(self):
+        for backend in codec.BACKENDS.values():
+            with self.assertRaises(codec.DecodeError, msg=backend.name):
+                backend.loads(b'{"name": ')
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def test_trace_and_summary_are_json(self):
+        with tempfile.TemporaryDirectory() as folder:
+            (summary_path, trace_path) = (os.path.join(folder, 'summary.json'), os.path.join(folder, 'trace.jsonl'))
+            metrics = instrumentation.Instrumentation(summary_path, trace_path)
+            for _ in range(3):
+                with metrics.stage('parse'):
+                    pass
+            metrics.count('products_imported', 3)
+            metrics.close()
+
+            with open(trace_path) as trace_file:
+                self.assertEqual([json.loads(line)['stage'] for line in trace_file], ['parse'] * 3)
+            with open(summary_path) as summary_file:
+                summary = json.load(summary_file)
+            self.assertEqual(summary['stages']['parse']['count'], 3)
+            self.assertEqual(summary['counters']['products_imported']['total'], 3)
+
+
+class FakeResponse:
+
+    def __init__(self, body):
+        self.ok = True
+        self.content = json.dumps(body).encode('utf-8')
+
+
+class FakeSession:
+
+    def __init__(self, collections):
+        self.collections = collections
+        self.gets = []
+
+    def get(self, url):
+        self.gets.append(url)
+        name = url.split('/search/collection/', 1)[1]
+        return FakeResponse({'result': [c for c in self.collections if c['name'].startswith(name)]})
+
+
+SCHEMA = {
+    '$async': True,
+    'type': 'object',
+    'required': ['capturedDate'],
+    'properties': {
+        'capturedDate': {'type': 'string', 'fullDateValidation': True},
+        'grid': {'type': 'string', 'pattern': '^[A-Z]{2}[0-9]{2}$'}
+    }
+}
+
+
+@unittest.skipIf(not schema_cache.SchemaCache.available(), 'jsonschema is not installed')
+class SchemaCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = FakeSession([
+            {'name': 'a/b', 'productsSchema': SCHEMA},
+            {'name': 'a/b/c', 'productsSchema': dict(SCHEMA)},
+            {'name': 'a/open', 'productsSchema': None}
+        ])
+        self.schemas = schema_cache.SchemaCache(self.session, 'http://catalog')
+
+    def validate(self, collection_name, properties):
+        return self.schemas.validate(dict(lidar_product(100), collectionName=collection_name,
+                                          properties=properties))
+
+    def test_valid(self):
+        self.assertEqual(self.validate('a/b', {'capturedDate': '2019-02-28'}), [])
+        self.assertEqual(self.validate('a/b', {'capturedDate': '2019-02-28T10:00:00Z',
+                                               'grid': 'NY27'}), [])
+
+    def test_invalid(self):
+        self.assertEqual(self.validate('a/b', {'capturedDate': '2019-02-30', 'grid': 'x'}), [
+            'properties.capturedDate | is not a valid date',
+            "properties.grid | 'x' does not match '^[A-Z]{2}[0-9]{2}$'"
+        ])
+        self.assertEqual(len(self.validate('a/b', {})), 1)
+
+    def test_missing_collection(self):
+        self.assertEqual(self.validate('a/x', {}),
+                         ['collectionName | a/x does not exist in the database'])
+
+    def test_no_products_schema(self):
+        self.assertEqual(self.validate('a/open', {'anything': 1}), [])
+
+    def validate_product(self, **changes):
+        product = lidar_product(100)
+        for (path, value) in changes.items():
+            parent = product
+            keys = path.split('__')
+            for key in keys[:-1]:
+                parent = parent[key]
+            parent[keys[-1]] = value
+        return self.schemas.validate(dict(product, collectionName='a/open'))
+
+    def test_whole_product_is_validated(self):
+        self.assertEqual(self.validate_product(), [])
+        self.assertEqual(self.validate_product(metadata={'boundingBox': {'north': 1, 'south': 0, 'east': 1, 'west': 0}}),
+                         ["metadata | 'title' is a required property"])
+        self.assertEqual(self.validate_product(data__product__s3__etag='"abc"'),
+                         ["data.product.s3 | Additional properties are not allowed ('etag' was unexpected)"])
+        self.assertEqual(len(self.validate_product(data__product={'title': 'Only a title'})), 1)
+        self.assertEqual(len(self.validate_product(name='not a name')), 1)
+
+    def test_product_schema_errors_come_first(self):
+        # As on the server, a product failing its schema is not checked any further
+        self.assertEqual(self.schemas.validate(dict(lidar_product(100), name='', collectionName='a/x')),
+                         ["name | '' does not match '^([A-Za-z0-9-_.])+$'"])
+        self.assertEqual(self.session.gets, [])
+
+    def test_bounding_box_must_not_be_empty(self):
+        self.assertEqual(self.validate_product(metadata__boundingBox__north=55.0), [
+            'metadata.boundingBox | north should be greater than south'])
+
+    def test_formats_are_checked_as_on_the_server(self):
+        # Either a date or a date time, which needs both formats checked
+        for date in ('2019-02-28', '2019-02-28T10:00:00Z'):
+            self.assertEqual(self.validate_product(metadata__datasetReferenceDate=date), [], date)
+        for date in ('2019-02-30', '28/02/2019', '2019-02-28T10:00:00'):
+            self.assertTrue(self.validate_product(metadata__datasetReferenceDate=date), date)
+
+        # Either a host name, an IPv6 address or a URI
+        for server in ('ftp.example.com', '::1', 'ftp://ftp.example.com'):
+            self.assertEqual(self.validate_product(data__product__ftp={'server': server, 'path': '/a.tif'}), [], server)
+        self.assertEqual(len(self.validate_product(data__product__ftp={'server': 'not a host', 'path': '/a.tif'})), 1)
+
+        self.assertEqual(self.validate_product(data__product__http={'url': 'https://example.com/a.tif'}), [])
+        self.assertEqual(len(self.validate_product(data__product__http={'url': 'example.com/a.tif'})), 1)
+        self.assertEqual(len(self.validate_product(metadata__responsibleOrganisation={'email': 'nobody'})), 1)
+
+    def test_fetched_once_and_shared_by_schema(self):
+        for _ in range(3):
+            self.validate('a/b', {'capturedDate': '2019-02-28'})
+            self.validate('a/b/c', {'capturedDate': '2019-02-28'})
+        self.assertEqual(len(self.session.gets), 2)
+        self.assertEqual(len(self.schemas._validators), 1)
+
+
+class FakeSearchSession:
+    # /search/product over one collection in name order, honouring the after cursor unless
+    # the catalog predates it
+
+    def __init__(self, names, supports_after=True):
+        self.products = [{'collectionName': 'a/b', 'name': n} for n in sorted(names)]
+        self.supports_after = supports_after
+        self.queries = []
+
+    def post(self, url, json=None):
+        self.queries.append(dict(json))
+        products = self.products
+        if self.supports_after and 'after' in json:
+            products = [p for p in products if 'a/b/' + p['name'] > json['after']]
+        start = json.get('offset', 0)
+        return FakeResponse({'result': products[start:start + json['limit']]})
+
+
+@mock.patch.object(importer, 'EXISTENCE_CHECK_PAGE_SIZE', 3)
+class ExistingProductNamesTest(unittest.TestCase):
+
+    names = ['p%02d' % i for i in range(10)]
+
+    def existing(self, session):
+        return Importer('http://catalog', 'products.json', session=session,
+                        server_validation=True).existing_product_names('a/b')
+
+    def test_pages_with_after(self):
+        session = FakeSearchSession(self.names)
+        self.assertEqual(self.existing(session), set(self.names))
+        self.assertEqual(len(session.queries), 4)
+        self.assertFalse(any('offset' in q for q in session.queries))
+        self.assertEqual(session.queries[1]['after'], 'a/b/p02')
+
+    def test_falls_back_to_offset_paging(self):
+        session = FakeSearchSession(self.names, supports_after=False)
+        self.assertEqual(self.existing(session), set(self.names))
+        self.assertEqual([q.get('offset') for q in session.queries[2:]], [3, 6, 9])
+
+
+class FakeDatabase:
+    # Just enough of the catalog database for pg_loader, the staging COPY and the upsert
+    # into the product table
+
+    def __init__(self, collection_names):
+        self.collections = dict((name, str(uuid.uuid4())) for name in collection_names)
+        self.products = {}
+        self.staging = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        # The staging table is ON COMMIT DELETE ROWS
+        self.staging = []
+
+    def rollback(self):
+        self.staging = []
+
+    def close(self):
+        pass
+
+
+class FakeCursor:
+
+    def __init__(self, database):
+        self.database = database
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, statement, params=None):
+        self.rows = []
+        if statement == pg_loader.COLLECTIONS:
+            self.rows = [(self.database.collections[name], name, None) for name in params[0]
+                         if name in self.database.collections]
+        elif statement.strip().startswith('INSERT INTO product'):
+            self._upsert('DO UPDATE' in statement)
+
+    def copy_expert(self, statement, buffer):
+        self.database.staging.extend(csv.reader(buffer))
+
+    def _upsert(self, update):
+        latest = {}
+        for (seq, collection_id, name, metadata, properties, data, geometry) in sorted(
+                self.database.staging, key=lambda row: int(row[0])):
+            latest[(collection_id, name)] = {
+                'metadata': json.loads(metadata),
+                'properties': json.loads(properties) if properties else None,
+                'data': json.loads(data) if data else None,
+                'footprint': json.loads(geometry)
+            }
+        for (key, row) in latest.items():
+            existing = self.database.products.get(key)
+            if existing is None:
+                self.database.products[key] = dict(row, id=str(uuid.uuid4()))
+            elif update:
+                existing.update(row)
+            else:
+                continue
+            self.rows.append((self.database.products[key]['id'],) + key)
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+
+def lidar_product(size):
+    # A product as the LiDAR json generator writes it
+    return {
+        'name': 'nt27_50cm_dsm_phase1',
+        'collectionName': 'scotland-gov/lidar/phase-1/dsm',
+        'metadata': {'title': 'Scotland Lidar Phase 1 DSM NT27',
+                     'boundingBox': {'north': 56.0, 'south': 55.9, 'east': -3.0, 'west': -3.2}},
+        'properties': {'osgbGridRef': 'NT27'},
+        'footprint': {'type': 'Polygon', 'coordinates': [
+            [[-3.2, 55.9], [-3.0, 55.9], [-3.0, 56.0], [-3.2, 56.0], [-3.2, 55.9]]]},
+        'data': {'product': {'title': 'Scotland Lidar Phase 1 DSM NT27',
+                             's3': {'key': 'phase-1/dsm/NT27_50CM_DSM_PHASE1.tif',
+                                    'bucket': 'scotland-gov-lidar', 'region': 'eu-west-1',
+                                    'size': size}}}
+    }
+
+
+class DirectModeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.database = FakeDatabase(['scotland-gov/lidar/phase-1/dsm'])
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def load(self, name, products, update_existing=True):
+        path = os.path.join(self.folder.name, name)
+        with open(path, 'w') as products_file:
+            json.dump(products, products_file)
+        loader = pg_loader.PostgisLoader(self.database, update_existing=update_existing)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return Importer(None, path, product_import=True, batch_size=10, loader=loader,
+                            progress_interval=0).do_import()
+
+    def stored(self):
+        return list(self.database.products.values())
+
+    def test_changed_product_is_updated(self):
+        # The generator's reconcile mode writes products for replaced objects under their
+        # existing names, only direct mode can import them
+        self.load('full.json', [lidar_product(100)])
+        [original] = self.stored()
+
+        [(_, ok, message)] = self.load('full.changed.json', [lidar_product(200)])
+
+        self.assertTrue(ok)
+        self.assertEqual(message, original['id'])
+        [updated] = self.stored()
+        self.assertEqual(updated['data']['product']['s3']['size'], 200)
+
+    def test_existing_product_is_kept_when_skipping_existing(self):
+        self.load('full.json', [lidar_product(100)])
+        self.assertEqual(self.load('full.changed.json', [lidar_product(200)], False), [])
+        [kept] = self.stored()
+        self.assertEqual(kept['data']['product']['s3']['size'], 100)
+
+
+def named_product(name):
+    return dict(lidar_product(100), name=name)
+
+
+class FakeBatchResponse:
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.content = json.dumps(body).encode('utf-8')
+        self.text = self.content.decode('utf-8')
+
+
+class FakeBatchSession:
+    # The bulk /add/products route, rejecting a batch with any invalid or existing product
+    # in it as the API does, with a result for each product of the batch
+
+    def __init__(self, invalid=(), existing=(), too_large=False):
+        self.invalid = set(invalid)
+        self.existing = set(existing)
+        self.too_large = too_large
+        self.batches = []
+
+    def post(self, url, json=None):
+        names = [p['name'] for p in json]
+        self.batches.append(names)
+        if self.too_large:
+            return FakeBatchResponse(413, {'message': 'request entity too large'})
+        if self.invalid & set(names):
+            return FakeBatchResponse(400, {'results': [
+                {'productName': n, 'valid': n not in self.invalid,
+                 'validationErrors': ['%s is invalid' % n] if n in self.invalid else []}
+                for n in names]})
+        if self.existing & set(names):
+            return FakeBatchResponse(409, {'duplicates': [
+                {'collectionName': p['collectionName'], 'productName': p['name']}
+                for p in json if p['name'] in self.existing]})
+        return FakeBatchResponse(200, {'results': [{'productId': 'id-' + n} for n in names]})
+
+
+class ImportBatchTest(unittest.TestCase):
+
+    names = ['p%d' % i for i in range(6)]
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'products.json')
+        with open(self.path, 'w') as products_file:
+            json.dump([named_product(n) for n in self.names], products_file)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def run_import(self, session, resume=False):
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            results = Importer('http://catalog', self.path, product_import=True, batch_size=6,
+                               session=session, resume=resume, server_validation=True,
+                               progress_interval=0).do_import()
+        return dict((name, (ok, message)) for (name, ok, message) in results)
+
+    def test_per_product_errors_are_reported_against_their_products(self):
+        session = FakeBatchSession(invalid=['p1', 'p4'], existing=['p2'])
+        results = self.run_import(session)
+
+        self.assertEqual(session.batches, [self.names, ['p0', 'p2', 'p3', 'p5'], ['p0', 'p3', 'p5']])
+        for name in ('p0', 'p3', 'p5'):
+            self.assertEqual(results[name], (True, 'id-' + name))
+        for name in ('p1', 'p4'):
+            self.assertFalse(results[name][0])
+            self.assertIn('%s is invalid' % name, results[name][1])
+        self.assertFalse(results['p2'][0])
+        self.assertIn('already exists', results['p2'][1])
+
+        # The journal holds the same outcomes
+        journal = importer.ImportJournal(self.path + '.journal')
+        journal.close()
+        self.assertEqual(journal.completed, set(('scotland-gov/lidar/phase-1/dsm', n) for n in ('p0', 'p3', 'p5')))
+
+    def test_rejected_batch_fails_every_product(self):
+        results = self.run_import(FakeBatchSession(too_large=True))
+        self.assertEqual(sorted(results), self.names)
+        self.assertTrue(all(not ok and 'smaller --batch-size' in message for (ok, message) in results.values()))
+
+
+    def test_resume_only_sends_unimported_products(self):
+        self.run_import(FakeBatchSession(invalid=['p2', 'p4']))
+
+        session = FakeBatchSession()
+        results = self.run_import(session, resume=True)
+
+        self.assertEqual(session.batches, [['p2', 'p4']])
+        self.assertEqual(results, {'p2': (True, 'id-p2'), 'p4': (True, 'id-p4')})
+        # Nothing is left to import
+        session = FakeBatchSession()
+        self.assertEqual(self.run_import(session, resume=True), {})
+        self.assertEqual(session.batches, [])
+
+    def test_without_resume_everything_is_sent_again(self):
+        self.run_import(FakeBatchSession())
+        session = FakeBatchSession(existing=self.names)
+        self.run_import(session)
+        self.assertEqual(session.batches, [self.names])
+
+
+class ImportJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'products.json.journal')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_latest_outcome_of_each_product_counts(self):
+        journal = importer.ImportJournal(self.path)
+        journal.record(named_product('p1'), True, 'id-p1')
+        journal.record(named_product('p2'), False, 'invalid')
+        journal.record(named_product('p3'), True, 'id-p3')
+        # Imported again later and failed, i.e. after the product was deleted
+        journal.record(named_product('p3'), False, 'invalid')
+        journal.record(named_product('p2'), True, 'id-p2')
+        journal.close()
+
+        journal = importer.ImportJournal(self.path)
+        journal.close()
+        self.assertEqual(journal.completed,
+                         set(('scotland-gov/lidar/phase-1/dsm', n) for n in ('p1', 'p2')))
+
+    def test_journal_is_appended_to(self):
+        for name in ('p1', 'p2'):
+            journal = importer.ImportJournal(self.path)
+            journal.record(named_product(name), True, 'id-' + name)
+            journal.close()
+        with open(self.path) as journal_file:
+            self.assertEqual([json.loads(line)['name'] for line in journal_file], ['p1', 'p2'])
+
+
+class AdaptiveLimitTest(unittest.TestCase):
+
+    def fill(self, limit):
+        while limit.in_flight < int(limit.limit):
+            limit.acquire()
+
+    def test_slow_start_then_back_off(self):
+        limit = flow_control.AdaptiveLimit(16)
+        # Every response to a full window grows the limit by one, doubling it per window
+        for expected in (2, 4, 8, 16, 16):
+            for _ in range(int(limit.limit)):
+                self.fill(limit)
+                limit.release(0.01)
+            self.assertEqual(limit.limit, expected)
+
+        self.fill(limit)
+        limit.release(0.01, congested=True)
+        self.assertEqual(limit.limit, 8)
+        self.assertFalse(limit.slow_start)
+
+    def test_one_back_off_per_round_trip(self):
+        limit = flow_control.AdaptiveLimit(16, minimum=2)
+        limit.limit = 16
+        self.fill(limit)
+        for _ in range(4):
+            limit.release(10.0, congested=True)
+        self.assertEqual(limit.limit, 8)
+        self.assertEqual(limit.decreases, 1)
+
+    def test_latency_signals_congestion(self):
+        limit = flow_control.AdaptiveLimit(16, tolerance=2.0)
+        (limit.limit, limit.slow_start) = (8, False)
+        self.fill(limit)
+        limit.release(0.01)
+        for _ in range(10):
+            limit.release(0.05)
+        self.assertEqual(limit.decreases, 1)
+        self.assertLess(limit.limit, 5)
+
+    def test_unused_limit_does_not_grow(self):
+        limit = flow_control.AdaptiveLimit(16)
+        limit.limit = 4
+        for _ in range(10):
+            limit.acquire()
+            limit.release(0.01)
+        self.assertEqual(limit.limit, 4)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = flow_control.TokenBucket(10, burst=3)
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0.0, 0.0, 0.0])
+        waits = [bucket.reserve() for _ in range(3)]
+        for (wait, expected) in zip(waits, (0.1, 0.2, 0.3)):
+            self.assertAlmostEqual(wait, expected, delta=0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()